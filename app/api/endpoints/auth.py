@@ -3,14 +3,17 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from app.db.session import get_db
 from app.db.models.user import User, OTP
 from app.schemas.user import UserCreate, UserResponse
-from app.core.security import hash_password
+from app.core.security import hash_password_async, verify_and_update_password, PasswordHasherBusy
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.future import select
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from app.core.security import verify_password
-from app.core.email import send_otp_email
+from app.core.email import enqueue_otp_email
 from app.core.jwt import create_access_token, create_refresh_token, verify_refresh_token
 from app.dependencies.auth import get_current_user
-import random
+from app.dependencies.rate_limit import limit_login_username, rate_limit
+from app.services.email_dispatcher import email_dispatcher
+import secrets
 
 router = APIRouter()
 
@@ -21,29 +24,41 @@ async def get_me(username: str = Depends(get_current_user)):
     return {"username": username}
 
 
-@router.post("/login")
+@router.post("/login", dependencies=[rate_limit("auth.login"), Depends(limit_login_username)])
 async def login_user(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     try:
         result = await db.execute(select(User).filter(User.username == form_data.username))
         user = result.scalars().first()
-        # check the provided pass with its hash
-        if not user or not verify_password(form_data.password, user.hashed_password):
+        if not user:
+            raise HTTPException(
+                status_code=400, detail="Invalid username or password")
+        # check the provided pass with its hash, off the event loop
+        verified, new_hash = await verify_and_update_password(form_data.password, user.hashed_password)
+        if not verified:
             raise HTTPException(
                 status_code=400, detail="Invalid username or password")
 
         access_token = create_access_token({"sub": user.username})
         refresh_token = create_refresh_token({"sub": user.username})
+        if new_hash:
+            # stored hash uses outdated cost settings, upgrade it
+            user.hashed_password = new_hash
+            await db.commit()
         return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
+    except PasswordHasherBusy as e:
+        raise HTTPException(status_code=503, detail=str(e),
+                            headers={"Retry-After": "1"}) from None
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from None
 
 
-@router.post("/register", response_model=UserResponse)
+@router.post("/register", response_model=UserResponse, dependencies=[rate_limit("auth.register")])
 async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     try:
-        # check user exists
-        result = await db.execute(select(User).filter(User.username == user.username))
-        existing_user = result.scalars().first()
+        # check user exists, usernames are unique ignoring case
+        result = await db.execute(
+            select(User.id).filter(func.lower(User.username) == user.username.lower()))
+        existing_user = result.first()
         if existing_user:
             raise HTTPException(
                 status_code=400, detail="Username already registered")
@@ -51,11 +66,20 @@ async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
         new_user = User(
             username=user.username,
             email=user.email,
-            hashed_password=hash_password(user.hashed_password)
+            hashed_password=await hash_password_async(user.hashed_password)
         )
         db.add(new_user)
+        if user.email:
+            await db.flush()
+            # Generate a random 6-digit OTP
+            otp_code = f"{secrets.randbelow(1000000):06d}"
+            db.add(OTP(user_id=new_user.id, otp_code=otp_code))
+            # Queue the OTP email in the same transaction, the dispatcher
+            # sends it in the background
+            enqueue_otp_email(db, user.email, otp_code)
         await db.commit()
         await db.refresh(new_user)
+        email_dispatcher.notify()
 
         user_data = UserResponse(
             id=new_user.id,
@@ -64,30 +88,19 @@ async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
             created_at=new_user.created_at
         )
 
-        # # Generate a random 6-digit OTP
-        # otp_code = str(random.randint(100000, 999999))
-
-        # # Store OTP (ensure user_id is the primary key)
-        # existing_otp = await db.execute(select(OTP).filter(OTP.user_id == new_user.id))
-        # otp_entry = existing_otp.scalars().first()
-
-        # if otp_entry:
-        #     otp_entry.otp_code = otp_code
-        # else:
-        #     new_otp = OTP(user_id=new_user.id, otp_code=otp_code)
-        #     db.add(new_otp)
-
-        # await db.commit()
-
-        # # Send OTP via email
-        # await send_otp_email(user.email, otp_code)
-
         return user_data
+    except IntegrityError:
+        # registered concurrently, uq_users_username_lower caught it
+        raise HTTPException(
+            status_code=400, detail="Username already registered") from None
+    except PasswordHasherBusy as e:
+        raise HTTPException(status_code=503, detail=str(e),
+                            headers={"Retry-After": "1"}) from None
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from None
 
 
-@router.post("/refresh")
+@router.post("/refresh", dependencies=[rate_limit("auth.refresh")])
 async def refresh_token(refresh_token: str):
     try:
         payload = verify_refresh_token(refresh_token)
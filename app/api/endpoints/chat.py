@@ -1,258 +1,691 @@
-from dotenv import load_dotenv
-from fastapi import APIRouter, WebSocket, Depends, WebSocketException, status, HTTPException, WebSocketDisconnect
+from fastapi import APIRouter, WebSocket, Depends, WebSocketException, status, HTTPException, WebSocketDisconnect, Query
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from app.dependencies.auth import get_current_user
-from app.db.session import get_db
-from app.db.models.user import User
+from app.dependencies.auth import get_current_principal, verify_access_token_cached
+from app.db.session import get_db, SessionLocal
 from app.db.models.chat import ChatRoom, ChatParticipant, ChatMessage
-from app.schemas.chat import ChatCreate, ChatResponse, MessageResponse
+from app.schemas.chat import (ChatCreate, ChatCreateResponse, ChatResponse, MessagePage, InboxPage, ReadReceipt,
+                              SearchPage, PresencePage, ParticipantsUpdate, ParticipantsResult,
+                              MessageSend, MessageSent)
+from app.core.config import settings
+from app.core.pagination import encode_cursor, decode_cursor
+from app.core.serialization import FastJSONResponse, Frame, dumps
+from app.core.wire import DECODE_ERRORS, FrameTooLarge, negotiate
+from app.services.broadcast import Connection, frame_counters
+from app.services.chat_hub import hub
+from app.services.dedup import valid_client_msg_id
+from app.services.membership import membership
+from app.services.archive import message_archive
+from app.services.message_writer import message_error, persist_message
+from app.services.participants import (ADDED, MAX_BULK_MEMBERS, REMOVED, add_members, announce_members,
+                                       create_room, insert_participants, remove_members)
+from app.services.presence import presence
+from app.services.rate_limit import TokenBucket
+from app.services.search import search_messages
+from app.services.sync import catch_up, parse_cursors
+from app.services.user_cache import Principal, user_cache
+from sqlalchemy import and_, func, or_, tuple_, update
 from sqlalchemy.future import select
 from datetime import datetime
-import json
-import os
-from jose import JWTError, jwt
+from typing import List, Optional
+import logging
 
 
+logger = logging.getLogger(__name__)
 router = APIRouter()
 
+MAX_PAGE_SIZE = 200
+EXPORT_BATCH_SIZE = 1000
+WS_FRAME_RATE = settings.ws_frame_rate
+WS_FRAME_BURST = settings.ws_frame_burst
+WS_FLOOD_MAX_VIOLATIONS = settings.ws_flood_max_violations
 
-load_dotenv()
-# JWT Secret and Algorithm
-SECRET_KEY = os.getenv("SECRET KEY", "").strip()
-ALGORITHM = os.getenv("ALGORITHM")
+
+def _chat_dict(chat: ChatRoom) -> dict:
+    return {
+        "id": chat.id,
+        "name": chat.name,
+        "is_group": chat.is_group,
+        "created_at": chat.created_at,
+    }
+
+
+def _message_dict(message: ChatMessage) -> dict:
+    return {
+        "id": message.id,
+        "chat_id": message.chat_id,
+        "sender_id": message.sender_id,
+        "message": message.message,
+        "created_at": message.created_at,
+        "seq": message.seq,
+    }
 
 
 @router.get("/", response_model=list[ChatResponse])
-async def get_user_chats(username: str = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+async def get_user_chats(user: Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_db)):
     try:
         # Retrieve list of chats for the authenticated user
-        # check user exists
-        result = await db.execute(select(User).filter(User.username == username))
-        user = result.scalars().first()
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found")
         chat_result = await db.execute(select(ChatRoom).join(ChatParticipant).filter(ChatParticipant.user_id == user.id))
         chats = chat_result.scalars().all()
         if chats is None:
             raise HTTPException(status_code=404, detail="No chats found")
-        chat_responses = [
-            ChatResponse(
-                id=chat.id,
-                name=chat.name,
-                is_group=chat.is_group,
-                created_at=chat.created_at
-            ) for chat in chats
-        ]
-        return chat_responses
+        # rows are built here, skip re-validating them against the model
+        return FastJSONResponse([_chat_dict(chat) for chat in chats])
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from None
 
 
-@router.post("/create", response_model=ChatResponse)
-async def create_chat(chat: ChatCreate, username: str = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+@router.get("/inbox", response_model=InboxPage)
+async def get_inbox(
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    user: Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_db)
+):
     try:
-        # Create a new chat
-        new_chat = ChatRoom(name=chat.name, is_group=chat.is_group)
-        db.add(new_chat)
-        await db.commit()
-        await db.refresh(new_chat)
-
-        chat_data = ChatResponse(
-            id=new_chat.id,
-            name=new_chat.name,
-            is_group=new_chat.is_group,
-            created_at=new_chat.created_at
+        # Rooms of the authenticated user by last activity, each with its
+        # last message and unread count, in a single query
+        last_activity = func.coalesce(ChatRoom.last_message_at, ChatRoom.created_at)
+        query = (
+            select(ChatRoom, ChatParticipant.unread_count,
+                   ChatParticipant.last_read_message_id, ChatMessage, last_activity)
+            .join(ChatParticipant, and_(ChatParticipant.chat_id == ChatRoom.id,
+                                        ChatParticipant.user_id == user.id))
+            .outerjoin(ChatMessage, and_(ChatMessage.id == ChatRoom.last_message_id,
+                                         ChatMessage.created_at == ChatRoom.last_message_at))
         )
+        if cursor:
+            activity_at, chat_id = decode_cursor(cursor, 2)
+            query = query.filter(tuple_(last_activity, ChatRoom.id) <
+                                 tuple_(datetime.fromisoformat(activity_at), chat_id))
+        query = query.order_by(last_activity.desc(), ChatRoom.id.desc()).limit(limit + 1)
+        rows = (await db.execute(query)).all()
+
+        rooms = [
+            {
+                **_chat_dict(chat),
+                "member_count": chat.member_count,
+                "unread_count": unread_count,
+                "last_read_message_id": last_read_message_id,
+                "last_activity_at": activity_at,
+                "last_message": _message_dict(message) if message else None,
+            } for chat, unread_count, last_read_message_id, message, activity_at in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rooms[-1]
+            next_cursor = encode_cursor(last["last_activity_at"], last["id"])
+        return FastJSONResponse({"rooms": rooms, "next": next_cursor})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
 
-        # Get the authenticated user
-        result = await db.execute(select(User).filter(User.username == username))
-        user = result.scalars().first()
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-        print("user", user)
 
-        # Add the user as a chat participant
-        participant = ChatParticipant(chat_id=new_chat.id, user_id=user.id)
-        db.add(participant)
-        await db.commit()
-        await db.refresh(participant)
-        print("participant", participant)
+@router.get("/search", response_model=SearchPage)
+async def search_chat_messages(
+    q: str = Query(..., min_length=1, max_length=256),
+    chat_id: Optional[int] = None,
+    order: str = "relevance",
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    user: Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        # Full-text search over the chats the user participates in, ranked
+        # by relevance or most recent first
+        if chat_id is not None:
+            await _authorize_chat_reader(chat_id, user, db)
+            chat_ids = [chat_id]
+        else:
+            chat_ids = await membership.user_chats(db, user.id)
+        page = await search_messages(db, chat_ids, q, order=order, cursor=cursor, limit=limit)
+        return FastJSONResponse(page)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
+
+
+@router.get("/presence", response_model=PresencePage)
+async def get_chats_presence(
+    chat_id: List[int] = Query(default=[]),
+    user: Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        # Online and away members of the given chats, all of the user's
+        # chats when none are given. Presence is held in memory and members
+        # come from the membership cache
+        user_chats = await membership.user_chats(db, user.id)
+        if not chat_id:
+            chat_ids = sorted(user_chats)[:MAX_PAGE_SIZE]
+        elif len(chat_id) > MAX_PAGE_SIZE:
+            raise HTTPException(status_code=400, detail=f"At most {MAX_PAGE_SIZE} chats")
+        elif not user_chats.issuperset(chat_id):
+            raise HTTPException(status_code=403, detail="Not authorized for this chat")
+        else:
+            chat_ids = list(dict.fromkeys(chat_id))
+        members = await membership.chat_members_many(db, chat_ids)
+        chats = [
+            {
+                "chat_id": cid,
+                "users": [{"user_id": member, "status": status}
+                          for member, status in presence.bulk(members[cid]).items()],
+            } for cid in chat_ids
+        ]
+        return FastJSONResponse({"chats": chats})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
 
-        # Return a Pydantic model, not a database model
-        return chat_data
 
+@router.post("/create", response_model=ChatCreateResponse)
+async def create_chat(chat: ChatCreate, user: Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_db)):
+    try:
+        # Create the room with the creator and the initial members in one
+        # transaction, a constant number of statements whatever the size
+        if len(chat.member_ids) >= MAX_BULK_MEMBERS:
+            raise HTTPException(
+                status_code=400, detail=f"At most {MAX_BULK_MEMBERS - 1} initial members")
+        room = await create_room(db, chat.name, chat.is_group)
+        results = await add_members(db, room.id, [user.id, *chat.member_ids])
+        await db.commit()
+        await announce_members(room.id, results)
+
+        return FastJSONResponse({
+            "id": room.id,
+            "name": room.name,
+            "is_group": room.is_group,
+            "created_at": room.created_at,
+            "members": [{"user_id": user_id, "status": status} for user_id, status in results.items()],
+        })
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from None
 
 
 @router.post("/{chat_id}/add_participant")
-async def add_participant(chat_id: int, username: str = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+async def add_participant(chat_id: int, user: Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_db)):
     try:
-        # Add a participant to an existing chat
-        result = await db.execute(select(User).filter(User.username == username))
-        user = result.scalars().first()
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        # check if chat exists
-        chat_result = await db.execute(select(ChatRoom).filter(ChatRoom.id == chat_id))
-        chat = chat_result.scalars().first()
-        if chat is None:
+        # Add the calling user to an existing chat
+        chat_result = await db.execute(select(ChatRoom.id).filter(ChatRoom.id == chat_id))
+        if chat_result.first() is None:
             raise HTTPException(status_code=404, detail="Chat not found")
 
-        # check if user is already a participant
-        participant_result = await db.execute(select(ChatParticipant).filter(ChatParticipant.chat_id == chat_id, ChatParticipant.user_id == user.id))
-        existing_participant = participant_result.scalars().first()
-        if existing_participant:
+        added = await insert_participants(db, chat_id, [user.id])
+        if not added:
             raise HTTPException(
                 status_code=400, detail="User is already a participant in this chat")
-
-        # Add the user as a chat participant
-        participant = ChatParticipant(chat_id=chat_id, user_id=user.id)
-        db.add(participant)
+        participant = {column.key: getattr(added[0], column.key)
+                       for column in ChatParticipant.__table__.columns}
         await db.commit()
-        await db.refresh(participant)
+        await announce_members(chat_id, {user.id: ADDED})
         return participant
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from None
 
 
-@router.get("/{chat_id}/messages", response_model=list[MessageResponse])
-async def get_chat_messages(chat_id: int, username: str = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+@router.post("/{chat_id}/participants", response_model=ParticipantsResult)
+async def update_participants(chat_id: int, changes: ParticipantsUpdate, user: Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_db)):
     try:
-        # Retrieve messages for a given chat (only if the user is a participant)
-        chat_result = await db.execute(select(ChatRoom).filter(ChatRoom.id == chat_id))
-        chat = chat_result.scalars().first()
-        if chat is None:
+        # Add and remove many participants in one transaction, with the
+        # outcome for each user. Members may change anyone, other users
+        # only themselves
+        if len(changes.add) + len(changes.remove) > MAX_BULK_MEMBERS:
+            raise HTTPException(
+                status_code=400, detail=f"At most {MAX_BULK_MEMBERS} users per request")
+        if set(changes.add) & set(changes.remove):
+            raise HTTPException(
+                status_code=400, detail="A user cannot be both added and removed")
+        if (set(changes.add) | set(changes.remove)) - {user.id} and \
+                not await membership.is_member(db, chat_id, user.id):
+            raise HTTPException(
+                status_code=403, detail="Not authorized for this chat")
+
+        # locks the room, concurrent updates of its members queue up here
+        room = (await db.execute(
+            select(ChatRoom.member_count).filter(ChatRoom.id == chat_id).with_for_update())).first()
+        if room is None:
             raise HTTPException(status_code=404, detail="Chat not found")
 
-        user_result = await db.execute(select(User).filter(User.username == username))
-        user = user_result.scalars().first()
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found")
+        results = await remove_members(db, chat_id, changes.remove)
+        results.update(await add_members(db, chat_id, changes.add))
+        await db.commit()
+        await announce_members(chat_id, results)
+
+        statuses = list(results.values())
+        return FastJSONResponse({
+            "chat_id": chat_id,
+            "member_count": room.member_count + statuses.count(ADDED) - statuses.count(REMOVED),
+            "results": [{"user_id": user_id, "status": status} for user_id, status in results.items()],
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
+
 
-        is_participant = await db.execute(
-            select(ChatParticipant).filter(ChatParticipant.chat_id ==
-                                           chat_id, ChatParticipant.user_id == user.id))
-        if not is_participant:
+@router.post("/{chat_id}/read")
+async def mark_read(chat_id: int, receipt: ReadReceipt, user: Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_db)):
+    try:
+        # Move the caller's read receipt forward and recount their unread
+        # messages, receipts never move backwards
+        result = await db.execute(
+            select(ChatParticipant, ChatRoom.last_message_id)
+            .join(ChatRoom, ChatRoom.id == ChatParticipant.chat_id)
+            .filter(ChatParticipant.chat_id == chat_id, ChatParticipant.user_id == user.id))
+        row = result.first()
+        if row is None:
             raise HTTPException(
                 status_code=403, detail="Not authorized for this chat")
+        participant, last_message_id = row
+
+        # a receipt past the newest message would hide messages sent later
+        read_up_to = last_message_id
+        if receipt.message_id is not None and last_message_id is not None:
+            read_up_to = min(receipt.message_id, last_message_id)
+        if read_up_to is None or (participant.last_read_message_id or 0) >= read_up_to:
+            return {"chat_id": chat_id, "last_read_message_id": participant.last_read_message_id,
+                    "unread_count": participant.unread_count}
+
+        if read_up_to >= last_message_id:
+            unread_count = 0
+        else:
+            unread_result = await db.execute(
+                select(func.count()).select_from(ChatMessage).filter(
+                    ChatMessage.chat_id == chat_id,
+                    ChatMessage.id > read_up_to,
+                    ChatMessage.sender_id != user.id))
+            unread_count = unread_result.scalar()
+        # guarded so a concurrent receipt further ahead is kept
+        moved = await db.execute(
+            update(ChatParticipant)
+            .where(ChatParticipant.chat_id == chat_id, ChatParticipant.user_id == user.id,
+                   or_(ChatParticipant.last_read_message_id.is_(None),
+                       ChatParticipant.last_read_message_id < read_up_to))
+            .values(last_read_message_id=read_up_to, unread_count=unread_count)
+            .execution_options(synchronize_session=False))
+        await db.commit()
+        if not moved.rowcount:
+            await db.refresh(participant)
+            return {"chat_id": chat_id, "last_read_message_id": participant.last_read_message_id,
+                    "unread_count": participant.unread_count}
+        return {"chat_id": chat_id, "last_read_message_id": read_up_to, "unread_count": unread_count}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
 
-        messages_result = await db.execute(
-            select(ChatMessage).filter(ChatMessage.chat_id == chat_id)
-        )
-        messages = messages_result.scalars().all()
-        if messages is None:
-            raise HTTPException(status_code=404, detail="No messages found")
-
-        message_responses = [
-            MessageResponse(
-                chat_id=message.chat_id,
-                sender_id=message.sender_id,
-                message=message.message
-            ) for message in messages
-        ]
-        return message_responses
+
+async def _publish_saved(chat_id: int, sender_id: int, message_text: str, saved, origin: str = None):
+    # Publish once, every process delivers to its own sockets of the
+    # participants, the sender's other sockets included
+    await hub.publish_message(chat_id, sender_id, {
+        "id": saved.id,
+        "chat_id": chat_id,
+        "sender_id": sender_id,
+        "message": message_text,
+        "created_at": saved.created_at,
+        "seq": saved.seq,
+    }, origin=origin)
+
+
+@router.post("/{chat_id}/messages", response_model=MessageSent)
+async def send_message(chat_id: int, body: MessageSend, user: Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_db)):
+    try:
+        # The HTTP twin of a websocket message frame, for clients without a
+        # socket open. A resend with the same client_msg_id answers with
+        # the original message and delivers nothing again.
+        error = message_error(body.message)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        if not await membership.is_member(db, chat_id, user.id):
+            raise HTTPException(
+                status_code=403, detail="Not authorized for this chat")
+        saved = await persist_message(db, chat_id, user.id, body.message, body.client_msg_id)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
+
+    # Committed from here on, a failed publish must not read as a failed
+    # send, the members still find the message in the history
+    if not saved.duplicate:
+        presence.stop_typing(chat_id, user.id)
+        try:
+            await _publish_saved(chat_id, user.id, body.message, saved)
+        except Exception:
+            logger.exception("publishing a sent message failed",
+                             extra={"user_id": user.id, "chat_id": chat_id, "message_id": saved.id})
+    return FastJSONResponse({
+        "id": saved.id,
+        "chat_id": chat_id,
+        "sender_id": user.id,
+        "message": body.message,
+        "created_at": saved.created_at,
+        "seq": saved.seq,
+        "client_msg_id": body.client_msg_id,
+        "duplicate": saved.duplicate,
+    })
+
+
+@router.get("/{chat_id}/messages", response_model=MessagePage)
+async def get_chat_messages(
+    chat_id: int,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    after_seq: Optional[int] = None,
+    before_seq: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    include_archived: bool = False,
+    user: Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        # Retrieve one page of messages for a given chat (only if the user is
+        # a participant), keyset paginated on (created_at, id). Archived
+        # months are older than every live row, so with include_archived a
+        # backward page continues into the archive and a forward one starts
+        # there.
+        # after_seq/before_seq instead select by seq, e.g. to fill a gap a
+        # client noticed, an integer range scan of live rows
+        if before and after:
+            raise HTTPException(
+                status_code=400, detail="Use either before or after, not both")
+        by_seq = after_seq is not None or before_seq is not None
+        if by_seq and (before or after):
+            raise HTTPException(
+                status_code=400, detail="Use either cursors or seqs, not both")
+        await _authorize_chat_reader(chat_id, user, db)
+
+        key = tuple_(ChatMessage.created_at, ChatMessage.id)
+        query = select(ChatMessage).filter(ChatMessage.chat_id == chat_id)
+        cursor_key = None
+        forward = bool(after) or after_seq is not None
+        if by_seq:
+            if after_seq is not None:
+                query = query.filter(ChatMessage.seq > after_seq)
+            if before_seq is not None:
+                query = query.filter(ChatMessage.seq < before_seq)
+            query = query.order_by(ChatMessage.seq if forward else ChatMessage.seq.desc())
+            include_archived = False
+        elif after:
+            created_at, message_id = decode_cursor(after, 2)
+            cursor_key = (datetime.fromisoformat(created_at), message_id)
+            query = query.filter(key > tuple_(*cursor_key)).order_by(
+                ChatMessage.created_at, ChatMessage.id)
+        else:
+            if before:
+                created_at, message_id = decode_cursor(before, 2)
+                cursor_key = (datetime.fromisoformat(created_at), message_id)
+                query = query.filter(key < tuple_(*cursor_key))
+            query = query.order_by(
+                ChatMessage.created_at.desc(), ChatMessage.id.desc())
+
+        # fetch one extra row to learn whether the scan can go on
+        messages = []
+        if include_archived and after:
+            messages = await message_archive.read_messages(
+                db, chat_id, limit + 1, after=cursor_key)
+        if len(messages) <= limit:
+            messages_result = await db.execute(query.limit(limit + 1 - len(messages)))
+            messages += [_message_dict(message) for message in messages_result.scalars()]
+        if include_archived and not after and len(messages) <= limit:
+            messages += await message_archive.read_messages(
+                db, chat_id, limit + 1 - len(messages), before=cursor_key)
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        if not forward:
+            messages.reverse()
+
+        page = {"messages": messages, "before": None, "after": None}
+        if messages:
+            first, last = messages[0], messages[-1]
+            # older rows exist if the backward scan found more or the page
+            # was reached by going forward, and symmetrically for newer rows
+            if forward or has_more:
+                page["before"] = encode_cursor(first["created_at"], first["id"])
+            if before or before_seq is not None or (forward and has_more):
+                page["after"] = encode_cursor(last["created_at"], last["id"])
+        return FastJSONResponse(page)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e)) from None
 
 
+@router.get("/{chat_id}/messages/export")
+async def export_chat_messages(chat_id: int, user: Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_db)):
+    # Stream the whole history as NDJSON in constant memory, rows come from a
+    # server-side cursor on a session owned by the response itself
+    await _authorize_chat_reader(chat_id, user, db)
+
+    async def stream_messages():
+        async with SessionLocal() as session:
+            result = await session.stream_scalars(
+                select(ChatMessage)
+                .filter(ChatMessage.chat_id == chat_id)
+                .order_by(ChatMessage.created_at, ChatMessage.id)
+                .execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            async for message in result:
+                yield dumps(_message_dict(message)) + b"\n"
+
+    return StreamingResponse(stream_messages(), media_type="application/x-ndjson")
+
+
+async def _authorize_chat_reader(chat_id: int, user: Principal, db: AsyncSession):
+    chat_result = await db.execute(select(ChatRoom.id).filter(ChatRoom.id == chat_id))
+    if chat_result.first() is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+
+    if not await membership.is_member(db, chat_id, user.id):
+        raise HTTPException(
+            status_code=403, detail="Not authorized for this chat")
+
+
 async def get_current_user_from_token(token: str, db: AsyncSession):
     """Manually extracts the user from JWT token."""
     credentials_exception = WebSocketDisconnect(
         code=1008)  # Unauthorized WebSocket Disconnect
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError:
+    username = verify_access_token_cached(token)
+    if username is None:
         raise credentials_exception
 
-    result = await db.execute(select(User).where(User.username == username))
-    user = result.scalars().first()
+    user = await user_cache.by_username(db, username)
     if user is None:
         raise credentials_exception
     return user
 
-# Store active WebSocket connections
-active_connections = {}
+# Active WebSocket connections of this process, by user and by room
+active_connections = hub.registry
+
+
+async def _sync_connection(connection: Connection, chat_ids, since: Optional[int], cursors: Optional[str]):
+    """Reply to a reconnect's cursors with one sync frame, then let the live
+    frames held since connecting through, minus the messages it carried."""
+    reply, sent_ids = None, ()
+    try:
+        per_room = parse_cursors(cursors or "")
+    except ValueError:
+        connection.release(Frame(text="Error: Invalid cursors, expected chat_id:seq,..."))
+        return
+    try:
+        async with SessionLocal() as db:
+            delta = await catch_up(db, hub.recent, chat_ids, since, per_room)
+        sent_ids = {message["id"] for room in delta["rooms"] for message in room["messages"]}
+        reply = Frame(delta)
+    except Exception:
+        logger.exception("websocket sync failed", extra={"user_id": connection.user_id})
+        reply = Frame(text="Error: Sync failed, fetch the history instead")
+    finally:
+        connection.release(reply, sent_ids)
 
 
 @router.websocket("/ws/chat")
 async def websocket_endpoint(
     websocket: WebSocket,
     token: str,
-    db: AsyncSession = Depends(get_db)
+    since: Optional[int] = None,
+    cursors: Optional[str] = None,
+    protocol: Optional[str] = None,
+    compress: bool = False,
+    batch: bool = False
 ):
     # WebSocket for authenticated users to send/receive messages
-    # Authenticate user
-    await websocket.accept()
+    # The socket never holds a session, each unit of work borrows one so
+    # pooled connections scale with message rate, not connected users
+    # A reconnecting client passes the last seq it saw per room
+    # (cursors=chat_id:seq,...) and/or the last message id it saw anywhere
+    # (since), and first gets one sync frame with what it missed, then the
+    # live stream
+    # JSON text frames unless the client negotiates another wire protocol,
+    # by offering a subprotocol such as chat.msgpack.deflate.batch or with
+    # protocol=msgpack&compress=true&batch=true, see WireProtocol
+    try:
+        wire, subprotocol = negotiate(
+            websocket.scope.get("subprotocols"), protocol, compress, batch)
+    except ValueError as e:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=str(e))
+    await websocket.accept(subprotocol=subprotocol)
     # Authenticate user from token
-    user = await get_current_user_from_token(token, db)
-    print(f"User {user.username} connected to WebSocket")
+    async with SessionLocal() as db:
+        user = await get_current_user_from_token(token, db)
 
     if not user:
         await websocket.close()
-        print(f"User {user.username} not found in database")
+        logger.warning("websocket user not found")
         return
+    logger.info("websocket connected", extra={"user_id": user.id})
 
     user_id = user.id
-    active_connections[user_id] = websocket
+    connection = Connection(websocket, user_id, wire)
+    connection.start()
+    syncing = since is not None or cursors is not None
+    if syncing:
+        # live frames wait until the sync frame is queued
+        connection.hold()
+    # frames of this socket, refused ones are dropped
+    frame_limit = TokenBucket(WS_FRAME_RATE, WS_FRAME_BURST)
+    violations = 0
 
     try:
+        async with SessionLocal() as db:
+            chat_ids = await membership.user_chats(db, user_id)
+        await hub.connect(connection, chat_ids)
+        presence.connect(connection)
+        if syncing:
+            await _sync_connection(connection, chat_ids, since, cursors)
+
         while True:
-            data = await websocket.receive_text()
-            print(f"Received message: {data}")
-            message_data = json.loads(data)
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000))
+            frame_counters.received += 1
+            retry_after = frame_limit.take()
+            if retry_after:
+                frame_counters.refused += 1
+                violations += 1
+                if violations > WS_FLOOD_MAX_VIOLATIONS:
+                    logger.warning("websocket flooded, closing it", extra={"user_id": user_id})
+                    connection.close(code=1008)  # policy violation
+                    break
+                if violations == 1:
+                    # once per run of refused frames, not once per frame
+                    connection.enqueue(Frame(
+                        text=f"Error: Too many messages, retry in {retry_after:.2f}s"))
+                continue
+            violations = 0
+            data = received.get("text")
+            try:
+                message_data = wire.decode(received["bytes"] if data is None else data)
+            except FrameTooLarge:
+                logger.info("websocket frame too large", extra={"user_id": user_id})
+                connection.close(code=1009)  # message too big
+                break
+            except DECODE_ERRORS:
+                # a client mistake, the socket stays open
+                connection.enqueue(Frame(text="Error: Invalid frame."))
+                continue
+            frame_type = message_data.get("type", "message")
             chat_id = message_data.get("chat_id")
-            message_text = message_data.get("message")
 
-            # Verify user is in the chat
-            result = await db.execute(
-                select(ChatParticipant).where(
-                    ChatParticipant.chat_id == chat_id,
-                    ChatParticipant.user_id == user_id
-                )
-            )
-            chat_participant = result.scalars().first()
-            if not chat_participant:
-                print(
-                    f"User {user.username} is not a participant in chat {chat_id}")
-                await websocket.send_text("Error: You are not a participant in this chat.")
+            # Heartbeats keep the socket alive, typing is coalesced per room
+            # by the presence service, neither touches the database
+            if frame_type == "heartbeat":
+                presence.heartbeat(connection, message_data.get("status"))
+                continue
+            if frame_type == "typing":
+                if not hub.registry.in_room(user_id, chat_id):
+                    connection.enqueue(
+                        Frame(text="Error: You are not a participant in this chat."))
+                    continue
+                presence.typing(connection, chat_id, bool(message_data.get("typing", True)))
                 continue
 
-            # Save message to database
-            new_message = ChatMessage(
-                chat_id=chat_id, sender_id=user_id, message=message_text)
-            db.add(new_message)
-            await db.commit()
-            await db.refresh(new_message)
-
-            # Create response payload
-            response = MessageResponse(
-                id=new_message.id,
-                chat_id=chat_id,
-                sender_id=user_id,
-                message=message_text,
-                created_at=new_message.created_at
-            ).model_dump()
-            response["created_at"] = response["created_at"].isoformat()
-
-            # Broadcast message to all participants except the sender
-            result = await db.execute(
-                select(ChatParticipant.user_id).where(
-                    ChatParticipant.chat_id == chat_id,
-                    ChatParticipant.user_id != user_id  # Exclude the sender
-                )
-            )
-            chat_users = result.scalars().all()
+            logger.debug("websocket message", extra={"user_id": user_id, "chat_id": chat_id})
+            presence.touch(connection)
+            message_text = message_data.get("message")
+            error = message_error(message_text)
+            if error:
+                connection.enqueue(Frame(text=f"Error: {error}."))
+                continue
+            if type(chat_id) is not int:
+                # bool and float would pass the membership cache, True == 1
+                connection.enqueue(Frame(text="Error: Invalid chat_id."))
+                continue
+            client_msg_id = message_data.get("client_msg_id")
+            if not valid_client_msg_id(client_msg_id):
+                connection.enqueue(Frame(text="Error: Invalid client_msg_id."))
+                continue
+
+            async with SessionLocal() as db:
+                # Verify user is in the chat, served from the membership cache
+                if not await membership.is_member(db, chat_id, user_id):
+                    logger.info("websocket message to a chat the user is not in",
+                                extra={"user_id": user_id, "chat_id": chat_id})
+                    connection.enqueue(
+                        Frame(text="Error: You are not a participant in this chat."))
+                    continue
+
+                # Save message to database, batched with other connections
+                # when write-behind is enabled
+                saved = await persist_message(db, chat_id, user_id, message_text, client_msg_id)
+
+            # Ack the sender only once the message is committed, a resend
+            # gets the original's ack and was delivered the first time
+            ack = {"type": "ack", "id": saved.id, "seq": saved.seq, "created_at": saved.created_at}
+            if client_msg_id is not None:
+                ack["client_msg_id"] = client_msg_id
+            if saved.duplicate:
+                ack["duplicate"] = True
+                connection.enqueue(Frame(ack))
+                continue
+            connection.enqueue(Frame(ack))
+            presence.stop_typing(chat_id, user_id)
 
-            for chat_user_id in chat_users:
-                if chat_user_id in active_connections:
-                    await active_connections[chat_user_id].send_text(json.dumps(response))
+            try:
+                await _publish_saved(chat_id, user_id, message_text, saved, origin=connection.id)
+            except ValueError as e:
+                connection.enqueue(Frame(text=f"Error: {e}"))
 
     except WebSocketDisconnect:
-        print(f"User {user.username} disconnected")
-        if user_id in active_connections:
-            del active_connections[user_id]
+        logger.info("websocket disconnected", extra={"user_id": user_id})
+    except Exception:
+        # anything else ends this socket only, the client may reconnect
+        logger.exception("websocket failed", extra={"user_id": user_id})
+        connection.close(code=1011)
+    finally:
+        # every exit path unregisters the socket and stops its writer,
+        # even when one of the steps fails
+        try:
+            presence.disconnect(connection)
+            await hub.disconnect(connection)
+        finally:
+            await connection.aclose()
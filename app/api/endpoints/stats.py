@@ -0,0 +1,43 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.session import get_db, pool_stats
+from app.services.broadcast import frame_counters
+from app.services.chat_hub import hub
+from app.services.email_dispatcher import email_dispatcher
+from app.services.presence import presence
+from app.services.rate_limit import local_rate_limiter, rate_limiter
+
+router = APIRouter()
+
+
+@router.get("/db-pool")
+async def get_db_pool_stats():
+    # checked out / overflow connections and time spent waiting for one
+    return pool_stats()
+
+
+@router.get("/email")
+async def get_email_stats(db: AsyncSession = Depends(get_db)):
+    # dispatcher counters of this process and the outbox by status
+    return {**email_dispatcher.stats(), "outbox": await email_dispatcher.queue_stats(db)}
+
+
+@router.get("/presence")
+async def get_presence_stats():
+    # users and sockets tracked here, and how many room updates were sent
+    return presence.stats()
+
+
+@router.get("/connections")
+async def get_connection_stats():
+    # websockets, users and rooms with an online member on this process,
+    # and the frames they received and were sent
+    return {**hub.registry.stats(), **frame_counters.stats()}
+
+
+@router.get("/rate_limits")
+async def get_rate_limit_stats():
+    # hits allowed, and refused by limit name
+    if local_rate_limiter is rate_limiter:
+        return rate_limiter.stats()
+    return {**rate_limiter.stats(), "local": local_rate_limiter.stats()}
@@ -1,26 +1,81 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
 from app.db.session import get_db
+from app.core.pagination import encode_cursor, decode_cursor
+from app.core.serialization import FastJSONResponse
 from app.db.models.user import User
-from app.schemas.user import UserCreate, UserResponse
+from app.dependencies.auth import get_current_principal
+from app.schemas.user import UserCreate, UserResponse, UserPage, UserIds, UserSummaryList
+from app.services.user_cache import Principal, user_cache
+from sqlalchemy import func
 from sqlalchemy.future import select
 from sqlalchemy.orm import Session
-from typing import List
+from typing import Optional
 
 router = APIRouter()
 
+MAX_PAGE_SIZE = 200
+MAX_RESOLVE_IDS = 500
 
-@router.get("/users/", response_model=List[UserResponse])
-async def get_users(db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(User))
-    users = result.scalars().all()
-    return [UserResponse(id=user.id, username=user.username, email=user.email, created_at=user.created_at) for user in users]
+
+@router.get("/users/", response_model=UserPage)
+async def get_users(
+    prefix: Optional[str] = Query(None, min_length=1),
+    contains: Optional[str] = Query(None, min_length=3),
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    user: Principal = Depends(get_current_principal),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        # The user directory by username ignoring case, keyset paginated on
+        # lower(username), unique, along uq_users_username_lower. prefix
+        # matches the start of the name on the text_pattern_ops index,
+        # contains anywhere in it on the trigram index
+        name = func.lower(User.username)
+        query = select(User.id, User.username, name.label("key"))
+        if prefix:
+            query = query.filter(name.startswith(prefix.lower(), autoescape=True))
+        if contains:
+            query = query.filter(name.contains(contains.lower(), autoescape=True))
+        if cursor:
+            (after,) = decode_cursor(cursor, 1)
+            query = query.filter(name > after)
+        rows = (await db.execute(query.order_by(name).limit(limit + 1))).all()
+
+        users = [{"id": row.id, "username": row.username} for row in rows[:limit]]
+        next_cursor = encode_cursor(rows[limit - 1].key) if len(rows) > limit else None
+        return FastJSONResponse({"users": users, "next": next_cursor})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
+
+
+@router.post("/users/resolve", response_model=UserSummaryList)
+async def resolve_users(body: UserIds, user: Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_db)):
+    try:
+        # Usernames of a batch of ids, e.g. the senders of a page of
+        # messages, from the user cache and one query for the rest. Ids of
+        # users that do not exist are left out
+        if len(body.ids) > MAX_RESOLVE_IDS:
+            raise HTTPException(
+                status_code=400, detail=f"At most {MAX_RESOLVE_IDS} ids per request")
+        found = await user_cache.by_ids(db, set(body.ids))
+        return FastJSONResponse({"users": [
+            {"id": principal.id, "username": principal.username}
+            for principal in sorted(found.values(), key=lambda principal: principal.id)]})
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e)) from None
 
 
 @router.get("/users/{user_id}", response_model=UserResponse)
 async def get_user(user_id: int, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(User).filter(User.id == user_id))
-    user = result.scalars().first()
+    result = await db.execute(
+        select(User.id, User.username, User.email, User.created_at).filter(User.id == user_id))
+    user = result.first()
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return UserResponse(id=user.id, username=user.username, email=user.email, created_at=user.created_at)
@@ -0,0 +1,250 @@
+import os
+from dataclasses import dataclass
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.getenv(name, str(default)))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Runtime settings, read once from the environment (and .env)."""
+
+    database_url: str
+    # SQL statement and pool logging, both write synchronously to stdout
+    db_echo: bool
+    db_echo_pool: bool
+    # connections kept open, plus extra ones opened under load
+    db_pool_size: int
+    db_max_overflow: int
+    # seconds a request waits for a free connection before failing
+    db_pool_timeout: float
+    # seconds after which a connection is replaced, -1 to never recycle
+    db_pool_recycle: int
+    db_pool_pre_ping: bool
+    # asyncpg prepared statements cached per connection, 0 behind pgbouncer
+    db_statement_cache_size: int
+    # server side limits in ms, 0 disables them
+    db_statement_timeout_ms: int
+    db_lock_timeout_ms: int
+    db_idle_in_transaction_timeout_ms: int
+
+    # SQL statements slower than this are logged, 0 disables it
+    db_slow_query_ms: float
+    # one statement run this many times by one request is logged as a
+    # likely N+1, 0 disables it
+    db_repeated_query_threshold: int
+
+    # DEBUG, INFO, WARNING...; json or text lines, written by a background
+    # thread from a queue of this many records, further ones are dropped
+    log_level: str
+    log_format: str
+    log_queue_size: int
+
+    # /metrics is always served, this turns off request, query and loop lag
+    # instrumentation
+    metrics: bool
+    # seconds between event loop lag samples, and the lag logged as a warning
+    loop_lag_interval: float
+    loop_lag_warn_ms: float
+
+    pubsub_backend: str
+
+    ws_send_queue_size: int
+    ws_slow_consumer_policy: str
+    ws_send_timeout: float
+    # events per batch frame at most when a negotiated socket's queue backs
+    # up, and binary frames smaller than this many bytes go uncompressed
+    ws_batch_max: int
+    ws_compress_min_bytes: int
+
+    # seconds without any frame before a heartbeating socket is closed
+    presence_timeout: float
+    # seconds without activity before a user shows as away
+    presence_away_after: float
+    # seconds between full presence snapshots shared with other processes
+    presence_sync_interval: float
+    # presence/typing updates per second and room, at most
+    presence_room_rate: float
+    # seconds a typing indicator lasts unless the client repeats it
+    typing_timeout: float
+
+    # per socket frame limit, sustained rate and burst, and how many
+    # refused frames in a row close the socket
+    ws_frame_rate: float
+    ws_frame_burst: int
+    ws_flood_max_violations: int
+
+    rate_limiting: bool
+    # memory (per process) or postgres (shared by every worker)
+    rate_limit_backend: str
+    # name=limit overrides, e.g. "auth.login=20/minute,global=off"
+    rate_limits: str
+    # take the client IP from X-Forwarded-For, only behind a trusted proxy
+    rate_limit_trust_proxy: bool
+    rate_limit_shards: int
+    rate_limit_max_keys: int
+
+    # recent messages kept per subscribed room for reconnecting clients,
+    # and for how many rooms at most
+    sync_buffer_size: int
+    sync_buffer_rooms: int
+    # messages per room and in total in one reconnect sync frame
+    sync_max_per_room: int
+    sync_max_messages: int
+
+    # client_msg_ids remembered per sender in memory, for how many senders,
+    # and hours the database keeps them for dedup across restarts
+    client_msg_id_cache_size: int
+    client_msg_id_cache_users: int
+    client_msg_id_retention_hours: float
+
+    membership_cache_chats: int
+    membership_cache_users: int
+
+    # characters per chat message at most
+    max_message_length: int
+
+    message_batching: bool
+    message_batch_size: int
+    message_batch_delay_ms: float
+
+    bcrypt_rounds: int
+    password_hash_workers: int
+    password_hash_max_pending: int
+
+    token_cache_size: int
+    token_cache_ttl: float
+    user_cache_size: int
+    user_cache_ttl: float
+
+    # monthly chat_messages partitions created ahead of time
+    partition_months_ahead: int
+    # seconds between partition maintenance runs, 0 disables the task
+    partition_maintenance_interval: float
+    # partitions older than this many months move to ARCHIVE_DIR, 0 keeps all
+    archive_after_months: int
+    archive_dir: str
+
+    mail_username: str
+    mail_password: str
+    mail_from: str
+    mail_server: str
+    mail_port: int
+    mail_starttls: bool
+    mail_ssl_tls: bool
+    mail_use_credentials: bool
+    # outbound email queue: SMTP connections kept open and sent in parallel
+    email_pool_size: int
+    email_batch_size: int
+    # seconds between polls of the outbox when nothing wakes the dispatcher
+    email_poll_interval: float
+    email_send_timeout: float
+    # exponential retry from base to max seconds, then dead-lettered
+    email_max_attempts: int
+    email_retry_base: float
+    email_retry_max: float
+    email_dispatcher: bool
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        return cls(
+            database_url=os.getenv("DATABASE_URL", ""),
+            db_echo=_env_bool("DB_ECHO", False),
+            db_echo_pool=_env_bool("DB_ECHO_POOL", False),
+            db_pool_size=_env_int("DB_POOL_SIZE", 10),
+            db_max_overflow=_env_int("DB_MAX_OVERFLOW", 10),
+            db_pool_timeout=_env_float("DB_POOL_TIMEOUT", 10),
+            db_pool_recycle=_env_int("DB_POOL_RECYCLE", 1800),
+            db_pool_pre_ping=_env_bool("DB_POOL_PRE_PING", True),
+            db_statement_cache_size=_env_int("DB_STATEMENT_CACHE_SIZE", 100),
+            db_statement_timeout_ms=_env_int("DB_STATEMENT_TIMEOUT_MS", 30000),
+            db_lock_timeout_ms=_env_int("DB_LOCK_TIMEOUT_MS", 5000),
+            db_idle_in_transaction_timeout_ms=_env_int(
+                "DB_IDLE_IN_TRANSACTION_TIMEOUT_MS", 60000),
+            db_slow_query_ms=_env_float("DB_SLOW_QUERY_MS", 200),
+            db_repeated_query_threshold=_env_int("DB_REPEATED_QUERY_THRESHOLD", 10),
+            log_level=os.getenv("LOG_LEVEL", "INFO").upper(),
+            log_format=os.getenv("LOG_FORMAT", "json"),
+            log_queue_size=_env_int("LOG_QUEUE_SIZE", 10000),
+            metrics=_env_bool("METRICS", True),
+            loop_lag_interval=_env_float("LOOP_LAG_INTERVAL", 0.5),
+            loop_lag_warn_ms=_env_float("LOOP_LAG_WARN_MS", 100),
+            pubsub_backend=os.getenv("PUBSUB_BACKEND", "memory"),
+            ws_send_queue_size=_env_int("WS_SEND_QUEUE_SIZE", 256),
+            ws_slow_consumer_policy=os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest"),
+            ws_send_timeout=_env_float("WS_SEND_TIMEOUT", 10),
+            ws_batch_max=_env_int("WS_BATCH_MAX", 64),
+            ws_compress_min_bytes=_env_int("WS_COMPRESS_MIN_BYTES", 256),
+            presence_timeout=_env_float("PRESENCE_TIMEOUT", 60),
+            presence_away_after=_env_float("PRESENCE_AWAY_AFTER", 300),
+            presence_sync_interval=_env_float("PRESENCE_SYNC_INTERVAL", 30),
+            presence_room_rate=_env_float("PRESENCE_ROOM_RATE", 2),
+            typing_timeout=_env_float("TYPING_TIMEOUT", 6),
+            ws_frame_rate=_env_float("WS_FRAME_RATE", 20),
+            ws_frame_burst=_env_int("WS_FRAME_BURST", 40),
+            ws_flood_max_violations=_env_int("WS_FLOOD_MAX_VIOLATIONS", 50),
+            rate_limiting=_env_bool("RATE_LIMITING", True),
+            rate_limit_backend=os.getenv("RATE_LIMIT_BACKEND", "memory"),
+            rate_limits=os.getenv("RATE_LIMITS", ""),
+            rate_limit_trust_proxy=_env_bool("RATE_LIMIT_TRUST_PROXY", False),
+            rate_limit_shards=_env_int("RATE_LIMIT_SHARDS", 16),
+            rate_limit_max_keys=_env_int("RATE_LIMIT_MAX_KEYS", 100000),
+            sync_buffer_size=_env_int("SYNC_BUFFER_SIZE", 64),
+            sync_buffer_rooms=_env_int("SYNC_BUFFER_ROOMS", 10000),
+            sync_max_per_room=_env_int("SYNC_MAX_PER_ROOM", 100),
+            sync_max_messages=_env_int("SYNC_MAX_MESSAGES", 1000),
+            client_msg_id_cache_size=_env_int("CLIENT_MSG_ID_CACHE_SIZE", 64),
+            client_msg_id_cache_users=_env_int("CLIENT_MSG_ID_CACHE_USERS", 10000),
+            client_msg_id_retention_hours=_env_float("CLIENT_MSG_ID_RETENTION_HOURS", 48),
+            membership_cache_chats=_env_int("MEMBERSHIP_CACHE_CHATS", 10000),
+            membership_cache_users=_env_int("MEMBERSHIP_CACHE_USERS", 50000),
+            max_message_length=_env_int("MAX_MESSAGE_LENGTH", 4000),
+            message_batching=_env_bool("MESSAGE_BATCHING", False),
+            message_batch_size=_env_int("MESSAGE_BATCH_SIZE", 200),
+            message_batch_delay_ms=_env_float("MESSAGE_BATCH_DELAY_MS", 5),
+            bcrypt_rounds=_env_int("BCRYPT_ROUNDS", 12),
+            password_hash_workers=_env_int("PASSWORD_HASH_WORKERS", os.cpu_count() or 2),
+            password_hash_max_pending=_env_int("PASSWORD_HASH_MAX_PENDING", 64),
+            token_cache_size=_env_int("TOKEN_CACHE_SIZE", 10000),
+            token_cache_ttl=_env_float("TOKEN_CACHE_TTL", 300),
+            user_cache_size=_env_int("USER_CACHE_SIZE", 10000),
+            user_cache_ttl=_env_float("USER_CACHE_TTL", 300),
+            partition_months_ahead=_env_int("PARTITION_MONTHS_AHEAD", 3),
+            partition_maintenance_interval=_env_float("PARTITION_MAINTENANCE_INTERVAL", 3600),
+            archive_after_months=_env_int("ARCHIVE_AFTER_MONTHS", 0),
+            archive_dir=os.getenv("ARCHIVE_DIR", "./archive"),
+            mail_username=os.getenv("MAIL_USERNAME", ""),
+            mail_password=os.getenv("MAIL_PASSWORD", ""),
+            mail_from=os.getenv("MAIL_FROM", ""),
+            mail_server=os.getenv("MAIL_SERVER", "smtp.gmail.com"),
+            mail_port=_env_int("MAIL_PORT", 587),
+            mail_starttls=_env_bool("MAIL_STARTTLS", True),
+            mail_ssl_tls=_env_bool("MAIL_SSL_TLS", False),
+            mail_use_credentials=_env_bool("MAIL_USE_CREDENTIALS", True),
+            email_pool_size=_env_int("EMAIL_POOL_SIZE", 4),
+            email_batch_size=_env_int("EMAIL_BATCH_SIZE", 50),
+            email_poll_interval=_env_float("EMAIL_POLL_INTERVAL", 5),
+            email_send_timeout=_env_float("EMAIL_SEND_TIMEOUT", 30),
+            email_max_attempts=_env_int("EMAIL_MAX_ATTEMPTS", 8),
+            email_retry_base=_env_float("EMAIL_RETRY_BASE", 5),
+            email_retry_max=_env_float("EMAIL_RETRY_MAX", 3600),
+            email_dispatcher=_env_bool("EMAIL_DISPATCHER", True),
+        )
+
+
+settings = Settings.from_env()
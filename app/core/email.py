@@ -1,27 +1,31 @@
-import os
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
-from dotenv import load_dotenv
-
-load_dotenv()
-
-conf = ConnectionConfig(
-    MAIL_USERNAME=os.getenv("MAIL_USERNAME"),
-    MAIL_PASSWORD=os.getenv("MAIL_PASSWORD"),
-    MAIL_FROM=os.getenv("MAIL_FROM"),
-    MAIL_PORT=587,
-    MAIL_SERVER="smtp.gmail.com",
-    MAIL_STARTTLS=True,
-    MAIL_SSL_TLS=False,
-    USE_CREDENTIALS=True
-)
-
-
-async def send_otp_email(email: str, otp_code: str):
-    message = MessageSchema(
+from email.message import EmailMessage
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.db.models.email import OutboundEmail
+
+
+def build_message(recipient: str, subject: str, body: str, subtype: str = "plain") -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = settings.mail_from
+    message["To"] = recipient
+    message["Subject"] = subject
+    message.set_content(body, subtype=subtype)
+    return message
+
+
+def enqueue_email(db: AsyncSession, recipient: str, subject: str, body: str,
+                  subtype: str = "plain") -> OutboundEmail:
+    """Queue an email in the outbox, it is sent once the caller commits."""
+    email = OutboundEmail(recipient=recipient, subject=subject, body=body, subtype=subtype)
+    db.add(email)
+    return email
+
+
+def enqueue_otp_email(db: AsyncSession, email: str, otp_code: str) -> OutboundEmail:
+    return enqueue_email(
+        db, email,
         subject="Your Verification Code",
-        recipients=[email],
         body=f"Your OTP verification code is: {otp_code}",
-        subtype="plain"
     )
-    mail = FastMail(conf)
-    await mail.send_message(message)
@@ -0,0 +1,123 @@
+import logging
+import logging.handlers
+import queue
+
+import orjson
+
+from app.core.config import settings
+
+LOG_LEVEL = settings.log_level
+LOG_FORMAT = settings.log_format
+LOG_QUEUE_SIZE = settings.log_queue_size
+
+# attributes every LogRecord has, anything else came in through `extra`
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def _extras(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS}
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, msg, the `extra` fields
+    and exc when there is a traceback."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        entry.update(_extras(record))
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        # str() whatever orjson cannot encode rather than losing the line
+        return orjson.dumps(entry, default=str).decode()
+
+
+class KeyValueFormatter(logging.Formatter):
+    """Human readable lines, `extra` fields appended as key=value."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        extras = _extras(record)
+        if not extras:
+            return line
+        fields = " ".join(f"{key}={value}" for key, value in extras.items())
+        head, newline, traceback = line.partition("\n")
+        return f"{head} {fields}{newline}{traceback}"
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread without ever blocking the loop.
+
+    The message and traceback are rendered here, while the arguments are
+    still what they were, formatting and writing happen on the listener's
+    thread. When the queue is full the record is dropped and counted.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_listener = None
+_handler = None
+
+
+def setup_logging():
+    """Route the root and uvicorn loggers through a queue to one writer thread.
+
+    Safe to call more than once, the first call wins.
+    """
+    global _listener, _handler
+    if _listener is not None:
+        return
+    stream = logging.StreamHandler()
+    stream.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else KeyValueFormatter())
+    _handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    _listener = logging.handlers.QueueListener(_handler.queue, stream)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [_handler]
+    root.setLevel(LOG_LEVEL)
+    # uvicorn writes its own (access) logs synchronously to stdout
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logger = logging.getLogger(name)
+        if logger.handlers:
+            logger.handlers = [_handler]
+
+
+def shutdown_logging():
+    """Write out what is still queued and stop the writer thread."""
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener = None
+
+
+def log_stats() -> dict:
+    if _handler is None:
+        return {"queued": 0, "dropped": 0}
+    return {"queued": _handler.queue.qsize(), "dropped": _handler.dropped}
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import re
+import time
+from contextvars import ContextVar
+
+from prometheus_client import REGISTRY, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from sqlalchemy import event
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+METRICS = settings.metrics
+DB_SLOW_QUERY_MS = settings.db_slow_query_ms
+DB_REPEATED_QUERY_THRESHOLD = settings.db_repeated_query_threshold
+LOOP_LAG_INTERVAL = settings.loop_lag_interval
+LOOP_LAG_WARN_MS = settings.loop_lag_warn_ms
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template",
+    ["method", "route", "status"])
+DB_QUERY_SECONDS = Histogram(
+    "db_query_duration_seconds", "SQL statement execution time",
+    ["operation"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5))
+DB_QUERIES_PER_REQUEST = Histogram(
+    "db_queries_per_request", "SQL statements run by one HTTP request",
+    ["route"], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89))
+DB_REPEATED_QUERIES = Counter(
+    "db_repeated_query_requests", "Requests that ran one statement "
+    "DB_REPEATED_QUERY_THRESHOLD times or more, the shape of an N+1",
+    ["route"])
+EVENT_LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "How late a periodic timer fires, time the loop was blocked",
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5))
+
+_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+class QueryStats:
+    """Statements run on behalf of one request, filled by the engine hooks."""
+
+    __slots__ = ("count", "seconds", "statements")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        # statement text -> times run, the same text over and over is an N+1
+        self.statements = {}
+
+    def most_repeated(self):
+        """(statement, times) of the statement run most often."""
+        return max(self.statements.items(), key=lambda item: item[1], default=(None, 0))
+
+
+# the engine hooks run in SQLAlchemy's greenlet, which shares the context
+# of the awaiting task, so this is the current request's QueryStats
+current_queries: ContextVar = ContextVar("current_queries", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    operation = statement.lstrip()[:6].upper()
+    DB_QUERY_SECONDS.labels(operation if operation in _OPERATIONS else "OTHER").observe(elapsed)
+    stats = current_queries.get()
+    if stats is not None:
+        stats.count += 1
+        stats.seconds += elapsed
+        stats.statements[statement] = stats.statements.get(statement, 0) + 1
+    if DB_SLOW_QUERY_MS and elapsed * 1000 >= DB_SLOW_QUERY_MS:
+        logger.warning("slow query", extra={
+            "duration_ms": round(elapsed * 1000, 1), "statement": statement[:500]})
+
+
+def instrument_engine(engine):
+    """Time every statement of an (async) engine and count it per request."""
+    sync_engine = getattr(engine, "sync_engine", engine)
+    event.listen(sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def observe_request_queries(route: str, stats: QueryStats):
+    """Record a finished request's statements and warn about a likely N+1."""
+    DB_QUERIES_PER_REQUEST.labels(route).observe(stats.count)
+    if not DB_REPEATED_QUERY_THRESHOLD:
+        return
+    statement, times = stats.most_repeated()
+    if times >= DB_REPEATED_QUERY_THRESHOLD:
+        DB_REPEATED_QUERIES.labels(route).inc()
+        logger.warning("statement repeated within one request, likely N+1", extra={
+            "route": route, "queries": stats.count, "repeated": times,
+            "db_ms": round(stats.seconds * 1000, 1), "statement": statement[:500]})
+
+
+def _metric_name(*parts: str) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(parts))
+
+
+class StatsCollector:
+    """Exposes a service's stats() dict at scrape time.
+
+    Services keep their counters as plain attributes, bumped without the
+    lock a prometheus metric takes, this turns them into metrics named
+    `<prefix>_<key>`. Nested dicts are flattened, keys listed in `counters`
+    are counters and everything else numeric is a gauge.
+    """
+
+    def __init__(self, prefix: str, stats, counters=()):
+        self.prefix = prefix
+        self.stats = stats
+        self.counters = set(counters)
+
+    def collect(self):
+        yield from self._families(self.prefix, self.stats(), counter=False)
+
+    def _families(self, name: str, values: dict, counter: bool):
+        for key, value in values.items():
+            is_counter = counter or key in self.counters
+            if isinstance(value, dict):
+                yield from self._families(_metric_name(name, str(key)), value, is_counter)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                family = CounterMetricFamily if is_counter else GaugeMetricFamily
+                yield family(_metric_name(name, str(key)), f"{name} {key}", value=value)
+
+
+def register_stats(prefix: str, stats, counters=()):
+    REGISTRY.register(StatsCollector(prefix, stats, counters))
+
+
+class LoopLagMonitor:
+    """Sleeps LOOP_LAG_INTERVAL at a time and records how late it wakes up,
+    warning when the loop was blocked for LOOP_LAG_WARN_MS or more."""
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.max_lag = 0.0
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - started - self.interval)
+            EVENT_LOOP_LAG.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if LOOP_LAG_WARN_MS and lag * 1000 >= LOOP_LAG_WARN_MS:
+                logger.warning("event loop blocked", extra={"lag_ms": round(lag * 1000, 1)})
+
+
+loop_lag_monitor = LoopLagMonitor()
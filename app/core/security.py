@@ -1,7 +1,26 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from passlib.context import CryptContext
+from app.core.config import settings
+
+# bcrypt work factor, hashes with another cost are upgraded on next login
+BCRYPT_ROUNDS = settings.bcrypt_rounds
+# bcrypt releases the GIL, so a small thread pool hashes in parallel
+PASSWORD_HASH_WORKERS = settings.password_hash_workers
+# calls allowed to wait for a worker before new ones are refused
+PASSWORD_HASH_MAX_PENDING = settings.password_hash_max_pending
 
 # Create a password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+_hash_executor = ThreadPoolExecutor(
+    max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
+_pending = 0
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing pool is saturated, callers should answer 503."""
 
 
 def hash_password(password: str) -> str:
@@ -12,3 +31,37 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hashed version."""
     return pwd_context.verify(plain_password, hashed_password)
+
+
+async def _run_in_pool(func, *args):
+    global _pending
+    if _pending >= PASSWORD_HASH_MAX_PENDING:
+        raise PasswordHasherBusy("Password hashing is saturated, retry later")
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_hash_executor, func, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password_async(password: str) -> str:
+    """Hash a password on the hashing pool instead of the event loop."""
+    return await _run_in_pool(hash_password, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password on the hashing pool instead of the event loop."""
+    return await _run_in_pool(verify_password, plain_password, hashed_password)
+
+
+async def verify_and_update_password(plain_password: str, hashed_password: str):
+    """Verify a password and return (valid, new_hash).
+
+    new_hash is set when the stored hash uses outdated settings, e.g. fewer
+    rounds than BCRYPT_ROUNDS, and should replace the stored one.
+    """
+    return await _run_in_pool(pwd_context.verify_and_update, plain_password, hashed_password)
+
+
+def password_hasher_pending() -> int:
+    return _pending
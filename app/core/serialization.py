@@ -0,0 +1,55 @@
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+
+def _default(obj):
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+
+def dumps(obj) -> bytes:
+    """orjson encoding, datetimes come out in ISO 8601 like isoformat()."""
+    return orjson.dumps(obj, default=_default)
+
+
+def loads(data):
+    return orjson.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered with orjson.
+
+    Endpoints returning one directly skip response_model validation, which is
+    what list endpoints do with rows they built themselves.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+class Frame:
+    """An outbound websocket event, encoded once and shared by all recipients."""
+
+    __slots__ = ("payload", "_text", "_encoded")
+
+    def __init__(self, payload=None, text: str = None):
+        self.payload = payload
+        self._text = text
+        self._encoded = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = dumps(self.payload).decode()
+        return self._text
+
+    def encoded(self, key, encode):
+        """encode(self) for another wire format, cached under `key`."""
+        if self._encoded is None:
+            self._encoded = {}
+        data = self._encoded.get(key)
+        if data is None:
+            data = self._encoded[key] = encode(self)
+        return data
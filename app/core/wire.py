@@ -0,0 +1,213 @@
+import zlib
+from datetime import datetime, timezone
+
+import msgpack
+from pydantic import BaseModel
+
+from app.core.config import settings
+from app.core.serialization import Frame, loads
+
+WS_BATCH_MAX = settings.ws_batch_max
+WS_COMPRESS_MIN_BYTES = settings.ws_compress_min_bytes
+WS_COMPRESS_LEVEL = 6
+# an inbound frame may not inflate past this
+MAX_INFLATED_FRAME = 1 << 20
+
+JSON = "json"
+MSGPACK = "msgpack"
+ENCODINGS = (JSON, MSGPACK)
+SUBPROTOCOL_PREFIX = "chat."
+
+# field names of the msgpack encoding, both ways, names missing here go as is
+TAGS = {
+    "type": "y",
+    "id": "i",
+    "chat_id": "c",
+    "sender_id": "s",
+    "user_id": "u",
+    "message": "m",
+    "created_at": "t",
+    "seq": "q",
+    "client_msg_id": "k",
+    "duplicate": "d",
+    "status": "st",
+    "presence": "p",
+    "typing": "ty",
+    "rooms": "r",
+    "messages": "ms",
+    "truncated": "tr",
+    "before": "b",
+    "events": "e",
+}
+NAMES = {tag: name for name, tag in TAGS.items()}
+
+
+
+class FrameTooLarge(ValueError):
+    """An inbound frame inflates past MAX_INFLATED_FRAME."""
+
+
+# what decode raises for a malformed inbound frame
+DECODE_ERRORS = (ValueError, msgpack.UnpackException)
+
+# first byte of a binary frame once deflate is negotiated
+_PLAIN = b"\x00"
+_DEFLATED = b"\x01"
+
+
+def _tagged(value):
+    if isinstance(value, dict):
+        return {TAGS.get(key, key): _tagged(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_tagged(item) for item in value]
+    if isinstance(value, datetime) and value.tzinfo is None:
+        # stored as UTC, a msgpack timestamp needs the zone spelled out
+        return value.replace(tzinfo=timezone.utc)
+    if isinstance(value, BaseModel):
+        return _tagged(value.model_dump())
+    return value
+
+
+def _encode_msgpack(frame: Frame) -> bytes:
+    return msgpack.packb(_tagged(frame.payload), datetime=True)
+
+
+def _encode_json(frame: Frame) -> bytes:
+    return frame.text.encode()
+
+
+def _deflate(data: bytes) -> bytes:
+    if len(data) < WS_COMPRESS_MIN_BYTES:
+        return _PLAIN + data
+    return _DEFLATED + zlib.compress(data, WS_COMPRESS_LEVEL, wbits=-15)
+
+
+def _inflate(data: bytes) -> bytes:
+    flag, body = data[:1], data[1:]
+    if flag == _PLAIN:
+        return body
+    if flag != _DEFLATED:
+        raise ValueError("Unknown frame header")
+    inflater = zlib.decompressobj(wbits=-15)
+    inflated = inflater.decompress(body, MAX_INFLATED_FRAME)
+    if inflater.unconsumed_tail:
+        raise FrameTooLarge("Frame too large")
+    return inflated
+
+
+def _expect_map(message):
+    if not isinstance(message, dict):
+        raise ValueError("Expected a map")
+    return message
+
+
+class WireProtocol:
+    """How one websocket encodes its frames, negotiated when it connects.
+
+    json, the default, sends JSON text frames as before. msgpack sends
+    binary MessagePack frames whose field names are shortened to TAGS and
+    whose datetimes are msgpack timestamps. Either can add:
+
+    - deflate: frames become binary, a 0 byte then the frame as is, or for
+      frames of WS_COMPRESS_MIN_BYTES and up a 1 byte then the raw deflate
+      stream. Each event is compressed once for all its recipients, unlike
+      the server's permessage-deflate, which compresses it again on every
+      socket and keeps a compressor per socket.
+    - batch: when events wait in the socket's send queue, up to
+      WS_BATCH_MAX of them go out as one {"type": "batch", "events": [...]}
+      frame.
+
+    Error strings stay text frames whatever was negotiated. Inbound frames
+    use the same format, a text frame is always read as JSON.
+    """
+
+    __slots__ = ("encoding", "compress", "batch", "_key")
+
+    def __init__(self, encoding: str = JSON, compress: bool = False, batch: bool = False):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown websocket protocol {encoding}")
+        self.encoding = encoding
+        self.compress = compress
+        self.batch = batch
+        # cache key of a frame's encoding, batching does not change it
+        self._key = (encoding, compress)
+
+    @property
+    def name(self) -> str:
+        """The subprotocol naming this protocol, e.g. chat.msgpack.deflate."""
+        parts = [SUBPROTOCOL_PREFIX + self.encoding]
+        if self.compress:
+            parts.append("deflate")
+        if self.batch:
+            parts.append("batch")
+        return ".".join(parts)
+
+    @classmethod
+    def from_subprotocol(cls, name: str):
+        """The protocol a subprotocol names, or None for one of another kind."""
+        if not name.startswith(SUBPROTOCOL_PREFIX):
+            return None
+        encoding, *options = name[len(SUBPROTOCOL_PREFIX):].split(".")
+        if encoding not in ENCODINGS or not set(options) <= {"deflate", "batch"}:
+            return None
+        return cls(encoding, "deflate" in options, "batch" in options)
+
+    def encode(self, frame: Frame):
+        """The frame as this socket sends it, str for a text frame."""
+        if frame.payload is None or (self.encoding == JSON and not self.compress):
+            return frame.text
+        return frame.encoded(self._key, self._encode)
+
+    def _encode(self, frame: Frame) -> bytes:
+        data = _encode_msgpack(frame) if self.encoding == MSGPACK else _encode_json(frame)
+        return _deflate(data) if self.compress else data
+
+    def encode_batch(self, frames: list):
+        """Several frames as one batch frame, spliced from their encodings
+        so nothing is serialized twice. All must have a payload."""
+        if self.encoding == MSGPACK:
+            parts = [frame.encoded((MSGPACK, False), _encode_msgpack) for frame in frames]
+            packer = msgpack.Packer()
+            data = b"".join((packer.pack_map_header(2), packer.pack(TAGS["type"]),
+                             packer.pack("batch"), packer.pack(TAGS["events"]),
+                             packer.pack_array_header(len(parts)), *parts))
+        else:
+            text = '{"type":"batch","events":[' + ",".join(frame.text for frame in frames) + "]}"
+            if not self.compress:
+                return text
+            data = text.encode()
+        return _deflate(data) if self.compress else data
+
+    def decode(self, data) -> dict:
+        """An inbound frame, text or bytes, with full field names.
+
+        Raises one of DECODE_ERRORS for a frame that is not a map.
+        """
+        if isinstance(data, str):
+            return _expect_map(loads(data))
+        if self.compress:
+            data = _inflate(data)
+        if self.encoding == JSON:
+            return _expect_map(loads(data))
+        message = _expect_map(msgpack.unpackb(data, raw=False))
+        return {NAMES.get(key, key): value for key, value in message.items()}
+
+
+DEFAULT_PROTOCOL = WireProtocol()
+
+
+def negotiate(subprotocols, encoding: str = None, compress: bool = False,
+              batch: bool = False):
+    """(protocol, subprotocol to accept with or None) for a new socket.
+
+    The first subprotocol the client offers that names a protocol wins,
+    else the query parameters decide. Raises ValueError for an unknown
+    encoding.
+    """
+    for name in subprotocols or ():
+        protocol = WireProtocol.from_subprotocol(name)
+        if protocol is not None:
+            return protocol, name
+    if encoding is None and not compress and not batch:
+        return DEFAULT_PROTOCOL, None
+    return WireProtocol(encoding or JSON, compress, batch), None
@@ -1,7 +1,14 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, DateTime, func
+from sqlalchemy import DDL, Column, Integer, String, ForeignKey, Boolean, Date, DateTime, FetchedValue, Index, PrimaryKeyConstraint, event, func
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
+from app.core.config import settings
 from app.db.models.base import Base
 from app.db.models.user import User
+from app.db.partitions import initial_partitions_sql
+
+# text search configuration of chat_messages.search_vector, 'simple' does no
+# stemming or stop words so it works the same for every language
+SEARCH_CONFIG = "simple"
 
 
 class ChatRoom(Base):
@@ -11,6 +18,14 @@ class ChatRoom(Base):
     name = Column(String, nullable=True)  # null for private chats
     is_group = Column(Boolean, default=False)
     created_at = Column(DateTime, default=func.now())
+    # denormalized room summary, maintained when messages are inserted
+    # (no foreign key, chat_messages may be partitioned)
+    last_message_id = Column(Integer, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    member_count = Column(Integer, nullable=False, default=0, server_default="0")
+    # seq of the room's latest message, incremented under the row lock by
+    # every insert so a room's messages commit in seq order without gaps
+    last_seq = Column(Integer, nullable=False, default=0, server_default="0")
 
     chat_participant = relationship(
         "ChatParticipant", back_populates="chat_room")
@@ -24,19 +39,108 @@ class ChatParticipant(Base):
     chat_id = Column(Integer, ForeignKey("chat_rooms.id"))
     user_id = Column(Integer, ForeignKey("users.id"))
     joined_at = Column(DateTime, default=func.now())
+    # read receipt and the number of newer messages from other senders
+    last_read_message_id = Column(Integer, nullable=True)
+    unread_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     chat_room = relationship("ChatRoom", back_populates="chat_participant")
     user = relationship("User", back_populates="chat_participant")
 
+    __table_args__ = (
+        # the inbox starts from the rooms of one user
+        Index("ix_chat_participants_user_id_chat_id", "user_id", "chat_id"),
+        # one membership per user and room, bulk adds rely on it to skip
+        # existing members with ON CONFLICT DO NOTHING
+        Index("uq_chat_participants_chat_id_user_id", "chat_id", "user_id", unique=True),
+    )
+
 
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
 
-    id = Column(Integer, primary_key=True, index=True, unique=True)
+    # range partitioned by month on created_at (see app.db.partitions), so
+    # created_at is part of the primary key and id comes from a sequence
+    id = Column(Integer, primary_key=True, server_default=FetchedValue())
     chat_id = Column(Integer, ForeignKey("chat_rooms.id"))
     sender_id = Column(Integer, ForeignKey("users.id"))
     message = Column(String, nullable=False)
-    created_at = Column(DateTime, default=func.now())
+    created_at = Column(DateTime, primary_key=True,
+                        default=func.now(), server_default=func.now())
+    # position in the room, 1, 2, 3... (null for rows that predate it and
+    # were moved in from the legacy table afterwards)
+    seq = Column(Integer, nullable=True)
 
     chat_room = relationship("ChatRoom", back_populates="chat_message")
     user = relationship("User", back_populates="chat_message")
+
+    __table_args__ = (
+        # keyset pagination of a chat's history
+        Index("ix_chat_messages_chat_id_created_at_id",
+              "chat_id", "created_at", "id"),
+        # seq range scans of a room; a unique index of a partitioned table
+        # must hold the partition key, so it only rejects a repeated seq
+        # within one month, the room counter is what keeps seq unique
+        Index("uq_chat_messages_chat_id_seq", "chat_id", "seq", "created_at", unique=True),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+
+class MessageClientId(Base):
+    """A client's idempotency key for a message it sent, kept for a while so
+    a resend gets the original back instead of creating a copy.
+
+    Apart from chat_messages so it can be unique on (sender_id,
+    client_msg_id) alone, a partitioned table's unique index would have to
+    hold created_at.
+    """
+    __tablename__ = "chat_message_client_ids"
+
+    sender_id = Column(Integer, primary_key=True)
+    client_msg_id = Column(String(64), primary_key=True)
+    chat_id = Column(Integer, nullable=False)
+    # set in the transaction that claims the key, along with the message
+    message_id = Column(Integer, nullable=True)
+    message_created_at = Column(DateTime, nullable=True)
+    seq = Column(Integer, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=func.now(),
+                        server_default=func.now(), index=True)
+
+
+class ArchivedPartition(Base):
+    """A month of chat_messages moved to compressed files on disk."""
+    __tablename__ = "chat_message_archives"
+
+    id = Column(Integer, primary_key=True)
+    month = Column(Date, nullable=False, unique=True)
+    path = Column(String, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    archived_at = Column(DateTime, default=func.now())
+
+
+# Full-text search (Postgres only): a generated tsvector column and its GIN
+# index, the same as the add_chat_messages_search_vector migration. The
+# column is left unmapped so loading messages never fetches it.
+for statement in (
+    "ALTER TABLE chat_messages ADD COLUMN search_vector tsvector "
+    f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', message)) STORED",
+    "CREATE INDEX ix_chat_messages_search_vector ON chat_messages USING gin (search_vector)",
+):
+    event.listen(ChatMessage.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+# a fresh partitioned table needs an id sequence and somewhere to put rows
+for statement in [
+    "CREATE SEQUENCE IF NOT EXISTS chat_messages_id_seq OWNED BY chat_messages.id",
+    "ALTER TABLE chat_messages ALTER COLUMN id SET DEFAULT nextval('chat_messages_id_seq')",
+] + initial_partitions_sql(settings.partition_months_ahead):
+    event.listen(ChatMessage.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="postgresql"))
+
+
+@compiles(PrimaryKeyConstraint, "sqlite")
+def _sqlite_primary_key(constraint, compiler, **kw):
+    # sqlite only autoincrements a lone INTEGER PRIMARY KEY, local runs
+    # without partitions keep chat_messages keyed on id alone
+    if constraint.table.name == ChatMessage.__tablename__:
+        return "PRIMARY KEY (id)"
+    return compiler.visit_primary_key_constraint(constraint, **kw)
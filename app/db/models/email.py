@@ -0,0 +1,27 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, Index, func
+from app.db.models.base import Base
+
+
+class OutboundEmail(Base):
+    """A queued email, sent by the dispatcher in app.services.email_dispatcher."""
+    __tablename__ = "email_outbox"
+
+    id = Column(Integer, primary_key=True)
+    recipient = Column(String, nullable=False)
+    subject = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+    subtype = Column(String, nullable=False, default="plain", server_default="plain")
+    # pending until sent, dead once every attempt failed
+    status = Column(String, nullable=False, default="pending", server_default="pending")
+    attempts = Column(Integer, nullable=False, default=0, server_default="0")
+    # also the lease of a claimed row, a crashed sender's rows come back
+    # once it expires
+    next_attempt_at = Column(DateTime, nullable=False, default=func.now(), server_default=func.now())
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=func.now())
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # the dispatcher claims due pending rows in order
+        Index("ix_email_outbox_status_next_attempt_at", "status", "next_attempt_at"),
+    )
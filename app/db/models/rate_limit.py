@@ -0,0 +1,16 @@
+from sqlalchemy import DDL, Column, Float, String, event
+from app.db.models.base import Base
+
+
+class RateLimitBucket(Base):
+    """One rate limit key of app.services.rate_limit.PostgresRateLimiter."""
+    __tablename__ = "rate_limit_buckets"
+
+    key = Column(String, primary_key=True)
+    # epoch seconds at which the bucket is full again
+    tat = Column(Float, nullable=False)
+
+
+# buckets are cheap to lose, skip the WAL
+event.listen(RateLimitBucket.__table__, "after_create",
+             DDL("ALTER TABLE rate_limit_buckets SET UNLOGGED").execute_if(dialect="postgresql"))
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, func, ForeignKey, Boolean
+from sqlalchemy import DDL, Column, Integer, String, DateTime, func, ForeignKey, Boolean, Index, event
 from sqlalchemy.orm import relationship
 from app.db.models.base import Base
 
@@ -18,6 +18,28 @@ class User(Base):
     chat_participant = relationship("ChatParticipant", back_populates="user")
     chat_message = relationship("ChatMessage", back_populates="user")
 
+    __table_args__ = (
+        # usernames are unique ignoring case, and the directory lists them
+        # in this order
+        Index("uq_users_username_lower", func.lower(username), unique=True),
+        # prefix search, LIKE 'ab%' can only use an index outside the C
+        # locale with the pattern operator class
+        Index("ix_users_username_lower_pattern", func.lower(username).label("username_lower"),
+              postgresql_ops={"username_lower": "text_pattern_ops"}),
+    )
+
+
+# Substring search (Postgres only): a trigram index, the same as the
+# add_users_username_indexes migration, skipped where pg_trgm is not installed
+event.listen(User.__table__, "after_create", DDL("""
+    DO $$ BEGIN
+        IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE INDEX ix_users_username_lower_trgm ON users USING gin (lower(username) gin_trgm_ops);
+        END IF;
+    END $$
+""").execute_if(dialect="postgresql"))
+
 
 class OTP(Base):
     __tablename__ = "otps"
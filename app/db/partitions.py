@@ -0,0 +1,134 @@
+"""Monthly range partitions of chat_messages on created_at.
+
+Each month lives in chat_messages_pYYYYMM, rows outside every month land in
+chat_messages_default. Helpers here only emit SQL, they are shared by the
+model's create_all hook, the migrations and the maintenance task.
+"""
+import re
+from datetime import date, datetime, timezone
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+PARENT = "chat_messages"
+DEFAULT_PARTITION = "chat_messages_default"
+LEGACY_TABLE = "chat_messages_legacy"
+COLUMNS = "id, chat_id, sender_id, message, created_at, seq"
+# the legacy table predates seq
+LEGACY_COLUMNS = "id, chat_id, sender_id, message, created_at"
+
+_PARTITION_NAME = re.compile(r"^chat_messages_p(\d{4})(\d{2})$")
+
+
+def month_start(value=None) -> date:
+    value = value or datetime.now(timezone.utc)
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"chat_messages_p{month:%Y%m}"
+
+
+def parse_partition_name(name: str):
+    match = _PARTITION_NAME.match(name)
+    return date(int(match[1]), int(match[2]), 1) if match else None
+
+
+def create_partition_sql(month: date) -> str:
+    return (f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF {PARENT} "
+            f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')")
+
+
+def create_default_partition_sql() -> str:
+    return f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF {PARENT} DEFAULT"
+
+
+def initial_partitions_sql(months_ahead: int, today=None) -> list[str]:
+    """DDL for a fresh table: the default partition and the coming months."""
+    first = month_start(today)
+    return [create_default_partition_sql()] + [
+        create_partition_sql(add_months(first, n)) for n in range(months_ahead + 1)]
+
+
+async def list_partitions(conn: AsyncConnection) -> list[date]:
+    """Months that currently have an attached partition, oldest first."""
+    result = await conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :parent"), {"parent": PARENT})
+    return sorted(month for month in map(parse_partition_name, result.scalars()) if month)
+
+
+async def create_partition(conn: AsyncConnection, month: date) -> bool:
+    """Create the partition of `month` unless it exists.
+
+    Rows of that month already caught by the default partition are moved
+    into the new one in the same transaction, as Postgres refuses to create
+    a partition whose rows still sit in the default one.
+    """
+    name = partition_name(month)
+    exists = await conn.execute(text("SELECT to_regclass(:name)"), {"name": name})
+    if exists.scalar() is not None:
+        return False
+    bounds = {"start": month, "end": add_months(month, 1)}
+    stray = await conn.execute(text(
+        f"SELECT count(*) FROM {DEFAULT_PARTITION} "
+        "WHERE created_at >= :start AND created_at < :end"), bounds)
+    if stray.scalar():
+        await conn.execute(text(
+            f"CREATE TEMPORARY TABLE stray_messages ON COMMIT DROP AS "
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+            f"WHERE created_at >= :start AND created_at < :end RETURNING {COLUMNS}) "
+            f"SELECT * FROM moved"), bounds)
+        await conn.execute(text(create_partition_sql(month)))
+        await conn.execute(text(
+            f"INSERT INTO {PARENT} ({COLUMNS}) SELECT {COLUMNS} FROM stray_messages"))
+        await conn.execute(text("DROP TABLE stray_messages"))
+    else:
+        await conn.execute(text(create_partition_sql(month)))
+    return True
+
+
+async def ensure_partitions(conn: AsyncConnection, months_ahead: int, today=None) -> list[date]:
+    """Create the partitions of this month and the next `months_ahead` months."""
+    first = month_start(today)
+    created = []
+    for n in range(months_ahead + 1):
+        month = add_months(first, n)
+        if await create_partition(conn, month):
+            created.append(month)
+    return created
+
+
+async def legacy_table_exists(conn: AsyncConnection) -> bool:
+    result = await conn.execute(text("SELECT to_regclass(:name)"), {"name": LEGACY_TABLE})
+    return result.scalar() is not None
+
+
+async def legacy_months(conn: AsyncConnection) -> list[date]:
+    result = await conn.execute(text(
+        f"SELECT DISTINCT date_trunc('month', created_at)::date FROM {LEGACY_TABLE} "
+        "WHERE created_at IS NOT NULL ORDER BY 1"))
+    return list(result.scalars())
+
+
+async def move_legacy_rows(conn: AsyncConnection, batch_size: int) -> int:
+    """Move the oldest `batch_size` rows by id from the legacy table.
+
+    Delete and insert happen in one statement, so the copy can be stopped
+    and resumed at any point without losing or duplicating rows.
+    """
+    result = await conn.execute(text(
+        f"WITH moved AS ("
+        f"  DELETE FROM {LEGACY_TABLE} WHERE id IN ("
+        f"    SELECT id FROM {LEGACY_TABLE} ORDER BY id LIMIT :batch_size)"
+        f"  RETURNING id, chat_id, sender_id, message, coalesce(created_at, now()) AS created_at) "
+        f"INSERT INTO {PARENT} ({LEGACY_COLUMNS}) SELECT {LEGACY_COLUMNS} FROM moved"),
+        {"batch_size": batch_size})
+    return result.rowcount
@@ -1,13 +1,72 @@
+import time
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
-import os
-from dotenv import load_dotenv
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from app.core.config import settings
+
+DATABASE_URL = settings.database_url
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long callers wait for a connection."""
+
+    waits = 0
+    wait_seconds_total = 0.0
+    wait_seconds_max = 0.0
+    timeouts = 0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            TimedQueuePool.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            TimedQueuePool.waits += 1
+            TimedQueuePool.wait_seconds_total += waited
+            TimedQueuePool.wait_seconds_max = max(TimedQueuePool.wait_seconds_max, waited)
+
+
+def _engine_options() -> dict:
+    options = {
+        "echo": settings.db_echo,
+        "echo_pool": settings.db_echo_pool,
+        "pool_pre_ping": settings.db_pool_pre_ping,
+    }
+    if DATABASE_URL.startswith("sqlite"):
+        # local quick runs, keep SQLAlchemy's default sqlite pooling
+        return options
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+    )
+    if DATABASE_URL.startswith("postgresql+asyncpg"):
+        server_settings = {}
+        if settings.db_statement_timeout_ms:
+            server_settings["statement_timeout"] = str(settings.db_statement_timeout_ms)
+        if settings.db_lock_timeout_ms:
+            server_settings["lock_timeout"] = str(settings.db_lock_timeout_ms)
+        if settings.db_idle_in_transaction_timeout_ms:
+            server_settings["idle_in_transaction_session_timeout"] = str(
+                settings.db_idle_in_transaction_timeout_ms)
+        options["connect_args"] = {
+            # SQLAlchemy's adapter cache and asyncpg's own cache
+            "prepared_statement_cache_size": settings.db_statement_cache_size,
+            "statement_cache_size": settings.db_statement_cache_size,
+            "server_settings": server_settings,
+        }
+    return options
 
-load_dotenv()
-DATABASE_URL = os.getenv("DATABASE_URL")
 
 # set up an async postgresql connection
-engine = create_async_engine(DATABASE_URL, echo=True)
+engine = create_async_engine(DATABASE_URL, **_engine_options())
 
 SessionLocal = sessionmaker(
     autocommit=False, autoflush=False, bind=engine, class_=AsyncSession
@@ -17,3 +76,34 @@ SessionLocal = sessionmaker(
 async def get_db():
     async with SessionLocal() as session:
         yield session
+
+
+def dialect_insert(db: AsyncSession):
+    """The insert() of the session's dialect, ON CONFLICT is dialect specific
+    in SQLAlchemy."""
+    if db.bind.dialect.name == "postgresql":
+        return postgresql.insert
+    if db.bind.dialect.name == "sqlite":
+        return sqlite.insert
+    return insert
+
+
+def pool_stats() -> dict:
+    """Connection pool usage, for the stats endpoint and metrics."""
+    pool = engine.pool
+    stats = {"pool": type(pool).__name__}
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, TimedQueuePool):
+        stats.update(
+            waits=TimedQueuePool.waits,
+            wait_seconds_total=TimedQueuePool.wait_seconds_total,
+            wait_seconds_max=TimedQueuePool.wait_seconds_max,
+            timeouts=TimedQueuePool.timeouts,
+        )
+    return stats
@@ -1,13 +1,53 @@
+import hashlib
+import time
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.cache import TTLCache
+from app.core.config import settings
 from app.core.jwt import verify_access_token
+from app.db.session import get_db
+from app.services.user_cache import Principal, user_cache
+
+TOKEN_CACHE_SIZE = settings.token_cache_size
+TOKEN_CACHE_TTL = settings.token_cache_ttl
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
+# sha256(token) -> username of tokens whose signature was already checked
+token_cache = TTLCache(TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
 
-async def get_current_user(token: str = Depends(oauth2_scheme)):
+
+def verify_access_token_cached(token: str):
+    """Return the token's subject, verifying the signature once per token.
+
+    Entries never outlive the token's own `exp`.
+    """
+    digest = hashlib.sha256(token.encode()).digest()
+    username = token_cache.get(digest)
+    if username is not None:
+        return username
     payload = verify_access_token(token)
-    if not payload:
+    if not payload or payload.get("sub") is None:
+        return None
+    username = payload["sub"]
+    if "exp" in payload:
+        token_cache.set(digest, username, ttl=payload["exp"] - time.time())
+    return username
+
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    username = verify_access_token_cached(token)
+    if not username:
         raise HTTPException(
             status_code=401, detail="Invalid authentication token")
-    return payload["sub"]
+    return username
+
+
+async def get_current_principal(username: str = Depends(get_current_user),
+                                db: AsyncSession = Depends(get_db)) -> Principal:
+    # id, username and is_verified of the caller, usually without a query
+    principal = await user_cache.by_username(db, username)
+    if principal is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return principal
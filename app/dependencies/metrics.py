@@ -0,0 +1,47 @@
+import time
+from app.core.metrics import HTTP_REQUEST_SECONDS, QueryStats, current_queries, observe_request_queries
+
+
+def _route(scope) -> str:
+    # the template, e.g. /chat/{chat_id}/messages, keeps label values bounded
+    route = scope.get("route")
+    template = getattr(route, "path", None)
+    if template is None:
+        return "unmatched"
+    # some FastAPI versions keep the include_router prefix out of route.path,
+    # find where the matched part starts to put it back
+    path, regex, start = scope["path"], getattr(route, "path_regex", None), 0
+    while regex is not None and start >= 0 and not regex.match(path[start:]):
+        start = path.find("/", start + 1)
+    return path[:start] + template if start > 0 else template
+
+
+class MetricsMiddleware:
+    """Times every HTTP request by route template and counts the SQL
+    statements it runs, websockets are counted by the hub instead."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = QueryStats()
+        token = current_queries.set(stats)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_queries.reset(token)
+            route = _route(scope)
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, status).observe(elapsed)
+            observe_request_queries(route, stats)
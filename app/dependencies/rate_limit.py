@@ -0,0 +1,69 @@
+import math
+from fastapi import Depends, HTTPException, Request
+from fastapi.security import OAuth2PasswordRequestForm
+from starlette.datastructures import Headers
+from app.core.config import settings
+from app.core.serialization import FastJSONResponse
+from app.services.rate_limit import local_rate_limiter, rate_limiter
+
+RATE_LIMIT_TRUST_PROXY = settings.rate_limit_trust_proxy
+
+
+def client_ip(scope) -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = Headers(scope=scope).get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def _retry_after_header(retry_after: float) -> dict:
+    return {"Retry-After": str(max(1, math.ceil(retry_after)))}
+
+
+def too_many_requests(retry_after: float) -> HTTPException:
+    return HTTPException(status_code=429, detail="Too many requests, retry later",
+                         headers=_retry_after_header(retry_after))
+
+
+def rate_limit(name: str):
+    """Route dependency limiting calls per client IP under the limit `name`."""
+    async def check(request: Request):
+        retry_after = await rate_limiter.hit(name, client_ip(request.scope))
+        if retry_after:
+            raise too_many_requests(retry_after)
+    return Depends(check)
+
+
+async def limit_login_username(form_data: OAuth2PasswordRequestForm = Depends()):
+    # whichever IPs the attempts come from
+    retry_after = await rate_limiter.hit("auth.login.user", form_data.username.lower())
+    if retry_after:
+        raise too_many_requests(retry_after)
+
+
+class RateLimitMiddleware:
+    """Limits every HTTP request and websocket handshake per client IP,
+    in this process whatever RATE_LIMIT_BACKEND says.
+
+    Refused requests get a 429 with Retry-After, refused websockets are
+    closed before being accepted, which clients see as a 403.
+    """
+
+    def __init__(self, app, name: str = "global"):
+        self.app = app
+        self.name = name
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+        retry_after = await local_rate_limiter.hit(self.name, client_ip(scope))
+        if not retry_after:
+            return await self.app(scope, receive, send)
+        if scope["type"] == "websocket":
+            await send({"type": "websocket.close", "code": 1008})
+            return
+        response = FastJSONResponse({"detail": "Too many requests, retry later"},
+                                    status_code=429, headers=_retry_after_header(retry_after))
+        await response(scope, receive, send)
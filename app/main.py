@@ -1,12 +1,85 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from app.api.endpoints import users, auth, chat
+from app.core.serialization import FastJSONResponse
+from app.api.endpoints import users, auth, chat, metrics, stats
+from app.core.log import log_stats, setup_logging, shutdown_logging
+from app.core.metrics import METRICS, instrument_engine, loop_lag_monitor, register_stats
+from app.db.session import engine, pool_stats
+from app.dependencies.metrics import MetricsMiddleware
+from app.dependencies.rate_limit import RateLimitMiddleware
+from app.services.broadcast import frame_counters
+from app.services.chat_hub import hub
+from app.services.dedup import message_dedup
+from app.services.email_dispatcher import email_dispatcher
+from app.services.membership import membership
+from app.services.message_writer import MESSAGE_BATCHING, message_writer
+from app.services.partition_maintenance import partition_maintenance
+from app.services.presence import presence
+from app.services.rate_limit import local_rate_limiter, rate_limiter
+from app.services.user_cache import user_cache
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_logging()
+    if METRICS:
+        await loop_lag_monitor.start()
+    # connect the pub/sub backend before accepting websockets
+    await hub.start()
+    await membership.start(hub.pubsub)
+    await user_cache.start(hub.pubsub)
+    await presence.start(hub.pubsub)
+    await rate_limiter.start()
+    if MESSAGE_BATCHING:
+        await message_writer.start()
+    await partition_maintenance.start()
+    await message_dedup.start()
+    await email_dispatcher.start()
+    yield
+    await rate_limiter.stop()
+    await email_dispatcher.stop()
+    await partition_maintenance.stop()
+    await message_dedup.stop()
+    # flush queued messages while the database is still reachable
+    await message_writer.stop()
+    await presence.stop()
+    await hub.stop()
+    await loop_lag_monitor.stop()
+    shutdown_logging()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+# per client IP limit on every request, routes add their own on top
+app.add_middleware(RateLimitMiddleware)
+if METRICS:
+    # outermost, so refused requests are timed too
+    app.add_middleware(MetricsMiddleware)
+    instrument_engine(engine)
+
+# counters the services keep anyway, read at scrape time
+register_stats("ws", lambda: {**hub.registry.stats(), **frame_counters.stats()},
+               counters=("opened", "closed", "frames_received", "frames_refused",
+                         "frames_sent", "bytes_sent", "events_batched", "frames_dropped"))
+register_stats("db_pool", pool_stats, counters=("waits", "wait_seconds_total", "timeouts"))
+register_stats("sync_buffer", hub.recent.stats, counters=("hits", "misses"))
+register_stats("presence", presence.stats, counters=("changes", "room_frames"))
+register_stats("membership_cache", membership.stats, counters=("hits", "misses"))
+register_stats("message_writer", message_writer.stats,
+               counters=("batches", "messages", "failed", "flush_seconds_total"))
+register_stats("message_dedup", message_dedup.stats, counters=("hits", "misses", "pruned"))
+register_stats("email", email_dispatcher.stats,
+               counters=("sent", "failed_attempts", "dead", "batches", "smtp_connects",
+                         "send_seconds_total"))
+register_stats("rate_limit", local_rate_limiter.stats, counters=("allowed", "limited"))
+if rate_limiter is not local_rate_limiter:
+    register_stats("rate_limit_shared", rate_limiter.stats, counters=("allowed", "limited"))
+register_stats("log", log_stats, counters=("dropped",))
 
 # Include users API
 app.include_router(users.router, prefix="/users", tags=["Users"])
 app.include_router(auth.router, prefix="/auth", tags=["Auth"])
 app.include_router(chat.router, prefix="/chat", tags=["Chat"])
+app.include_router(stats.router, prefix="/stats", tags=["Stats"])
+app.include_router(metrics.router, tags=["Stats"])
 
 
 @app.get("/")
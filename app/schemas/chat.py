@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
 from typing import List, Optional
 
@@ -18,6 +18,7 @@ class BaseSchema(BaseModel):
 class ChatCreate(BaseModel):
     name: Optional[str] = None  # Name is optional for private chats
     is_group: bool
+    member_ids: List[int] = []  # added with the creator in one transaction
 
     class Config:
         from_attributes = True
@@ -35,6 +36,32 @@ class ChatResponse(BaseModel):
         from_attributes = True
 
 
+# Schema for the outcome of adding or removing one user
+
+
+class MemberResult(BaseModel):
+    user_id: int
+    # added, already_member, removed, not_member or user_not_found
+    status: str
+
+
+class ChatCreateResponse(ChatResponse):
+    members: List[MemberResult]
+
+# Schema for adding and removing several participants at once
+
+
+class ParticipantsUpdate(BaseModel):
+    add: List[int] = []
+    remove: List[int] = []
+
+
+class ParticipantsResult(BaseModel):
+    chat_id: int
+    member_count: int
+    results: List[MemberResult]
+
+
 # Schema for sending a message
 
 
@@ -49,6 +76,27 @@ class MessageResponse(BaseSchema):
     chat_id: int
     sender_id: int
     message: str
+    # 1, 2, 3... within the chat, a jump means messages were missed
+    seq: Optional[int] = Field(None, description=(
+        "Position of the message in its chat, 1, 2, 3... without gaps. Assigned from the "
+        "chat's counter, which keeps it unique; the database only enforces uniqueness "
+        "within a calendar month of created_at. Null for messages stored before seq was "
+        "introduced."))
+
+
+# Schema for sending a message over HTTP
+
+
+class MessageSend(BaseModel):
+    message: str
+    # picked by the client, a resend with the same id stores nothing twice
+    client_msg_id: Optional[str] = Field(None, min_length=1, max_length=64)
+
+
+class MessageSent(MessageResponse):
+    client_msg_id: Optional[str] = None
+    # the client_msg_id had been sent before, this is the original message
+    duplicate: bool = False
 
 # Schema for listing chats
 
@@ -61,3 +109,64 @@ class ChatListResponse(BaseModel):
 
 class MessageListResponse(BaseModel):
     messages: List[MessageResponse]
+
+# Schema for one page of a chat's history, oldest message first
+
+
+class MessagePage(MessageListResponse):
+    before: Optional[str] = None  # cursor for older messages, null if none
+    after: Optional[str] = None  # cursor for newer messages, null if none
+
+# Schema for one room of a user's inbox
+
+
+class InboxRoom(BaseModel):
+    id: int
+    name: str | None
+    is_group: bool
+    created_at: datetime
+    member_count: int
+    unread_count: int
+    last_read_message_id: Optional[int] = None
+    last_activity_at: datetime
+    last_message: Optional[MessageResponse] = None
+
+
+class InboxPage(BaseModel):
+    rooms: List[InboxRoom]
+    next: Optional[str] = None  # cursor for less recently active rooms
+
+# Schema for a read receipt, null marks the whole chat as read
+
+
+class ReadReceipt(BaseModel):
+    message_id: Optional[int] = None
+
+# Schema for one full-text search match, highlight is the HTML escaped
+# message with the matched terms in <mark>
+
+
+class SearchHit(MessageResponse):
+    rank: float
+    highlight: str
+
+
+class SearchPage(BaseModel):
+    hits: List[SearchHit]
+    next: Optional[str] = None  # cursor for the following matches
+
+# Schema for who is online in a chat, offline members are left out
+
+
+class UserPresence(BaseModel):
+    user_id: int
+    status: str  # online or away
+
+
+class ChatPresence(BaseModel):
+    chat_id: int
+    users: List[UserPresence]
+
+
+class PresencePage(BaseModel):
+    chats: List[ChatPresence]
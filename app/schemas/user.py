@@ -1,6 +1,6 @@
 from pydantic import BaseModel, EmailStr
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
 
 # Shared Attributes
 
@@ -28,6 +28,27 @@ class UserResponse(UserBase):
         orm_mode = True
 
 
+# what other users get to see of a user, in the directory and when
+# resolving the senders of messages
+
+
+class UserSummary(BaseModel):
+    id: int
+    username: str
+
+
+class UserSummaryList(BaseModel):
+    users: List[UserSummary]
+
+
+class UserPage(UserSummaryList):
+    next: Optional[str] = None  # cursor for the following page, null if none
+
+
+class UserIds(BaseModel):
+    ids: List[int]
+
+
 class OTPCreate(BaseModel):
     email: EmailStr
 
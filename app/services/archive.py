@@ -0,0 +1,160 @@
+import asyncio
+import gzip
+import logging
+import os
+import shutil
+from datetime import date, datetime
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.config import settings
+from app.core.serialization import dumps, loads
+from app.db.models.chat import ArchivedPartition
+from app.db.partitions import COLUMNS, PARENT, partition_name
+from app.db.session import engine
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_DIR = settings.archive_dir
+ARCHIVE_BATCH_SIZE = 5000
+
+
+class _ChatFileWriter:
+    """Writes rows sorted by chat into one gzip'd NDJSON file per chat."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.chat_id = None
+        self.file = None
+        self.count = 0
+
+    def write(self, rows):
+        for row in rows:
+            if row["chat_id"] != self.chat_id:
+                self.close()
+                self.chat_id = row["chat_id"]
+                self.file = gzip.open(
+                    os.path.join(self.directory, f"chat_{self.chat_id}.ndjson.gz"), "wb")
+            self.file.write(dumps(dict(row)) + b"\n")
+            self.count += 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class MessageArchive:
+    """Cold history: one directory per archived month under ARCHIVE_DIR,
+    holding chat_<id>.ndjson.gz files sorted by (created_at, id).
+
+    Archived months are recorded in chat_message_archives and their rows no
+    longer exist in chat_messages, the history API reads them from here on
+    demand.
+    """
+
+    def __init__(self, directory: str = ARCHIVE_DIR):
+        self.directory = directory
+
+    def month_path(self, month: date) -> str:
+        return os.path.join(self.directory, f"{month:%Y-%m}")
+
+    async def archive_partition(self, month: date) -> int:
+        """Write a month's partition to disk, then detach and drop it.
+
+        Files are written to a temporary directory and renamed when complete,
+        the partition is dropped only if the written count matches its rows.
+        """
+        partition = partition_name(month)
+        path = self.month_path(month)
+        staging = path + ".tmp"
+        await asyncio.to_thread(self._reset_directory, staging)
+
+        writer = _ChatFileWriter(staging)
+        try:
+            async with engine.connect() as conn:
+                async with conn.begin():
+                    await conn.execute(text("SET LOCAL statement_timeout = 0"))
+                    result = await conn.stream(
+                        text(f"SELECT {COLUMNS} FROM {partition} "
+                             "ORDER BY chat_id, created_at, id")
+                        .execution_options(yield_per=ARCHIVE_BATCH_SIZE))
+                    async for rows in result.mappings().partitions():
+                        await asyncio.to_thread(writer.write, rows)
+        finally:
+            await asyncio.to_thread(writer.close)
+        await asyncio.to_thread(self._publish, staging, path)
+
+        async with engine.begin() as conn:
+            await conn.execute(text(f"ALTER TABLE {PARENT} DETACH PARTITION {partition}"))
+            remaining = (await conn.execute(text(f"SELECT count(*) FROM {partition}"))).scalar()
+            if remaining != writer.count:
+                raise RuntimeError(
+                    f"{partition} holds {remaining} rows but {writer.count} were archived")
+            await conn.execute(
+                ArchivedPartition.__table__.insert().values(
+                    month=month, path=path, message_count=writer.count))
+            await conn.execute(text(f"DROP TABLE {partition}"))
+        logger.info("archived %s: %d messages to %s", partition, writer.count, path)
+        return writer.count
+
+    async def archived_months(self, db: AsyncSession) -> list[date]:
+        result = await db.execute(select(ArchivedPartition.month).order_by(ArchivedPartition.month))
+        return list(result.scalars())
+
+    async def read_messages(self, db: AsyncSession, chat_id: int, limit: int,
+                            before: Optional[tuple] = None, after: Optional[tuple] = None) -> list[dict]:
+        """Up to `limit` archived messages of a chat around a (created_at, id) key.
+
+        Newest first when paging backwards (`before` or no key), oldest first
+        with `after`, like the live history query.
+        """
+        months = await self.archived_months(db)
+        if after is not None:
+            months = [m for m in months if m >= date(after[0].year, after[0].month, 1)]
+        else:
+            if before is not None:
+                months = [m for m in months if m <= before[0].date()]
+            months.reverse()
+
+        messages = []
+        for month in months:
+            rows = await asyncio.to_thread(self._read_chat_month, month, chat_id)
+            if after is not None:
+                rows = [r for r in rows if (r["created_at"], r["id"]) > after]
+            else:
+                rows.reverse()
+                if before is not None:
+                    rows = [r for r in rows if (r["created_at"], r["id"]) < before]
+            messages.extend(rows[:limit - len(messages)])
+            if len(messages) >= limit:
+                break
+        return messages
+
+    def _read_chat_month(self, month: date, chat_id: int) -> list[dict]:
+        try:
+            with gzip.open(os.path.join(self.month_path(month), f"chat_{chat_id}.ndjson.gz")) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        rows = [loads(line) for line in lines]
+        for row in rows:
+            row["created_at"] = datetime.fromisoformat(row["created_at"])
+        return rows
+
+    @staticmethod
+    def _reset_directory(path: str):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    @staticmethod
+    def _publish(staging: str, path: str):
+        # a previous attempt may have published files before failing to drop
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(staging, path)
+
+
+message_archive = MessageArchive()
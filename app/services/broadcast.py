@@ -0,0 +1,230 @@
+import asyncio
+import itertools
+from collections import deque
+from enum import Enum
+
+from fastapi import WebSocket
+
+from app.core.config import settings
+from app.core.serialization import Frame
+from app.core.wire import DEFAULT_PROTOCOL, WS_BATCH_MAX, WireProtocol
+from app.services.pubsub import NODE_ID
+
+
+class SlowConsumerPolicy(str, Enum):
+    # throw away the oldest queued frame to make room for the new one
+    DROP_OLDEST = "drop_oldest"
+    # close the socket, the client is expected to reconnect and resync
+    DISCONNECT = "disconnect"
+    # replace a queued frame with the same coalesce key, else drop oldest,
+    # the hub keys presence and typing updates per room and user
+    COALESCE = "coalesce"
+
+
+SEND_QUEUE_SIZE = settings.ws_send_queue_size
+SLOW_CONSUMER_POLICY = SlowConsumerPolicy(settings.ws_slow_consumer_policy)
+SEND_TIMEOUT = settings.ws_send_timeout
+
+_connection_ids = itertools.count(1)
+
+
+class FrameCounters:
+    """Websocket frame totals of this process, plain ints bumped per frame."""
+
+    __slots__ = ("received", "refused", "sent", "bytes_sent", "batched", "dropped", "queued")
+
+    def __init__(self):
+        self.received = 0
+        # refused by the per socket frame limit
+        self.refused = 0
+        self.sent = 0
+        # frame sizes, characters of text frames and bytes of binary ones,
+        # before the server's permessage-deflate if any
+        self.bytes_sent = 0
+        # events that went out inside a batch frame
+        self.batched = 0
+        # thrown away by the slow consumer policy
+        self.dropped = 0
+        # waiting in the send queues right now
+        self.queued = 0
+
+    def stats(self) -> dict:
+        return {
+            "frames_received": self.received,
+            "frames_refused": self.refused,
+            "frames_sent": self.sent,
+            "bytes_sent": self.bytes_sent,
+            "events_batched": self.batched,
+            "frames_dropped": self.dropped,
+            "frames_queued": self.queued,
+        }
+
+
+frame_counters = FrameCounters()
+
+
+class Connection:
+    """A websocket with its own bounded outbound queue and writer task.
+
+    Producers never await the socket: `enqueue` only appends an encoded
+    Frame to the queue, and the writer task is the single place that sends.
+    """
+
+    __slots__ = ("websocket", "user_id", "id", "protocol", "max_queue", "policy", "dropped",
+                 "closed", "_queue", "_held", "_wakeup", "_writer")
+
+    def __init__(self, websocket: WebSocket, user_id: int,
+                 protocol: WireProtocol = DEFAULT_PROTOCOL,
+                 max_queue: int = SEND_QUEUE_SIZE,
+                 policy: SlowConsumerPolicy = SLOW_CONSUMER_POLICY):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.protocol = protocol
+        # unique across processes, lets a publisher skip its own socket
+        self.id = f"{NODE_ID}:{next(_connection_ids)}"
+        self.max_queue = max_queue
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self._queue = deque()
+        # frames set aside while the client catches up, see hold()
+        self._held = None
+        self._wakeup = asyncio.Event()
+        self._writer = None
+
+    def start(self):
+        self._writer = asyncio.create_task(self._run())
+
+    def enqueue(self, frame: Frame, coalesce_key=None) -> bool:
+        """Queue a frame for this socket, applying the slow consumer policy."""
+        if self.closed:
+            return False
+        if self._held is not None:
+            if len(self._held) >= self.max_queue:
+                self.dropped += 1
+                frame_counters.dropped += 1
+                self._held.popleft()
+            self._held.append((coalesce_key, frame))
+            return True
+        if self.policy == SlowConsumerPolicy.COALESCE and coalesce_key is not None:
+            # a newer state for the same key supersedes the queued one
+            for i, (key, _) in enumerate(self._queue):
+                if key == coalesce_key:
+                    self._queue[i] = (coalesce_key, frame)
+                    return True
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            frame_counters.dropped += 1
+            if self.policy == SlowConsumerPolicy.DISCONNECT:
+                self.close()
+                return False
+            self._queue.popleft()
+            frame_counters.queued -= 1
+        self._queue.append((coalesce_key, frame))
+        frame_counters.queued += 1
+        self._wakeup.set()
+        return True
+
+    def hold(self):
+        """Keep live frames aside until release(), so a catch-up reply
+        computed meanwhile goes out ahead of them."""
+        self._held = deque()
+
+    def release(self, first: Frame = None, skip_ids=()):
+        """Send `first`, then the held frames but the messages whose id is
+        in `skip_ids`, the ones `first` already carried."""
+        held, self._held = self._held or (), None
+        if first is not None:
+            self.enqueue(first)
+        for coalesce_key, frame in held:
+            payload = frame.payload
+            if (isinstance(payload, dict) and "type" not in payload
+                    and payload.get("id") in skip_ids):
+                continue
+            self.enqueue(frame, coalesce_key)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    async def _run(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    if self.closed:
+                        return
+                data = self._next_frame()
+                if isinstance(data, str):
+                    await asyncio.wait_for(self.websocket.send_text(data), SEND_TIMEOUT)
+                else:
+                    await asyncio.wait_for(self.websocket.send_bytes(data), SEND_TIMEOUT)
+                frame_counters.sent += 1
+                frame_counters.bytes_sent += len(data)
+        except Exception:
+            # a failed or stalled send means the peer is gone, stop writing
+            self.closed = True
+            self._clear()
+            asyncio.create_task(self._close_socket())
+
+    def _next_frame(self):
+        """Encode the next frame, or a batch of the waiting events when the
+        protocol allows it and the queue has backed up."""
+        _, frame = self._queue.popleft()
+        frame_counters.queued -= 1
+        if not self.protocol.batch or not self._queue or frame.payload is None:
+            return self.protocol.encode(frame)
+        frames = [frame]
+        # error strings have no payload to batch, they end the batch
+        while (self._queue and len(frames) < WS_BATCH_MAX
+               and self._queue[0][1].payload is not None):
+            frames.append(self._queue.popleft()[1])
+        frame_counters.queued -= len(frames) - 1
+        if len(frames) == 1:
+            return self.protocol.encode(frame)
+        frame_counters.batched += len(frames)
+        return self.protocol.encode_batch(frames)
+
+    def close(self, code: int = 1013):
+        """Close the socket, by default with 1013 try again later."""
+        if self.closed:
+            return
+        self.closed = True
+        self._clear()
+        self._wakeup.set()
+        asyncio.create_task(self._close_socket(code))
+
+    def _clear(self):
+        frame_counters.queued -= len(self._queue)
+        self._queue.clear()
+
+    async def _close_socket(self, code: int = 1013):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def aclose(self):
+        """Stop the writer task, used when the receive loop exits."""
+        self.closed = True
+        self._clear()
+        self._wakeup.set()
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except (asyncio.CancelledError, Exception):
+                pass
+
+
+def broadcast(connections, frame: Frame, coalesce_key=None) -> int:
+    """Enqueue one frame on every connection, it is encoded at most once.
+
+    Returns the number of connections the frame was queued on.
+    """
+    delivered = 0
+    for connection in connections:
+        if connection.enqueue(frame, coalesce_key):
+            delivered += 1
+    return delivered
@@ -0,0 +1,131 @@
+import asyncio
+
+from app.core.serialization import Frame, dumps, loads
+from app.services.broadcast import SLOW_CONSUMER_POLICY, SlowConsumerPolicy, broadcast
+from app.services.pubsub import PubSub, create_pubsub
+from app.services.registry import ConnectionRegistry
+from app.services.sync import RecentMessages
+
+
+def chat_channel(chat_id: int) -> str:
+    return f"chat_{chat_id}"
+
+
+# membership changes, every process applies them to its own sockets
+MEMBERS_CHANNEL = "room_members"
+# user ids per membership event, keeps payloads under the NOTIFY limit
+MEMBERS_CHUNK_SIZE = 500
+
+
+class ChatHub:
+    """Delivers chat events published on any process to the local sockets.
+
+    Every process subscribes to the channel of each chat that has at least
+    one locally connected member, and to the members channel so it learns
+    when its connected users join or leave rooms. A user may hold any number
+    of sockets, on one process or several. The messages of subscribed chats
+    are also kept in `recent`, for reconnecting clients to catch up from.
+    """
+
+    def __init__(self, pubsub: PubSub):
+        self.pubsub = pubsub
+        self.registry = ConnectionRegistry()
+        self.recent = RecentMessages()
+        # membership events being applied, referenced until they finish
+        self._tasks = set()
+
+    async def start(self):
+        await self.pubsub.start()
+        await self.pubsub.subscribe(MEMBERS_CHANNEL, self._on_members_event)
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await self.pubsub.stop()
+
+    async def connect(self, connection, chat_ids):
+        self.registry.add(connection)
+        for chat_id in chat_ids:
+            await self.join(connection.user_id, chat_id)
+
+    async def disconnect(self, connection):
+        # the registry is updated before awaiting, events may arrive meanwhile
+        empty_rooms = self.registry.remove(connection)
+        if empty_rooms is None:
+            # the user's other sockets keep the rooms
+            return
+        for chat_id in empty_rooms:
+            await self._unsubscribe(chat_id)
+
+    async def join(self, user_id: int, chat_id: int):
+        """Start delivering a chat to a locally connected user."""
+        if self.registry.join(user_id, chat_id):
+            await self.pubsub.subscribe(chat_channel(chat_id), self._on_chat_event)
+
+    async def leave(self, user_id: int, chat_id: int):
+        """Stop delivering a chat to a locally connected user."""
+        if self.registry.leave(user_id, chat_id):
+            await self._unsubscribe(chat_id)
+
+    async def _unsubscribe(self, chat_id: int):
+        # missed events would leave a hole in the buffer
+        self.recent.drop(chat_id)
+        await self.pubsub.unsubscribe(chat_channel(chat_id), self._on_chat_event)
+
+    async def publish_message(self, chat_id: int, sender_id: int, event: dict, origin: str = None):
+        """Fan a chat event out to every process.
+
+        The event reaches every socket of the room's members except the
+        connection with id `origin`, usually the one that sent it.
+        """
+        await self.pubsub.publish(
+            chat_channel(chat_id),
+            dumps({"sender_id": sender_id, "origin": origin, "event": event}).decode())
+
+    async def publish_members(self, chat_id: int, joined=(), left=()):
+        """Tell every process which users joined or left a room, the ones
+        holding their sockets start or stop delivering it."""
+        joined, left = list(joined), list(left)
+        for start in range(0, max(len(joined), len(left)), MEMBERS_CHUNK_SIZE):
+            await self.pubsub.publish(MEMBERS_CHANNEL, dumps({
+                "chat_id": chat_id,
+                "joined": joined[start:start + MEMBERS_CHUNK_SIZE],
+                "left": left[start:start + MEMBERS_CHUNK_SIZE],
+            }).decode())
+
+    def _on_chat_event(self, channel: str, payload: str):
+        envelope = loads(payload)
+        chat_id = int(channel.removeprefix("chat_"))
+        event = envelope["event"]
+        if "type" not in event:
+            # a chat message, other events carry a type
+            self.recent.add(chat_id, event)
+        recipients = self.registry.recipients(chat_id, exclude=envelope.get("origin"))
+        if event.get("type") == "presence" and SLOW_CONSUMER_POLICY == SlowConsumerPolicy.COALESCE:
+            # one frame per user and kind, so a slow socket keeps only the
+            # latest state of each instead of every update in between
+            for kind in ("presence", "typing"):
+                for entry in event.get(kind, ()):
+                    broadcast(recipients,
+                              Frame({"type": "presence", "chat_id": chat_id, kind: [entry]}),
+                              coalesce_key=(kind, chat_id, entry["user_id"]))
+            return
+        # encoded once on this process, shared by every local recipient
+        broadcast(recipients, Frame(event))
+
+    def _on_members_event(self, channel: str, payload: str):
+        task = asyncio.create_task(self._apply_members(loads(payload)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _apply_members(self, event: dict):
+        chat_id = event["chat_id"]
+        for user_id in event["joined"]:
+            if self.registry.is_connected(user_id):
+                await self.join(user_id, chat_id)
+        for user_id in event["left"]:
+            if self.registry.in_room(user_id, chat_id):
+                await self.leave(user_id, chat_id)
+
+
+hub = ChatHub(create_pubsub())
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+
+from sqlalchemy import delete, func, tuple_
+from sqlalchemy.future import select
+
+from app.core.config import settings
+from app.db.models.chat import MessageClientId
+from app.db.session import engine
+
+logger = logging.getLogger(__name__)
+
+CLIENT_MSG_ID_CACHE_SIZE = settings.client_msg_id_cache_size
+CLIENT_MSG_ID_CACHE_USERS = settings.client_msg_id_cache_users
+CLIENT_MSG_ID_RETENTION = timedelta(hours=settings.client_msg_id_retention_hours)
+MAX_CLIENT_MSG_ID_LENGTH = 64
+# seconds between deletes of expired keys, and rows per delete
+CLIENT_MSG_ID_PRUNE_INTERVAL = 300
+CLIENT_MSG_ID_PRUNE_BATCH = 10000
+
+
+def valid_client_msg_id(value) -> bool:
+    return value is None or (isinstance(value, str) and 0 < len(value) <= MAX_CLIENT_MSG_ID_LENGTH)
+
+
+class MessageDedup:
+    """The last client_msg_ids of each sender and what they were saved as.
+
+    A resend whose ack got lost is answered from here without touching the
+    database. The cache is only a shortcut: the chat_message_client_ids
+    table decides, see insert_messages, so a resend to another process or
+    after a restart is still caught. Its rows are deleted once older than
+    CLIENT_MSG_ID_RETENTION.
+    """
+
+    def __init__(self, per_user: int = CLIENT_MSG_ID_CACHE_SIZE,
+                 max_users: int = CLIENT_MSG_ID_CACHE_USERS):
+        self.per_user = per_user
+        self.max_users = max_users
+        self._users = OrderedDict()
+        self._task = None
+        self.hits = 0
+        self.misses = 0
+        self.pruned = 0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._prune())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def get(self, sender_id: int, client_msg_id: str):
+        saved = self._users.get(sender_id, {}).get(client_msg_id)
+        if saved is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return saved
+
+    def put(self, sender_id: int, client_msg_id: str, saved):
+        """Remember what a key was saved as, `saved` is returned by get as is."""
+        recent = self._users.get(sender_id)
+        if recent is None:
+            if len(self._users) >= self.max_users:
+                self._users.popitem(last=False)
+            recent = self._users[sender_id] = OrderedDict()
+        else:
+            self._users.move_to_end(sender_id)
+        recent[client_msg_id] = saved
+        if len(recent) > self.per_user:
+            recent.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._users),
+            "hits": self.hits,
+            "misses": self.misses,
+            "pruned": self.pruned,
+        }
+
+    async def _prune(self):
+        keys = tuple_(MessageClientId.sender_id, MessageClientId.client_msg_id)
+        while True:
+            await asyncio.sleep(CLIENT_MSG_ID_PRUNE_INTERVAL)
+            try:
+                while True:
+                    # in batches, a backlog does not hold one huge transaction
+                    async with engine.begin() as conn:
+                        result = await conn.execute(delete(MessageClientId).where(keys.in_(
+                            select(MessageClientId.sender_id, MessageClientId.client_msg_id)
+                            .where(MessageClientId.created_at < func.now() - CLIENT_MSG_ID_RETENTION)
+                            .limit(CLIENT_MSG_ID_PRUNE_BATCH))))
+                    self.pruned += result.rowcount
+                    if result.rowcount < CLIENT_MSG_ID_PRUNE_BATCH:
+                        break
+            except Exception:
+                logger.exception("client_msg_id pruning failed")
+
+
+message_dedup = MessageDedup()
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import math
+import random
+import time
+from contextlib import asynccontextmanager
+from datetime import timedelta
+
+import aiosmtplib
+from sqlalchemy import Interval, bindparam, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.email import build_message
+from app.db.models.email import OutboundEmail
+from app.db.session import DATABASE_URL, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+EMAIL_POOL_SIZE = settings.email_pool_size
+EMAIL_BATCH_SIZE = settings.email_batch_size
+EMAIL_POLL_INTERVAL = settings.email_poll_interval
+EMAIL_SEND_TIMEOUT = settings.email_send_timeout
+EMAIL_MAX_ATTEMPTS = settings.email_max_attempts
+EMAIL_RETRY_BASE = settings.email_retry_base
+EMAIL_RETRY_MAX = settings.email_retry_max
+
+
+def smtp_client() -> aiosmtplib.SMTP:
+    """A not yet connected client for the configured mail server."""
+    credentials = {}
+    if settings.mail_use_credentials:
+        credentials = {"username": settings.mail_username, "password": settings.mail_password}
+    return aiosmtplib.SMTP(
+        hostname=settings.mail_server,
+        port=settings.mail_port,
+        start_tls=settings.mail_starttls,
+        use_tls=settings.mail_ssl_tls,
+        timeout=EMAIL_SEND_TIMEOUT,
+        **credentials,
+    )
+
+
+class SMTPPool:
+    """Up to `size` SMTP sessions, kept open between messages.
+
+    A connection that fails is closed instead of returned, the next caller
+    opens a fresh one. A refused message does not count, the client resets
+    the session after an error reply and it stays usable.
+    """
+
+    def __init__(self, size: int = EMAIL_POOL_SIZE, factory=smtp_client):
+        self.size = size
+        self.factory = factory
+        self.connects = 0
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []
+
+    @asynccontextmanager
+    async def connection(self):
+        async with self._slots:
+            client = self._idle.pop() if self._idle else None
+            if client is None or not client.is_connected:
+                client = self.factory()
+                await client.connect()
+                self.connects += 1
+            try:
+                yield client
+            except (aiosmtplib.SMTPResponseException, aiosmtplib.SMTPRecipientsRefused):
+                self._idle.append(client)
+                raise
+            except BaseException:
+                client.close()
+                raise
+            self._idle.append(client)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for client in idle:
+            try:
+                await client.quit()
+            except Exception:
+                client.close()
+
+
+def _is_permanent(error: Exception) -> bool:
+    """5xx replies mean the server will never take this message."""
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return all(r.code >= 500 for r in error.recipients)
+    return isinstance(error, aiosmtplib.SMTPResponseException) and error.code >= 500
+
+
+def retry_delay(attempts: int, base: float = EMAIL_RETRY_BASE, cap: float = EMAIL_RETRY_MAX) -> float:
+    """Exponential backoff with full jitter after `attempts` failed sends."""
+    return random.uniform(0, min(cap, base * 2 ** (attempts - 1)))
+
+
+class EmailDispatcher:
+    """Sends queued rows of email_outbox in the background.
+
+    Rows are claimed in batches with FOR UPDATE SKIP LOCKED so any number of
+    processes can run a dispatcher. Claiming pushes next_attempt_at forward
+    as a lease, failed sends are retried with exponential backoff and rows
+    that fail EMAIL_MAX_ATTEMPTS times, or are refused permanently, are
+    marked dead.
+    """
+
+    def __init__(self, pool: SMTPPool = None, batch_size: int = EMAIL_BATCH_SIZE,
+                 poll_interval: float = EMAIL_POLL_INTERVAL,
+                 send_timeout: float = EMAIL_SEND_TIMEOUT,
+                 max_attempts: int = EMAIL_MAX_ATTEMPTS):
+        self.pool = pool or SMTPPool()
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.send_timeout = send_timeout
+        self.max_attempts = max_attempts
+        # long enough for a whole batch to go through the pool
+        self.lease = send_timeout * (math.ceil(batch_size / self.pool.size) + 1)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closing = False
+        self.sent = 0
+        self.failed_attempts = 0
+        self.dead = 0
+        self.batches = 0
+        self.send_seconds_total = 0.0
+        self.send_seconds_max = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        # claiming relies on SKIP LOCKED and server side time arithmetic
+        return settings.email_dispatcher and DATABASE_URL.startswith("postgresql")
+
+    async def start(self):
+        if not self.enabled:
+            logger.warning("email dispatcher disabled, queued emails are not sent")
+            return
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Finish the batch in flight, leave the rest of the queue for later."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        await self.pool.close()
+
+    def notify(self):
+        """Wake the dispatcher after committing new rows, instead of polling."""
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "failed_attempts": self.failed_attempts,
+            "dead": self.dead,
+            "batches": self.batches,
+            "smtp_connects": self.pool.connects,
+            "send_seconds_total": self.send_seconds_total,
+            "send_seconds_max": self.send_seconds_max,
+        }
+
+    async def queue_stats(self, db: AsyncSession) -> dict:
+        result = await db.execute(
+            select(OutboundEmail.status, func.count()).group_by(OutboundEmail.status))
+        return dict(result.all())
+
+    async def _run(self):
+        while not self._closing:
+            self._wakeup.clear()
+            try:
+                claimed = await self._claim()
+                if claimed:
+                    await self._deliver(claimed)
+            except Exception:
+                logger.exception("email dispatch failed")
+                claimed = []
+            if len(claimed) < self.batch_size and not self._closing:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _claim(self) -> list:
+        outbox = OutboundEmail.__table__
+        due = (
+            select(outbox.c.id)
+            .where(outbox.c.status == "pending", outbox.c.next_attempt_at <= func.now())
+            .order_by(outbox.c.next_attempt_at)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        async with SessionLocal() as db:
+            result = await db.execute(
+                update(outbox)
+                .where(outbox.c.id.in_(due.scalar_subquery()))
+                .values(next_attempt_at=func.now() + timedelta(seconds=self.lease),
+                        attempts=outbox.c.attempts + 1)
+                .returning(outbox.c.id, outbox.c.recipient, outbox.c.subject,
+                           outbox.c.body, outbox.c.subtype, outbox.c.attempts)
+            )
+            rows = result.all()
+            await db.commit()
+        return rows
+
+    async def _deliver(self, rows: list):
+        results = await asyncio.gather(*(self._send(row) for row in rows))
+        sent = [row.id for row, error in zip(rows, results) if error is None]
+        retry, dead = [], []
+        for row, error in zip(rows, results):
+            if error is None:
+                continue
+            if _is_permanent(error) or row.attempts >= self.max_attempts:
+                dead.append({"b_id": row.id, "b_error": repr(error)})
+            else:
+                retry.append({"b_id": row.id, "b_error": repr(error),
+                              "b_delay": timedelta(seconds=retry_delay(row.attempts))})
+
+        outbox = OutboundEmail.__table__
+        async with SessionLocal() as db:
+            if sent:
+                await db.execute(
+                    update(outbox).where(outbox.c.id.in_(sent))
+                    .values(status="sent", sent_at=func.now(), last_error=None))
+            if retry:
+                await db.execute(
+                    update(outbox).where(outbox.c.id == bindparam("b_id"))
+                    .values(next_attempt_at=func.now() + bindparam("b_delay", type_=Interval),
+                            last_error=bindparam("b_error")),
+                    retry)
+            if dead:
+                await db.execute(
+                    update(outbox).where(outbox.c.id == bindparam("b_id"))
+                    .values(status="dead", last_error=bindparam("b_error")),
+                    dead)
+            await db.commit()
+        self.batches += 1
+        self.sent += len(sent)
+        self.failed_attempts += len(retry) + len(dead)
+        self.dead += len(dead)
+        for item in dead:
+            logger.error("email %s dead-lettered: %s", item["b_id"], item["b_error"])
+
+    async def _send(self, row):
+        """Send one row, returning the exception instead of raising it."""
+        message = build_message(row.recipient, row.subject, row.body, row.subtype)
+        started = time.perf_counter()
+        try:
+            try:
+                async with self.pool.connection() as client:
+                    await asyncio.wait_for(client.send_message(message), self.send_timeout)
+            except aiosmtplib.SMTPServerDisconnected:
+                # an idle pooled session the server has since closed
+                async with self.pool.connection() as client:
+                    await asyncio.wait_for(client.send_message(message), self.send_timeout)
+        except Exception as e:
+            return e
+        elapsed = time.perf_counter() - started
+        self.send_seconds_total += elapsed
+        self.send_seconds_max = max(self.send_seconds_max, elapsed)
+        return None
+
+
+email_dispatcher = EmailDispatcher()
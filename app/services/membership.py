@@ -0,0 +1,145 @@
+import json
+from collections import OrderedDict
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.config import settings
+from app.db.models.chat import ChatParticipant
+
+MEMBERSHIP_CACHE_CHATS = settings.membership_cache_chats
+MEMBERSHIP_CACHE_USERS = settings.membership_cache_users
+MEMBERSHIP_CHANNEL = "membership"
+# user ids per invalidation message, keeps payloads under the NOTIFY limit
+MEMBERSHIP_CHUNK_SIZE = 500
+
+
+class MembershipCache:
+    """In-process LRU index of chat_id -> user_ids and user_id -> chat_ids.
+
+    Entries are loaded lazily from chat_participants on first use and dropped
+    on write, locally and on every other process through pub/sub.
+    """
+
+    def __init__(self, max_chats: int = MEMBERSHIP_CACHE_CHATS,
+                 max_users: int = MEMBERSHIP_CACHE_USERS):
+        self.max_chats = max_chats
+        self.max_users = max_users
+        self.hits = 0
+        self.misses = 0
+        self._chats = OrderedDict()
+        self._users = OrderedDict()
+        # bumped on every invalidation so a load that raced with a write
+        # does not put stale data back into the cache
+        self._generation = 0
+        self._pubsub = None
+
+    async def start(self, pubsub):
+        self._pubsub = pubsub
+        await pubsub.subscribe(MEMBERSHIP_CHANNEL, self._on_invalidate)
+
+    async def chat_members(self, db: AsyncSession, chat_id: int) -> frozenset:
+        members = self._get(self._chats, chat_id)
+        if members is None:
+            generation = self._generation
+            result = await db.execute(
+                select(ChatParticipant.user_id).where(ChatParticipant.chat_id == chat_id))
+            members = frozenset(result.scalars().all())
+            if generation == self._generation:
+                self._put(self._chats, chat_id, members, self.max_chats)
+        return members
+
+    async def chat_members_many(self, db: AsyncSession, chat_ids) -> dict:
+        """chat_id -> members for several chats, misses loaded in one query."""
+        members = {}
+        missing = []
+        for chat_id in chat_ids:
+            cached = self._get(self._chats, chat_id)
+            if cached is None:
+                missing.append(chat_id)
+            else:
+                members[chat_id] = cached
+        if missing:
+            generation = self._generation
+            result = await db.execute(
+                select(ChatParticipant.chat_id, ChatParticipant.user_id)
+                .where(ChatParticipant.chat_id.in_(missing)))
+            loaded = {chat_id: set() for chat_id in missing}
+            for chat_id, user_id in result.all():
+                loaded[chat_id].add(user_id)
+            for chat_id, user_ids in loaded.items():
+                members[chat_id] = frozenset(user_ids)
+                if generation == self._generation:
+                    self._put(self._chats, chat_id, members[chat_id], self.max_chats)
+        return members
+
+    async def user_chats(self, db: AsyncSession, user_id: int) -> frozenset:
+        chats = self._get(self._users, user_id)
+        if chats is None:
+            generation = self._generation
+            result = await db.execute(
+                select(ChatParticipant.chat_id).where(ChatParticipant.user_id == user_id))
+            chats = frozenset(result.scalars().all())
+            if generation == self._generation:
+                self._put(self._users, user_id, chats, self.max_users)
+        return chats
+
+    async def is_member(self, db: AsyncSession, chat_id: int, user_id: int) -> bool:
+        return user_id in await self.chat_members(db, chat_id)
+
+    async def invalidate(self, chat_id: int = None, user_id: int = None):
+        """Drop entries after a membership write and tell the other processes."""
+        self._invalidate(chat_id, user_id)
+        if self._pubsub is not None:
+            await self._pubsub.publish(
+                MEMBERSHIP_CHANNEL, json.dumps({"chat_id": chat_id, "user_id": user_id}))
+
+    async def invalidate_members(self, chat_id: int, user_ids):
+        """Drop a room and its changed members, one message for many users."""
+        user_ids = list(user_ids)
+        self._invalidate(chat_id, None)
+        for user_id in user_ids:
+            self._invalidate(None, user_id)
+        if self._pubsub is not None:
+            for start in range(0, max(len(user_ids), 1), MEMBERSHIP_CHUNK_SIZE):
+                await self._pubsub.publish(MEMBERSHIP_CHANNEL, json.dumps(
+                    {"chat_id": chat_id, "user_ids": user_ids[start:start + MEMBERSHIP_CHUNK_SIZE]}))
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "chats": len(self._chats),
+            "users": len(self._users),
+        }
+
+    def _get(self, entries: OrderedDict, key):
+        value = entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def _put(self, entries: OrderedDict, key, value, max_size: int):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > max_size:
+            entries.popitem(last=False)
+
+    def _invalidate(self, chat_id, user_id):
+        self._generation += 1
+        if chat_id is not None:
+            self._chats.pop(chat_id, None)
+        if user_id is not None:
+            self._users.pop(user_id, None)
+
+    def _on_invalidate(self, channel: str, payload: str):
+        event = json.loads(payload)
+        self._invalidate(event.get("chat_id"), event.get("user_id"))
+        for user_id in event.get("user_ids", ()):
+            self._invalidate(None, user_id)
+
+
+membership = MembershipCache()
@@ -0,0 +1,367 @@
+import asyncio
+import logging
+import time
+
+from collections import Counter
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+from sqlalchemy import bindparam, case, insert, or_, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.config import settings
+from app.core.serialization import dumps
+from app.db.models.chat import ChatMessage, ChatParticipant, ChatRoom, MessageClientId
+from app.db.session import SessionLocal, dialect_insert
+from app.services.dedup import message_dedup
+from app.services.pubsub import NOTIFY_PAYLOAD_LIMIT
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_BATCHING = settings.message_batching
+MESSAGE_BATCH_SIZE = settings.message_batch_size
+MESSAGE_BATCH_DELAY_MS = settings.message_batch_delay_ms
+MAX_MESSAGE_LENGTH = settings.max_message_length
+# the encoded text must leave room for the rest of the event it is
+# published in, a postgres NOTIFY takes less than 8000 bytes
+MAX_MESSAGE_BYTES = NOTIFY_PAYLOAD_LIMIT - 512
+
+
+def message_error(message):
+    """Why `message` cannot be stored, None when it can."""
+    if not isinstance(message, str) or not message.strip():
+        return "Message must be a non-empty string"
+    if len(message) > MAX_MESSAGE_LENGTH:
+        return f"Message too long, at most {MAX_MESSAGE_LENGTH} characters"
+    # checked before storing, a message stored but too large to publish
+    # would never reach the other members
+    if len(dumps(message)) > MAX_MESSAGE_BYTES:
+        return f"Message too long, at most {MAX_MESSAGE_BYTES} bytes encoded"
+    return None
+
+
+class SavedMessage(NamedTuple):
+    id: int
+    created_at: datetime
+    seq: Optional[int]
+    # the client_msg_id had been used, this is the message it was saved as
+    duplicate: bool = False
+
+
+async def insert_messages(db: AsyncSession, rows: list[dict]) -> list[SavedMessage]:
+    """Insert messages with one multi-row INSERT ... RETURNING id, created_at, seq.
+
+    Also maintains the room summaries read by the inbox. The returned rows are
+    in the same order as `rows`. The caller commits.
+
+    A row may carry a client_msg_id. Its sender's key is claimed in
+    chat_message_client_ids first, and a key already claimed, by an earlier
+    row of the batch or any committed transaction, inserts nothing: the
+    original message comes back marked duplicate. A concurrent claim of the
+    same key waits for the first one to commit or roll back.
+    """
+    originals, repeats = await _claim_client_ids(db, rows)
+    fresh = [i for i in range(len(rows)) if i not in originals and i not in repeats]
+    results = dict(originals)
+    if fresh:
+        messages = await _assign_seqs(db, [
+            {key: value for key, value in rows[i].items() if key != "client_msg_id"}
+            for i in fresh])
+        result = await db.execute(
+            insert(ChatMessage).returning(
+                ChatMessage.id, ChatMessage.created_at, ChatMessage.seq,
+                sort_by_parameter_order=True),
+            messages
+        )
+        saved = [SavedMessage(*row) for row in result]
+        await _update_room_summaries(db, messages, saved)
+        results.update(zip(fresh, saved))
+        await _record_client_ids(db, [(rows[i], results[i]) for i in fresh
+                                      if rows[i].get("client_msg_id") is not None])
+    for i, first in repeats.items():
+        results[i] = results[first]._replace(duplicate=True)
+    return [results[i] for i in range(len(rows))]
+
+
+async def _claim_client_ids(db: AsyncSession, rows: list[dict]) -> tuple:
+    """({row index: SavedMessage} of keys claimed before this batch,
+    {row index: index of the batch's first row with the same key})."""
+    first, repeats = {}, {}
+    for i, values in enumerate(rows):
+        if values.get("client_msg_id") is None:
+            continue
+        key = (values["sender_id"], values["client_msg_id"])
+        if key in first:
+            repeats[i] = first[key]
+        else:
+            first[key] = i
+    if not first:
+        return {}, repeats
+    result = await db.execute(
+        dialect_insert(db)(MessageClientId).values([
+            {"sender_id": sender_id, "client_msg_id": client_msg_id,
+             "chat_id": rows[i]["chat_id"]}
+            for (sender_id, client_msg_id), i in first.items()])
+        .on_conflict_do_nothing(index_elements=["sender_id", "client_msg_id"])
+        .returning(MessageClientId.sender_id, MessageClientId.client_msg_id))
+    taken = set(first) - {tuple(row) for row in result}
+    originals = {}
+    if taken:
+        result = await db.execute(
+            select(MessageClientId.sender_id, MessageClientId.client_msg_id,
+                   MessageClientId.message_id, MessageClientId.message_created_at,
+                   MessageClientId.seq)
+            .where(tuple_(MessageClientId.sender_id, MessageClientId.client_msg_id).in_(taken)))
+        for row in result:
+            originals[first[(row.sender_id, row.client_msg_id)]] = SavedMessage(
+                row.message_id, row.message_created_at, row.seq, duplicate=True)
+    return originals, repeats
+
+
+async def _record_client_ids(db: AsyncSession, pairs: list):
+    if not pairs:
+        return
+    claims = MessageClientId.__table__
+    await db.execute(
+        update(claims)
+        .where(claims.c.sender_id == bindparam("b_sender_id"),
+               claims.c.client_msg_id == bindparam("b_client_msg_id"))
+        .values(message_id=bindparam("b_message_id"),
+                message_created_at=bindparam("b_created_at"),
+                seq=bindparam("b_seq")),
+        [{"b_sender_id": values["sender_id"], "b_client_msg_id": values["client_msg_id"],
+          "b_message_id": saved.id, "b_created_at": saved.created_at, "b_seq": saved.seq}
+         for values, saved in pairs]
+    )
+
+
+async def _assign_seqs(db: AsyncSession, rows: list[dict]) -> list[dict]:
+    """Copies of `rows` numbered within their room, in order.
+
+    One UPDATE ... RETURNING reserves the seqs of every room in the batch.
+    The room rows stay locked until commit, so concurrent writers to a room
+    queue up behind each other and a room's seqs commit in order; a rolled
+    back batch gives its seqs back.
+    """
+    counts = Counter(values["chat_id"] for values in rows)
+    rooms = ChatRoom.__table__
+    result = await db.execute(
+        update(rooms)
+        .where(rooms.c.id.in_(sorted(counts)))
+        .values(last_seq=rooms.c.last_seq + case(counts, value=rooms.c.id))
+        .returning(rooms.c.id, rooms.c.last_seq))
+    next_seq = {chat_id: last_seq - counts[chat_id] + 1 for chat_id, last_seq in result}
+    numbered = []
+    for values in rows:
+        seq = next_seq.get(values["chat_id"])
+        if seq is not None:
+            next_seq[values["chat_id"]] = seq + 1
+        # a missing room gets no seq, the insert fails on its foreign key
+        numbered.append({**values, "seq": seq})
+    return numbered
+
+
+async def _update_room_summaries(db: AsyncSession, rows: list[dict], saved: list):
+    latest = {}
+    sent = {}
+    by_chat = {}
+    for values, row in zip(rows, saved):
+        chat_id, sender_id = values["chat_id"], values["sender_id"]
+        if chat_id not in latest or latest[chat_id][0] < row.id:
+            latest[chat_id] = (row.id, row.created_at)
+        count, last_id = sent.get((chat_id, sender_id), (0, 0))
+        sent[(chat_id, sender_id)] = (count + 1, max(last_id, row.id))
+        by_chat.setdefault(chat_id, []).append((row.id, sender_id))
+
+    # sorted so concurrent batches lock rows in the same order
+    rooms = ChatRoom.__table__
+    await db.execute(
+        update(rooms)
+        .where(rooms.c.id == bindparam("b_chat_id"),
+               or_(rooms.c.last_message_id.is_(None),
+                   rooms.c.last_message_id < bindparam("b_message_id")))
+        .values(last_message_id=bindparam("b_message_id"),
+                last_message_at=bindparam("b_created_at")),
+        [{"b_chat_id": chat_id, "b_message_id": message_id, "b_created_at": created_at}
+         for chat_id, (message_id, created_at) in sorted(latest.items())]
+    )
+    participants = ChatParticipant.__table__
+    groups = sorted(sent.items())
+    # everyone else in the room gets the messages as unread
+    await db.execute(
+        update(participants)
+        .where(participants.c.chat_id == bindparam("b_chat_id"),
+               participants.c.user_id != bindparam("b_sender_id"))
+        .values(unread_count=participants.c.unread_count + bindparam("b_count")),
+        [{"b_chat_id": chat_id, "b_sender_id": sender_id, "b_count": count}
+         for (chat_id, sender_id), (count, _) in groups]
+    )
+    # and the sender has read the room up to their own last message, only
+    # later messages of others in this batch stay unread, unless their
+    # receipt is already further ahead
+    await db.execute(
+        update(participants)
+        .where(participants.c.chat_id == bindparam("b_chat_id"),
+               participants.c.user_id == bindparam("b_sender_id"),
+               or_(participants.c.last_read_message_id.is_(None),
+                   participants.c.last_read_message_id < bindparam("b_message_id")))
+        .values(last_read_message_id=bindparam("b_message_id"),
+                unread_count=bindparam("b_unread")),
+        [{"b_chat_id": chat_id, "b_sender_id": sender_id, "b_message_id": last_id,
+          "b_unread": sum(1 for message_id, other in by_chat[chat_id]
+                          if other != sender_id and message_id > last_id)}
+         for (chat_id, sender_id), (_, last_id) in groups]
+    )
+
+
+class MessageWriter:
+    """Write-behind batching of chat messages from every connection.
+
+    `submit` resolves only after the batch holding the message has committed,
+    so an ack sent to the client always refers to a durable row. A failed
+    batch fails every submitter in it and nothing is acked.
+    """
+
+    def __init__(self, batch_size: int = MESSAGE_BATCH_SIZE,
+                 max_delay_ms: float = MESSAGE_BATCH_DELAY_MS):
+        self.batch_size = batch_size
+        self.max_delay = max_delay_ms / 1000
+        self._queue = asyncio.Queue()
+        self._task = None
+        self._closing = False
+        self.batches = 0
+        self.messages = 0
+        self.failed = 0
+        self.max_batch_size = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._closing
+
+    async def start(self):
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop accepting messages and flush everything already queued."""
+        if self._task is None:
+            return
+        self._closing = True
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, chat_id: int, sender_id: int, message: str,
+                     client_msg_id: str = None):
+        if not self.running:
+            raise RuntimeError("Message writer is not running")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(
+            ({"chat_id": chat_id, "sender_id": sender_id, "message": message,
+              "client_msg_id": client_msg_id}, future))
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "messages": self.messages,
+            "failed": self.failed,
+            "queued": self._queue.qsize(),
+            "max_batch_size": self.max_batch_size,
+            "avg_batch_size": self.messages / self.batches if self.batches else 0,
+            "flush_seconds_total": self.flush_seconds_total,
+            "flush_seconds_max": self.flush_seconds_max,
+        }
+
+    async def _run(self):
+        while True:
+            item = await self._queue.get()
+            batch = [] if item is None else [item]
+            self._drain(batch)
+            if len(batch) < self.batch_size and not self._closing:
+                # give other connections a few ms to join this batch
+                await asyncio.sleep(self.max_delay)
+                self._drain(batch)
+            if batch:
+                await self._flush(batch)
+            if self._closing and self._queue.empty():
+                return
+
+    def _drain(self, batch: list):
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            if item is not None:
+                batch.append(item)
+
+    async def _flush(self, batch: list):
+        started = time.perf_counter()
+        try:
+            async with SessionLocal() as session:
+                rows = await insert_messages(session, [values for values, _ in batch])
+                await session.commit()
+        except Exception:
+            logger.exception("failed to persist a batch of %d messages, retrying one by one",
+                             len(batch))
+            await self._flush_one_by_one(batch)
+            return
+
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.messages += len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.flush_seconds_total += elapsed
+        self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+        for (_, future), row in zip(batch, rows):
+            if not future.done():
+                future.set_result(row)
+
+    async def _flush_one_by_one(self, batch: list):
+        # a row that breaks the INSERT only fails its own submitter
+        for values, future in batch:
+            try:
+                async with SessionLocal() as session:
+                    rows = await insert_messages(session, [values])
+                    await session.commit()
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            self.messages += 1
+            if not future.done():
+                future.set_result(rows[0])
+
+
+message_writer = MessageWriter()
+
+
+async def persist_message(db: AsyncSession, chat_id: int, sender_id: int, message: str,
+                          client_msg_id: str = None) -> SavedMessage:
+    """Store one message and return it as a SavedMessage once committed.
+
+    Goes through the batching writer when MESSAGE_BATCHING is enabled,
+    otherwise inserts and commits on the given session. A client_msg_id the
+    sender already used stores nothing and returns the original message,
+    from memory when it was recent.
+    """
+    if client_msg_id is not None:
+        saved = message_dedup.get(sender_id, client_msg_id)
+        if saved is not None:
+            return saved
+    if message_writer.running:
+        saved = await message_writer.submit(chat_id, sender_id, message, client_msg_id)
+    else:
+        rows = await insert_messages(
+            db, [{"chat_id": chat_id, "sender_id": sender_id, "message": message,
+                  "client_msg_id": client_msg_id}])
+        await db.commit()
+        saved = rows[0]
+    if client_msg_id is not None:
+        message_dedup.put(sender_id, client_msg_id, saved._replace(duplicate=True))
+    return saved
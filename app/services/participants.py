@@ -0,0 +1,87 @@
+from sqlalchemy import delete, insert, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.db.models.chat import ChatParticipant, ChatRoom
+from app.db.models.user import User
+from app.db.session import dialect_insert
+from app.services.chat_hub import hub
+from app.services.membership import membership
+
+# users per bulk add or remove
+MAX_BULK_MEMBERS = 1000
+
+ADDED = "added"
+ALREADY_MEMBER = "already_member"
+REMOVED = "removed"
+NOT_MEMBER = "not_member"
+USER_NOT_FOUND = "user_not_found"
+
+
+async def create_room(db: AsyncSession, name, is_group: bool):
+    """Insert a room and return its row, nothing else is loaded back."""
+    result = await db.execute(
+        insert(ChatRoom).values(name=name, is_group=is_group, member_count=0)
+        .returning(ChatRoom.id, ChatRoom.name, ChatRoom.is_group, ChatRoom.created_at))
+    return result.one()
+
+
+async def insert_participants(db: AsyncSession, chat_id: int, user_ids) -> list:
+    """Insert memberships of existing users, skipping current members.
+
+    One INSERT ... ON CONFLICT DO NOTHING backed by the unique
+    (chat_id, user_id) index, then one update of the room's member count.
+    Returns the new ChatParticipant rows. The caller commits.
+    """
+    rows = [{"chat_id": chat_id, "user_id": user_id} for user_id in sorted(set(user_ids))]
+    if not rows:
+        return []
+    result = await db.execute(
+        dialect_insert(db)(ChatParticipant).values(rows)
+        .on_conflict_do_nothing(index_elements=["chat_id", "user_id"])
+        .returning(ChatParticipant))
+    added = list(result.scalars())
+    if added:
+        await db.execute(
+            update(ChatRoom).where(ChatRoom.id == chat_id)
+            .values(member_count=ChatRoom.member_count + len(added)))
+    return added
+
+
+async def add_members(db: AsyncSession, chat_id: int, user_ids) -> dict:
+    """user_id -> ADDED, ALREADY_MEMBER or USER_NOT_FOUND, the caller commits."""
+    user_ids = list(dict.fromkeys(user_ids))
+    result = await db.execute(select(User.id).where(User.id.in_(user_ids)))
+    existing = set(result.scalars())
+    added = {participant.user_id for participant in await insert_participants(db, chat_id, existing)}
+    return {
+        user_id: ADDED if user_id in added else ALREADY_MEMBER if user_id in existing else USER_NOT_FOUND
+        for user_id in user_ids
+    }
+
+
+async def remove_members(db: AsyncSession, chat_id: int, user_ids) -> dict:
+    """user_id -> REMOVED or NOT_MEMBER, the caller commits."""
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    result = await db.execute(
+        delete(ChatParticipant)
+        .where(ChatParticipant.chat_id == chat_id, ChatParticipant.user_id.in_(user_ids))
+        .returning(ChatParticipant.user_id))
+    removed = set(result.scalars())
+    if removed:
+        await db.execute(
+            update(ChatRoom).where(ChatRoom.id == chat_id)
+            .values(member_count=ChatRoom.member_count - len(removed)))
+    return {user_id: REMOVED if user_id in removed else NOT_MEMBER for user_id in user_ids}
+
+
+async def announce_members(chat_id: int, results: dict):
+    """After commit: drop cached memberships and update live sockets."""
+    joined = [user_id for user_id, status in results.items() if status == ADDED]
+    left = [user_id for user_id, status in results.items() if status == REMOVED]
+    if not joined and not left:
+        return
+    await membership.invalidate_members(chat_id, joined + left)
+    await hub.publish_members(chat_id, joined=joined, left=left)
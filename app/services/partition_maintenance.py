@@ -0,0 +1,171 @@
+"""Background upkeep of the chat_messages partitions, and its command line.
+
+    python -m app.services.partition_maintenance ensure
+    python -m app.services.partition_maintenance archive [--dry-run]
+    python -m app.services.partition_maintenance migrate-legacy [--batch-size N]
+
+`migrate-legacy` moves rows left in chat_messages_legacy by the partitioning
+migration (when it ran with `-x defer_copy=true`) into the partitioned table
+in small transactions, then drops the legacy table.
+"""
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import text
+
+from app.core.config import settings
+from app.db.partitions import (LEGACY_TABLE, add_months, create_partition, ensure_partitions,
+                               legacy_months, legacy_table_exists, list_partitions, month_start,
+                               move_legacy_rows)
+from app.db.session import DATABASE_URL, engine
+from app.services.archive import message_archive
+
+logger = logging.getLogger(__name__)
+
+PARTITION_MONTHS_AHEAD = settings.partition_months_ahead
+PARTITION_MAINTENANCE_INTERVAL = settings.partition_maintenance_interval
+ARCHIVE_AFTER_MONTHS = settings.archive_after_months
+# arbitrary key, one maintenance run at a time across every process
+MAINTENANCE_LOCK_ID = 727_001
+
+
+class PartitionMaintenance:
+    """Creates upcoming partitions and archives old ones on an interval."""
+
+    def __init__(self, interval: float = PARTITION_MAINTENANCE_INTERVAL,
+                 months_ahead: int = PARTITION_MONTHS_AHEAD,
+                 archive_after_months: int = ARCHIVE_AFTER_MONTHS):
+        self.interval = interval
+        self.months_ahead = months_ahead
+        self.archive_after_months = archive_after_months
+        self._task = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0 and DATABASE_URL.startswith("postgresql")
+
+    async def start(self):
+        if self.enabled:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def run_once(self, archive: bool = True) -> dict:
+        """One pass, skipped when another process holds the maintenance lock."""
+        async with engine.connect() as lock_conn:
+            locked = (await lock_conn.execute(
+                text("SELECT pg_try_advisory_lock(:id)"), {"id": MAINTENANCE_LOCK_ID})).scalar()
+            await lock_conn.commit()
+            if not locked:
+                return {"skipped": True}
+            try:
+                async with engine.begin() as conn:
+                    today = (await conn.execute(text("SELECT localtimestamp"))).scalar()
+                    created = await ensure_partitions(conn, self.months_ahead, today)
+                archived = []
+                if archive:
+                    for month in await self.archivable_months(today):
+                        await message_archive.archive_partition(month)
+                        archived.append(month)
+            finally:
+                await lock_conn.execute(
+                    text("SELECT pg_advisory_unlock(:id)"), {"id": MAINTENANCE_LOCK_ID})
+                await lock_conn.commit()
+        return {"created": created, "archived": archived}
+
+    async def archivable_months(self, today) -> list:
+        if self.archive_after_months <= 0:
+            return []
+        cutoff = add_months(month_start(today), -self.archive_after_months)
+        async with engine.connect() as conn:
+            return [month for month in await list_partitions(conn)
+                    if add_months(month, 1) <= cutoff]
+
+    async def _run(self):
+        while True:
+            try:
+                result = await self.run_once()
+                if result.get("created") or result.get("archived"):
+                    logger.info("partition maintenance: %s", result)
+            except Exception:
+                logger.exception("partition maintenance failed")
+            await asyncio.sleep(self.interval)
+
+
+partition_maintenance = PartitionMaintenance()
+
+
+async def migrate_legacy(batch_size: int, drop: bool = True) -> int:
+    """Move every row of the legacy table into the partitioned one."""
+    async with engine.begin() as conn:
+        if not await legacy_table_exists(conn):
+            logger.info("%s does not exist, nothing to migrate", LEGACY_TABLE)
+            return 0
+        # partitions first, so old rows do not all land in the default one
+        for month in await legacy_months(conn):
+            await create_partition(conn, month)
+
+    moved = 0
+    while True:
+        async with engine.begin() as conn:
+            await conn.execute(text("SET LOCAL statement_timeout = 0"))
+            count = await move_legacy_rows(conn, batch_size)
+        if not count:
+            break
+        moved += count
+        logger.info("moved %d messages", moved)
+
+    if drop:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP TABLE {LEGACY_TABLE}"))
+            await conn.execute(text("ANALYZE chat_messages"))
+        logger.info("dropped %s", LEGACY_TABLE)
+    return moved
+
+
+async def _main(args):
+    try:
+        if args.command == "ensure":
+            logger.info("partitions: %s", await partition_maintenance.run_once(archive=False))
+        elif args.command == "archive":
+            async with engine.connect() as conn:
+                today = (await conn.execute(text("SELECT localtimestamp"))).scalar()
+            if args.dry_run:
+                logger.info("would archive %s", await partition_maintenance.archivable_months(today))
+            else:
+                logger.info("partitions: %s", await partition_maintenance.run_once())
+        else:
+            await migrate_legacy(args.batch_size, drop=not args.keep_legacy)
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("ensure", help="create this month's and upcoming partitions")
+    archive = commands.add_parser(
+        "archive", help="archive partitions older than ARCHIVE_AFTER_MONTHS")
+    archive.add_argument("--dry-run", action="store_true")
+    migrate = commands.add_parser(
+        "migrate-legacy", help=f"move rows from {LEGACY_TABLE} into the partitions")
+    migrate.add_argument("--batch-size", type=int, default=10000)
+    migrate.add_argument("--keep-legacy", action="store_true",
+                         help=f"keep the emptied {LEGACY_TABLE} table")
+    args = parser.parse_args()
+    logging.basicConfig()
+    logging.getLogger("app.services").setLevel(logging.INFO)
+    asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    main()
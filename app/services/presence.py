@@ -0,0 +1,300 @@
+import asyncio
+import logging
+import time
+
+from app.core.config import settings
+from app.core.serialization import dumps, loads
+from app.services.chat_hub import hub
+from app.services.pubsub import NODE_ID
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_TIMEOUT = settings.presence_timeout
+PRESENCE_AWAY_AFTER = settings.presence_away_after
+PRESENCE_SYNC_INTERVAL = settings.presence_sync_interval
+PRESENCE_ROOM_RATE = settings.presence_room_rate
+TYPING_TIMEOUT = settings.typing_timeout
+PRESENCE_CHANNEL = "presence"
+# user entries per presence notification, keeps payloads under the NOTIFY limit
+PRESENCE_CHUNK_SIZE = 300
+
+ONLINE = "online"
+AWAY = "away"
+OFFLINE = "offline"
+_RANK = {OFFLINE: 0, AWAY: 1, ONLINE: 2}
+
+
+class _SocketState:
+    __slots__ = ("connection", "last_seen", "last_active", "away", "heartbeats")
+
+    def __init__(self, connection, now: float):
+        self.connection = connection
+        self.last_seen = now
+        self.last_active = now
+        # set by the client, e.g. when its window loses focus
+        self.away = False
+        # only sockets that heartbeat are closed for being silent
+        self.heartbeats = False
+
+    def status(self, now: float) -> str:
+        if self.away or now - self.last_active > PRESENCE_AWAY_AFTER:
+            return AWAY
+        return ONLINE
+
+
+class _RoomUpdate:
+    """Presence and typing changes of one room waiting for the next flush."""
+
+    __slots__ = ("presence", "typing")
+
+    def __init__(self):
+        self.presence = {}
+        self.typing = {}
+
+
+class PresenceService:
+    """Online/away/offline per user and typing per room, kept in memory.
+
+    Each process tracks the sockets connected to it and shares every user's
+    local status on the presence channel, plus a full snapshot every
+    PRESENCE_SYNC_INTERVAL seconds. Entries of another process expire after
+    three missed snapshots, so users of a crashed process go offline.
+
+    Changes are not sent as they happen: they are collected per room and
+    flushed to the room's members at most PRESENCE_ROOM_RATE times per
+    second by each process, where later changes of a user replace earlier
+    ones. Typing only reaches the room when it starts or stops, repeated
+    typing events merely extend TYPING_TIMEOUT.
+    """
+
+    def __init__(self, room_rate: float = PRESENCE_ROOM_RATE):
+        self.room_rate = room_rate
+        # user_id -> {connection: _SocketState} for sockets on this process
+        self._sockets = {}
+        # user_id -> status last announced by this process
+        self._local = {}
+        # user_id -> {node_id: (status, expires_at)} announced by other processes
+        self._remote = {}
+        # (chat_id, user_id) -> monotonic deadline of the typing indicator
+        self._typing = {}
+        self._rooms = {}
+        self._announce = {}
+        self._pubsub = None
+        self._task = None
+        self.changes = 0
+        self.room_frames = 0
+
+    async def start(self, pubsub):
+        self._pubsub = pubsub
+        await pubsub.subscribe(PRESENCE_CHANNEL, self._on_presence)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        # tell the other processes our users are gone
+        users = [[user_id, OFFLINE] for user_id in self._local]
+        self._local.clear()
+        await self._publish_users(users)
+        await self._pubsub.unsubscribe(PRESENCE_CHANNEL, self._on_presence)
+
+    def connect(self, connection):
+        """Track a socket, after hub.connect so the user's rooms are known."""
+        self._sockets.setdefault(connection.user_id, {})[connection] = \
+            _SocketState(connection, time.monotonic())
+        self._refresh(connection.user_id, time.monotonic())
+
+    def disconnect(self, connection):
+        """Forget a socket, before hub.disconnect drops the user's rooms."""
+        user_id = connection.user_id
+        sockets = self._sockets.get(user_id)
+        if sockets is None or sockets.pop(connection, None) is None:
+            return
+        if not sockets:
+            del self._sockets[user_id]
+            for key in [key for key in self._typing if key[1] == user_id]:
+                del self._typing[key]
+                self._room(key[0]).typing[user_id] = False
+        self._refresh(user_id, time.monotonic())
+
+    def touch(self, connection, active: bool = True):
+        """Any frame from the client proves the socket alive, non heartbeat
+        frames also count as activity."""
+        state = self._state(connection)
+        if state is None:
+            return
+        now = time.monotonic()
+        state.last_seen = now
+        if active:
+            was_idle = now - state.last_active > PRESENCE_AWAY_AFTER
+            state.last_active = now
+            if was_idle:
+                self._refresh(connection.user_id, now)
+
+    def heartbeat(self, connection, status: str = None):
+        state = self._state(connection)
+        if state is None:
+            return
+        state.heartbeats = True
+        self.touch(connection, active=False)
+        if status not in (ONLINE, AWAY):
+            return
+        state.away = status == AWAY
+        if not state.away:
+            state.last_active = state.last_seen
+        self._refresh(connection.user_id, state.last_seen)
+
+    def typing(self, connection, chat_id: int, is_typing: bool = True):
+        self.touch(connection)
+        key = (chat_id, connection.user_id)
+        if is_typing:
+            if key not in self._typing:
+                self._room(chat_id).typing[connection.user_id] = True
+            self._typing[key] = time.monotonic() + TYPING_TIMEOUT
+        else:
+            self.stop_typing(chat_id, connection.user_id)
+
+    def stop_typing(self, chat_id: int, user_id: int):
+        """Clear the indicator, e.g. once the user's message was sent."""
+        if self._typing.pop((chat_id, user_id), None) is not None:
+            self._room(chat_id).typing[user_id] = False
+
+    def status(self, user_id: int) -> str:
+        best = self._local.get(user_id, OFFLINE)
+        now = time.monotonic()
+        for status, expires_at in self._remote.get(user_id, {}).values():
+            if expires_at > now and _RANK[status] > _RANK[best]:
+                best = status
+        return best
+
+    def bulk(self, user_ids) -> dict:
+        """user_id -> status of every user in `user_ids` that is not offline."""
+        statuses = {}
+        for user_id in user_ids:
+            status = self.status(user_id)
+            if status != OFFLINE:
+                statuses[user_id] = status
+        return statuses
+
+    def stats(self) -> dict:
+        return {
+            "local_users": len(self._local),
+            "local_sockets": sum(len(sockets) for sockets in self._sockets.values()),
+            "remote_users": len(self._remote),
+            "typing": len(self._typing),
+            "changes": self.changes,
+            "room_frames": self.room_frames,
+        }
+
+    def _state(self, connection):
+        return self._sockets.get(connection.user_id, {}).get(connection)
+
+    def _room(self, chat_id: int) -> _RoomUpdate:
+        update = self._rooms.get(chat_id)
+        if update is None:
+            update = self._rooms[chat_id] = _RoomUpdate()
+        return update
+
+    def _refresh(self, user_id: int, now: float):
+        """Recompute a user's local status and queue the change, if any."""
+        sockets = self._sockets.get(user_id)
+        local = OFFLINE
+        if sockets:
+            local = max((state.status(now) for state in sockets.values()), key=_RANK.get)
+        previous = self._local.get(user_id, OFFLINE)
+        if local == previous:
+            return
+        before = self.status(user_id)
+        if local == OFFLINE:
+            del self._local[user_id]
+        else:
+            self._local[user_id] = local
+        self._announce[user_id] = local
+        after = self.status(user_id)
+        if after != before:
+            self.changes += 1
+            for chat_id in hub.registry.rooms_of(user_id):
+                self._room(chat_id).presence[user_id] = after
+
+    async def _run(self):
+        tick = 1 / self.room_rate
+        next_sweep = next_sync = time.monotonic()
+        while True:
+            try:
+                now = time.monotonic()
+                if now >= next_sweep:
+                    self._sweep(now)
+                    next_sweep = now + 1
+                if now >= next_sync:
+                    await self._publish_users(
+                        [[user_id, status] for user_id, status in self._local.items()])
+                    next_sync = now + PRESENCE_SYNC_INTERVAL
+                await self._flush()
+            except Exception:
+                logger.exception("presence flush failed")
+            await asyncio.sleep(tick)
+
+    def _sweep(self, now: float):
+        for user_id, sockets in list(self._sockets.items()):
+            for state in sockets.values():
+                if (state.heartbeats and PRESENCE_TIMEOUT > 0
+                        and now - state.last_seen > PRESENCE_TIMEOUT):
+                    # the receive loop ends and calls disconnect
+                    state.connection.close()
+            self._refresh(user_id, now)
+        for key, deadline in list(self._typing.items()):
+            if deadline <= now:
+                del self._typing[key]
+                self._room(key[0]).typing[key[1]] = False
+        for user_id, nodes in list(self._remote.items()):
+            for node, (_, expires_at) in list(nodes.items()):
+                if expires_at <= now:
+                    del nodes[node]
+            if not nodes:
+                del self._remote[user_id]
+
+    async def _flush(self):
+        announce, self._announce = self._announce, {}
+        if announce:
+            await self._publish_users([[user_id, status] for user_id, status in announce.items()])
+        rooms, self._rooms = self._rooms, {}
+        for chat_id, update in rooms.items():
+            event = {"type": "presence", "chat_id": chat_id}
+            if update.presence:
+                event["presence"] = [{"user_id": user_id, "status": status}
+                                     for user_id, status in update.presence.items()]
+            if update.typing:
+                event["typing"] = [{"user_id": user_id, "typing": typing}
+                                   for user_id, typing in update.typing.items()]
+            await hub.publish_message(chat_id, None, event)
+            self.room_frames += 1
+
+    async def _publish_users(self, users: list):
+        for start in range(0, len(users), PRESENCE_CHUNK_SIZE):
+            await self._pubsub.publish(PRESENCE_CHANNEL, dumps(
+                {"node": NODE_ID, "users": users[start:start + PRESENCE_CHUNK_SIZE]}).decode())
+
+    def _on_presence(self, channel: str, payload: str):
+        event = loads(payload)
+        node = event["node"]
+        if node == NODE_ID:
+            return
+        expires_at = time.monotonic() + 3 * PRESENCE_SYNC_INTERVAL
+        for user_id, status in event["users"]:
+            if status == OFFLINE:
+                nodes = self._remote.get(user_id)
+                if nodes is not None:
+                    nodes.pop(node, None)
+                    if not nodes:
+                        del self._remote[user_id]
+            else:
+                self._remote.setdefault(user_id, {})[node] = (status, expires_at)
+
+
+presence = PresenceService()
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+import uuid
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+PUBSUB_BACKEND = settings.pubsub_backend
+# identifies this process in events shared with the other ones
+NODE_ID = uuid.uuid4().hex[:12]
+# postgres rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 7999
+
+
+class PubSub:
+    """Channel based publish/subscribe shared by every backend.
+
+    Callbacks are plain functions taking (channel, payload) and are called on
+    the event loop, so they must not block.
+    """
+
+    def __init__(self):
+        self._callbacks = {}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        self._callbacks.clear()
+
+    async def publish(self, channel: str, payload: str):
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, callback):
+        callbacks = self._callbacks.get(channel)
+        if callbacks is None:
+            callbacks = self._callbacks[channel] = set()
+            await self._listen(channel)
+        callbacks.add(callback)
+
+    async def unsubscribe(self, channel: str, callback):
+        callbacks = self._callbacks.get(channel)
+        if callbacks is None:
+            return
+        callbacks.discard(callback)
+        if not callbacks:
+            del self._callbacks[channel]
+            await self._unlisten(channel)
+
+    async def _listen(self, channel: str):
+        pass
+
+    async def _unlisten(self, channel: str):
+        pass
+
+    def _dispatch(self, channel: str, payload: str):
+        for callback in list(self._callbacks.get(channel, ())):
+            try:
+                callback(channel, payload)
+            except Exception:
+                logger.exception("pubsub callback failed on %s", channel)
+
+
+class InMemoryPubSub(PubSub):
+    """Single process backend, also the default for tests and local runs."""
+
+    async def publish(self, channel: str, payload: str):
+        self._dispatch(channel, payload)
+
+
+class PostgresPubSub(PubSub):
+    """Backend on top of postgres LISTEN/NOTIFY.
+
+    Uses two dedicated asyncpg connections outside the SQLAlchemy pool, one
+    that only listens and one for NOTIFY, and re-LISTENs every channel after
+    reconnecting. Notifications sent while disconnected are lost.
+    """
+
+    def __init__(self, dsn: str):
+        super().__init__()
+        self.dsn = dsn
+        self._listen_conn = None
+        self._notify_conn = None
+        self._notify_lock = asyncio.Lock()
+        # an asyncpg connection runs one command at a time
+        self._listen_lock = asyncio.Lock()
+        self._stopping = False
+
+    async def start(self):
+        import asyncpg
+
+        self._stopping = False
+        self._listen_conn = await asyncpg.connect(self.dsn)
+        self._listen_conn.add_termination_listener(self._on_terminated)
+        self._notify_conn = await asyncpg.connect(self.dsn)
+        for channel in self._callbacks:
+            await self._listen(channel)
+
+    async def stop(self):
+        self._stopping = True
+        for conn in (self._listen_conn, self._notify_conn):
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        self._listen_conn = self._notify_conn = None
+        await super().stop()
+
+    async def publish(self, channel: str, payload: str):
+        if len(payload.encode()) > NOTIFY_PAYLOAD_LIMIT:
+            raise ValueError("Payload too large for postgres NOTIFY")
+        async with self._notify_lock:
+            if self._notify_conn is None or self._notify_conn.is_closed():
+                import asyncpg
+                self._notify_conn = await asyncpg.connect(self.dsn)
+            await self._notify_conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+
+    async def _listen(self, channel: str):
+        async with self._listen_lock:
+            if self._listen_conn is not None and not self._listen_conn.is_closed():
+                await self._listen_conn.add_listener(channel, self._on_notify)
+
+    async def _unlisten(self, channel: str):
+        async with self._listen_lock:
+            if self._listen_conn is not None and not self._listen_conn.is_closed():
+                await self._listen_conn.remove_listener(channel, self._on_notify)
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self._dispatch(channel, payload)
+
+    def _on_terminated(self, connection):
+        if not self._stopping:
+            logger.warning("pubsub listener connection lost, reconnecting")
+            asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        import asyncpg
+
+        delay = 0.5
+        while not self._stopping:
+            try:
+                self._listen_conn = await asyncpg.connect(self.dsn)
+                self._listen_conn.add_termination_listener(self._on_terminated)
+                for channel in list(self._callbacks):
+                    await self._listen(channel)
+                return
+            except Exception:
+                logger.exception("pubsub reconnect failed")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+
+
+def create_pubsub() -> PubSub:
+    if PUBSUB_BACKEND == "postgres":
+        # asyncpg wants a plain libpq url, not the SQLAlchemy dialect form
+        dsn = settings.database_url.replace("postgresql+asyncpg://", "postgresql://")
+        return PostgresPubSub(dsn)
+    return InMemoryPubSub()
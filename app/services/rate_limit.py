@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from sqlalchemy import delete, func, text
+
+from app.core.config import settings
+from app.db.models.rate_limit import RateLimitBucket
+from app.db.session import engine
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMITING = settings.rate_limiting
+RATE_LIMIT_BACKEND = settings.rate_limit_backend
+RATE_LIMIT_SHARDS = settings.rate_limit_shards
+RATE_LIMIT_MAX_KEYS = settings.rate_limit_max_keys
+# seconds between deletes of expired rows of the postgres backend
+RATE_LIMIT_PRUNE_INTERVAL = 60
+
+_PERIODS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+
+# limits by name, per client IP unless the name says otherwise;
+# RATE_LIMITS="auth.login=20/minute,auth.register=off" overrides them
+DEFAULT_LIMITS = {
+    # every HTTP request and websocket handshake, per process
+    "global": "600/minute",
+    "auth.login": "20/minute",
+    # per username, against guessing one account's password from many IPs
+    "auth.login.user": "10/minute",
+    "auth.register": "10/hour",
+    "auth.refresh": "60/minute",
+}
+
+
+@dataclass(frozen=True)
+class Limit:
+    """At most `count` hits per `period` seconds, all of them in a burst."""
+
+    count: int
+    period: float
+
+    @property
+    def interval(self) -> float:
+        return self.period / self.count
+
+
+def parse_limit(value: str):
+    """'10/minute' -> Limit(10, 60), 'off' or '' -> None."""
+    value = value.strip().lower()
+    if value in ("", "off", "none"):
+        return None
+    count, _, unit = value.partition("/")
+    if unit not in _PERIODS or int(count) <= 0:
+        raise ValueError(f"Invalid rate limit {value!r}, expected e.g. 10/minute")
+    return Limit(int(count), _PERIODS[unit])
+
+
+def configured_limits(overrides: str = settings.rate_limits) -> dict:
+    values = dict(DEFAULT_LIMITS)
+    for item in filter(None, (part.strip() for part in overrides.split(","))):
+        name, _, value = item.partition("=")
+        values[name.strip()] = value
+    return {name: parse_limit(value) for name, value in values.items()}
+
+
+class RateLimiter:
+    """Token bucket per key, evaluated as GCRA.
+
+    Each key keeps a single number, its theoretical arrival time (tat): the
+    moment its bucket is full again. A hit costing n moves tat n intervals
+    forward and is refused when that would put tat more than one period
+    ahead of now. Backends only differ in where tat is stored.
+    """
+
+    def __init__(self, limits: dict = None):
+        self.limits = configured_limits() if limits is None else limits
+        self.allowed = 0
+        self.limited = {}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def hit(self, name: str, key: str, cost: int = 1) -> float:
+        """Count a hit of `key` against the limit `name`.
+
+        Returns 0 when allowed, else the seconds until it would be.
+        """
+        limit = self.limits.get(name)
+        if limit is None:
+            return 0.0
+        retry_after = await self._hit(f"{name}:{key}", limit, cost)
+        if retry_after > 0:
+            self.limited[name] = self.limited.get(name, 0) + 1
+        else:
+            self.allowed += 1
+        return retry_after
+
+    async def _hit(self, key: str, limit: Limit, cost: int) -> float:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {"allowed": self.allowed, "limited": dict(self.limited)}
+
+
+class MemoryRateLimiter(RateLimiter):
+    """Limits per process, each worker counts on its own.
+
+    Keys are spread over `shards` LRU dicts so each stays small, full
+    buckets are dropped as they reach the front and, past `max_keys`,
+    the least recently used key goes whatever its state.
+    """
+
+    def __init__(self, limits: dict = None, shards: int = RATE_LIMIT_SHARDS,
+                 max_keys: int = RATE_LIMIT_MAX_KEYS):
+        super().__init__(limits)
+        self._shards = [OrderedDict() for _ in range(shards)]
+        self._shard_size = max(1, max_keys // shards)
+
+    async def _hit(self, key: str, limit: Limit, cost: int) -> float:
+        return self.check(key, limit, cost, time.monotonic())
+
+    def check(self, key: str, limit: Limit, cost: int, now: float) -> float:
+        shard = self._shards[hash(key) % len(self._shards)]
+        tat = max(shard.get(key, now), now) + cost * limit.interval
+        if tat - now > limit.period:
+            return tat - now - limit.period
+        shard[key] = tat
+        shard.move_to_end(key)
+        # the oldest entries are the likeliest to be full already
+        while shard:
+            oldest, oldest_tat = next(iter(shard.items()))
+            if oldest_tat > now and len(shard) <= self._shard_size:
+                break
+            del shard[oldest]
+        return 0.0
+
+    def stats(self) -> dict:
+        return {**super().stats(), "keys": sum(len(shard) for shard in self._shards)}
+
+
+class PostgresRateLimiter(RateLimiter):
+    """Limits shared by every worker through the rate_limit_buckets table.
+
+    One upsert per hit, the row lock serializes concurrent hits of a key.
+    The table is unlogged, buckets reset if postgres crashes. If the
+    database cannot be reached hits are allowed, logins fail anyway then.
+    """
+
+    # tat only moves when the hit is allowed, no row comes back otherwise
+    _HIT = text("""
+        INSERT INTO rate_limit_buckets AS b (key, tat)
+        VALUES (:key, extract(epoch FROM clock_timestamp()) + :increment)
+        ON CONFLICT (key) DO UPDATE
+        SET tat = greatest(b.tat, extract(epoch FROM clock_timestamp())) + :increment
+        WHERE greatest(b.tat, extract(epoch FROM clock_timestamp())) + :increment
+              - extract(epoch FROM clock_timestamp()) <= :period
+        RETURNING tat
+    """)
+    _RETRY_AFTER = text("""
+        SELECT greatest(tat, extract(epoch FROM clock_timestamp())) + :increment
+               - extract(epoch FROM clock_timestamp()) - :period
+        FROM rate_limit_buckets WHERE key = :key
+    """)
+
+    def __init__(self, limits: dict = None):
+        super().__init__(limits)
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._prune())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _hit(self, key: str, limit: Limit, cost: int) -> float:
+        params = {"key": key, "increment": cost * limit.interval, "period": limit.period}
+        try:
+            async with engine.begin() as conn:
+                if (await conn.execute(self._HIT, params)).first() is not None:
+                    return 0.0
+                retry_after = (await conn.execute(self._RETRY_AFTER, params)).scalar()
+        except Exception:
+            logger.warning("rate limit check failed, allowing %s", key, exc_info=True)
+            return 0.0
+        return max(float(retry_after or 0), 0.001)
+
+    async def _prune(self):
+        while True:
+            await asyncio.sleep(RATE_LIMIT_PRUNE_INTERVAL)
+            try:
+                async with engine.begin() as conn:
+                    # a bucket whose tat has passed is full, same as no row
+                    await conn.execute(delete(RateLimitBucket).where(
+                        RateLimitBucket.tat < func.extract("epoch", func.clock_timestamp())))
+            except Exception:
+                logger.exception("rate limit pruning failed")
+
+
+class TokenBucket:
+    """A plain token bucket, e.g. for the frames of one websocket."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, cost: float = 1) -> float:
+        """Take `cost` tokens, returns 0 or the seconds until there are enough."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+def create_rate_limiters():
+    """(limiter for the routes, in-process limiter for every request)."""
+    if not RATE_LIMITING:
+        disabled = RateLimiter(limits={})
+        return disabled, disabled
+    local = MemoryRateLimiter()
+    if RATE_LIMIT_BACKEND == "postgres":
+        return PostgresRateLimiter(), local
+    return local, local
+
+
+# the global limit always counts per process, a shared backend would add a
+# query to every request
+rate_limiter, local_rate_limiter = create_rate_limiters()
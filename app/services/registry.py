@@ -0,0 +1,105 @@
+class ConnectionRegistry:
+    """Sockets of this process indexed by user and by room.
+
+    Holds user_id -> connections, chat_id -> online user_ids and
+    user_id -> chat_ids, all sets, so adding or removing a socket and joining
+    a room are O(1). Only users with a local socket appear in a room, so
+    fanning out to a room never walks offline participants.
+    """
+
+    __slots__ = ("connections", "rooms", "user_rooms", "opened", "closed")
+
+    def __init__(self):
+        self.connections = {}
+        self.rooms = {}
+        self.user_rooms = {}
+        self.opened = 0
+        self.closed = 0
+
+    def add(self, connection) -> bool:
+        """Register a socket, True if it is the user's first one here."""
+        self.opened += 1
+        sockets = self.connections.get(connection.user_id)
+        if sockets is None:
+            self.connections[connection.user_id] = {connection}
+            self.user_rooms[connection.user_id] = set()
+            return True
+        sockets.add(connection)
+        return False
+
+    def remove(self, connection):
+        """Unregister a socket, safe to call more than once.
+
+        Returns None while the user keeps another socket here, else the
+        chat_ids left without any online member.
+        """
+        user_id = connection.user_id
+        sockets = self.connections.get(user_id)
+        if sockets is None or connection not in sockets:
+            return None
+        self.closed += 1
+        sockets.discard(connection)
+        if sockets:
+            return None
+        del self.connections[user_id]
+        empty_rooms = []
+        for chat_id in self.user_rooms.pop(user_id, ()):
+            members = self.rooms.get(chat_id)
+            if members is None:
+                continue
+            members.discard(user_id)
+            if not members:
+                del self.rooms[chat_id]
+                empty_rooms.append(chat_id)
+        return empty_rooms
+
+    def join(self, user_id: int, chat_id: int) -> bool:
+        """Add a connected user to a room, True if the room was empty here."""
+        rooms = self.user_rooms.get(user_id)
+        if rooms is None or chat_id in rooms:
+            return False
+        rooms.add(chat_id)
+        members = self.rooms.get(chat_id)
+        if members is None:
+            self.rooms[chat_id] = {user_id}
+            return True
+        members.add(user_id)
+        return False
+
+    def leave(self, user_id: int, chat_id: int) -> bool:
+        """Remove a user from a room, True if nobody is left in it here."""
+        rooms = self.user_rooms.get(user_id)
+        if rooms is None or chat_id not in rooms:
+            return False
+        rooms.discard(chat_id)
+        members = self.rooms[chat_id]
+        members.discard(user_id)
+        if members:
+            return False
+        del self.rooms[chat_id]
+        return True
+
+    def is_connected(self, user_id: int) -> bool:
+        return user_id in self.connections
+
+    def in_room(self, user_id: int, chat_id: int) -> bool:
+        return chat_id in self.user_rooms.get(user_id, ())
+
+    def rooms_of(self, user_id: int):
+        return self.user_rooms.get(user_id, ())
+
+    def recipients(self, chat_id: int, exclude: str = None) -> list:
+        """Every local socket of the room's online members but `exclude`."""
+        return [connection
+                for user_id in self.rooms.get(chat_id, ())
+                for connection in self.connections[user_id] if connection.id != exclude]
+
+    def stats(self) -> dict:
+        return {
+            "connections": self.opened - self.closed,
+            "users": len(self.connections),
+            "rooms": len(self.rooms),
+            "room_members": sum(len(members) for members in self.rooms.values()),
+            "opened": self.opened,
+            "closed": self.closed,
+        }
@@ -0,0 +1,81 @@
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import func, literal_column, select, tuple_
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.pagination import decode_cursor, encode_cursor
+from app.db.models.chat import SEARCH_CONFIG, ChatMessage
+
+# generated column maintained by Postgres, not mapped on ChatMessage so
+# regular message loads never fetch it
+search_vector = literal_column("chat_messages.search_vector", TSVECTOR)
+
+SEARCH_ORDERS = ("relevance", "recent")
+HEADLINE_OPTIONS = "StartSel=<mark>, StopSel=</mark>, MaxWords=35, MinWords=15, MaxFragments=2"
+
+
+def _escape_html(text):
+    """The SQL expression of `text` with & < > escaped, the parser skips
+    the entities so the headline marks the same words."""
+    for char, entity in (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;")):
+        text = func.replace(text, char, entity)
+    return text
+
+
+async def search_messages(db: AsyncSession, chat_ids, q: str, order: str = "relevance",
+                          cursor: Optional[str] = None, limit: int = 20) -> dict:
+    """One page of messages matching `q` in the given chats.
+
+    The chats are passed as a list rather than joined from chat_participants
+    so the planner can weigh them against the term: rare terms come from the
+    GIN index on search_vector, common terms in a few chats from the history
+    index on chat_id. Pages are keyset paginated on (rank, id) or
+    (created_at, id) depending on `order`, only the page is highlighted.
+    """
+    if order not in SEARCH_ORDERS:
+        raise HTTPException(status_code=400, detail=f"order must be one of {', '.join(SEARCH_ORDERS)}")
+    if not chat_ids:
+        return {"hits": [], "next": None}
+    query_ts = func.websearch_to_tsquery(literal_column(f"'{SEARCH_CONFIG}'"), q)
+    rank = func.ts_rank(search_vector, query_ts).label("rank")
+
+    matches = (
+        select(ChatMessage.id, ChatMessage.chat_id, ChatMessage.sender_id,
+               ChatMessage.message, ChatMessage.created_at, ChatMessage.seq, rank)
+        .filter(ChatMessage.chat_id.in_(sorted(chat_ids)),
+                search_vector.op("@@")(query_ts))
+    )
+
+    if order == "relevance":
+        if cursor:
+            last_rank, last_id = decode_cursor(cursor, 2)
+            matches = matches.filter(
+                tuple_(rank, ChatMessage.id) < tuple_(float(last_rank), int(last_id)))
+        matches = matches.order_by(rank.desc(), ChatMessage.id.desc())
+    else:
+        if cursor:
+            created_at, last_id = decode_cursor(cursor, 2)
+            matches = matches.filter(tuple_(ChatMessage.created_at, ChatMessage.id) <
+                                     tuple_(datetime.fromisoformat(created_at), int(last_id)))
+        matches = matches.order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+
+    # fetch one extra row to learn whether there is a next page
+    page = matches.limit(limit + 1).subquery()
+    # highlight is HTML, only the <mark> tags may come through unescaped
+    headline = func.ts_headline(literal_column(f"'{SEARCH_CONFIG}'"),
+                                _escape_html(page.c.message), query_ts, HEADLINE_OPTIONS)
+    ordering = ((page.c.rank.desc(), page.c.id.desc()) if order == "relevance"
+                else (page.c.created_at.desc(), page.c.id.desc()))
+    rows = (await db.execute(
+        select(page, headline.label("highlight")).order_by(*ordering))).all()
+
+    hits = [row._asdict() for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = hits[-1]
+        next_cursor = encode_cursor(
+            last["rank"] if order == "relevance" else last["created_at"], last["id"])
+    return {"hits": hits, "next": next_cursor}
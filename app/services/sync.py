@@ -0,0 +1,197 @@
+from collections import OrderedDict, deque
+from datetime import timedelta
+
+from sqlalchemy import union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.config import settings
+from app.core.pagination import encode_cursor
+from app.db.models.chat import ChatMessage, ChatRoom
+
+SYNC_BUFFER_SIZE = settings.sync_buffer_size
+SYNC_BUFFER_ROOMS = settings.sync_buffer_rooms
+SYNC_MAX_MESSAGES = settings.sync_max_messages
+SYNC_MAX_PER_ROOM = settings.sync_max_per_room
+# rooms per catch-up statement
+SYNC_QUERY_ROOMS = 100
+# ids are taken at insert time but created_at is the transaction's start,
+# a message after the cursor may be this much older than it
+SYNC_CLOCK_SLACK = timedelta(minutes=10)
+
+
+def parse_cursors(cursors: str) -> dict:
+    """"12:41,15:7" -> {12: 41, 15: 7}, chat_id:seq pairs, raises ValueError."""
+    per_room = {}
+    for item in filter(None, (part.strip() for part in cursors.split(","))):
+        chat_id, _, message_id = item.partition(":")
+        per_room[int(chat_id)] = int(message_id)
+    return per_room
+
+
+class RecentMessages:
+    """The last SYNC_BUFFER_SIZE messages of each room this process is
+    subscribed to, fed by the hub as they are delivered.
+
+    A room's buffer only holds what arrived since the subscription began, so
+    it answers for a cursor only when it reaches back to the cursor, meaning
+    nothing after the cursor can be missing. The hub
+    drops the buffer when it unsubscribes, and past SYNC_BUFFER_ROOMS rooms
+    the least recently written one goes.
+    """
+
+    def __init__(self, size: int = SYNC_BUFFER_SIZE, max_rooms: int = SYNC_BUFFER_ROOMS):
+        self.size = size
+        self.max_rooms = max_rooms
+        self._rooms = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, chat_id: int, message: dict):
+        buffer = self._rooms.get(chat_id)
+        if buffer is None:
+            if len(self._rooms) >= self.max_rooms:
+                self._rooms.popitem(last=False)
+            buffer = self._rooms[chat_id] = deque(maxlen=self.size)
+        else:
+            self._rooms.move_to_end(chat_id)
+        buffer.append(message)
+
+    def drop(self, chat_id: int):
+        self._rooms.pop(chat_id, None)
+
+    def after(self, chat_id: int, key: str, cursor: int, limit: int):
+        """(newest `limit` messages whose `key`, seq or id, is past `cursor`,
+        truncated) or None when the buffer cannot vouch for all of them."""
+        buffer = self._rooms.get(chat_id)
+        # seqs have no gaps, the message right after the cursor is enough
+        reach = cursor + 1 if key == "seq" else cursor
+        if not buffer or buffer[0][key] is None or buffer[0][key] > reach:
+            self.misses += 1
+            return None
+        self.hits += 1
+        messages = [message for message in buffer if message[key] > cursor]
+        return messages[-limit:], len(messages) > limit
+
+    def stats(self) -> dict:
+        return {
+            "rooms": len(self._rooms),
+            "messages": sum(len(buffer) for buffer in self._rooms.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _message_dict(row) -> dict:
+    return {
+        "id": row.id,
+        "chat_id": row.chat_id,
+        "sender_id": row.sender_id,
+        "message": row.message,
+        "created_at": row.created_at,
+        "seq": row.seq,
+    }
+
+
+async def _floors(db: AsyncSession, message_ids) -> dict:
+    """message id -> its created_at less the slack, a lower bound that lets
+    a range scan by id stop and prune partitions."""
+    if not message_ids:
+        return {}
+    result = await db.execute(
+        select(ChatMessage.id, ChatMessage.created_at).where(ChatMessage.id.in_(set(message_ids))))
+    return {row.id: row.created_at - SYNC_CLOCK_SLACK for row in result}
+
+
+async def _load(db: AsyncSession, wanted: list) -> dict:
+    """chat_id -> newest messages past its cursor, limit + 1 of them at
+    most, for [(chat_id, key, cursor, limit)], one statement per chunk of
+    rooms."""
+    floors = await _floors(db, [cursor for _, key, cursor, _ in wanted if key == "id"])
+    columns = (ChatMessage.id, ChatMessage.chat_id, ChatMessage.sender_id,
+               ChatMessage.message, ChatMessage.created_at, ChatMessage.seq)
+    loaded = {chat_id: [] for chat_id, _, _, _ in wanted}
+    for start in range(0, len(wanted), SYNC_QUERY_ROOMS):
+        queries = []
+        for chat_id, key, cursor, limit in wanted[start:start + SYNC_QUERY_ROOMS]:
+            query = select(*columns).where(ChatMessage.chat_id == chat_id)
+            if key == "seq":
+                # newest first along the (chat_id, seq) index
+                query = query.where(ChatMessage.seq > cursor).order_by(ChatMessage.seq.desc())
+            else:
+                query = query.where(ChatMessage.id > cursor)
+                if cursor in floors:
+                    query = query.where(ChatMessage.created_at >= floors[cursor])
+                # newest first along the (chat_id, created_at, id) index
+                query = query.order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+            queries.append(select(query.limit(limit + 1).subquery()))
+        result = await db.execute(union_all(*queries) if len(queries) > 1 else queries[0])
+        for row in result:
+            loaded[row.chat_id].append(_message_dict(row))
+    return loaded
+
+
+async def catch_up(db: AsyncSession, recent: RecentMessages, chat_ids, since=None,
+                   cursors: dict = None) -> dict:
+    """The sync frame for a reconnecting client: the messages it missed in
+    each of `chat_ids`, past its seq cursor for the room or else past the
+    global message id `since`.
+
+    Rooms whose last message is not past the cursor cost nothing, the others
+    are served from `recent` when it covers the cursor and from the database
+    otherwise. Each room sends its newest SYNC_MAX_PER_ROOM messages and the
+    whole frame at most SYNC_MAX_MESSAGES; a room that had more is marked
+    truncated with a `before` cursor to page back through its history.
+    """
+    cursors = cursors or {}
+    wanted = {}
+    for chat_id in chat_ids:
+        if chat_id in cursors:
+            wanted[chat_id] = ("seq", cursors[chat_id])
+        elif since is not None:
+            wanted[chat_id] = ("id", since)
+    rooms = []
+    if wanted:
+        result = await db.execute(
+            select(ChatRoom.id, ChatRoom.last_message_id, ChatRoom.last_seq)
+            .where(ChatRoom.id.in_(list(wanted)), ChatRoom.last_message_id.is_not(None)))
+        # most recently active rooms first, they get the budget
+        behind = sorted(
+            ((row.last_message_id, row.id) for row in result
+             if (row.last_seq if wanted[row.id][0] == "seq" else row.last_message_id)
+             > wanted[row.id][1]),
+            reverse=True)
+        budget = SYNC_MAX_MESSAGES
+        missing = []
+        for _, chat_id in behind:
+            limit = min(SYNC_MAX_PER_ROOM, budget)
+            room = {"chat_id": chat_id, "messages": [], "truncated": limit == 0}
+            rooms.append(room)
+            if limit == 0:
+                continue
+            key, cursor = wanted[chat_id]
+            buffered = recent.after(chat_id, key, cursor, limit)
+            if buffered is None:
+                missing.append((chat_id, key, cursor, limit))
+                # counted against the budget as if full
+                budget -= limit
+                continue
+            room["messages"], room["truncated"] = buffered
+            budget -= len(room["messages"])
+        if missing:
+            loaded = await _load(db, missing)
+            limits = {chat_id: limit for chat_id, _, _, limit in missing}
+            for room in rooms:
+                messages = loaded.get(room["chat_id"])
+                if messages is None:
+                    continue
+                # UNION ALL keeps no order, oldest first like the history
+                messages.sort(key=lambda message: (message["seq"] or 0, message["id"]))
+                limit = limits[room["chat_id"]]
+                room["truncated"] = len(messages) > limit
+                room["messages"] = messages[-limit:]
+    for room in rooms:
+        if room["truncated"] and room["messages"]:
+            first = room["messages"][0]
+            room["before"] = encode_cursor(first["created_at"], first["id"])
+    return {"type": "sync", "rooms": rooms}
@@ -0,0 +1,104 @@
+import json
+from dataclasses import dataclass
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+from app.core.cache import TTLCache
+from app.core.config import settings
+from app.db.models.user import User
+
+USER_CACHE_SIZE = settings.user_cache_size
+USER_CACHE_TTL = settings.user_cache_ttl
+USERS_CHANNEL = "users"
+
+
+@dataclass(frozen=True, slots=True)
+class Principal:
+    """The authenticated user as seen by request handlers."""
+    id: int
+    username: str
+    is_verified: bool
+
+
+class UserCache:
+    """Principals of recently seen users, looked up by username or id.
+
+    Call `invalidate` after changing a user's row, it also reaches the other
+    processes through pub/sub.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self._by_username = TTLCache(max_size, ttl)
+        self._by_id = TTLCache(max_size, ttl)
+        self._pubsub = None
+
+    async def start(self, pubsub):
+        self._pubsub = pubsub
+        await pubsub.subscribe(USERS_CHANNEL, self._on_invalidate)
+
+    async def by_username(self, db: AsyncSession, username: str):
+        principal = self._by_username.get(username)
+        if principal is None:
+            principal = await self._load(db, User.username == username)
+        return principal
+
+    async def by_id(self, db: AsyncSession, user_id: int):
+        principal = self._by_id.get(user_id)
+        if principal is None:
+            principal = await self._load(db, User.id == user_id)
+        return principal
+
+    async def by_ids(self, db: AsyncSession, user_ids) -> dict:
+        """user id -> Principal of the ones that exist, one query for all
+        the ids not cached."""
+        found, missing = {}, set()
+        for user_id in user_ids:
+            principal = self._by_id.get(user_id)
+            if principal is None:
+                missing.add(user_id)
+            else:
+                found[user_id] = principal
+        if missing:
+            result = await db.execute(
+                select(User.id, User.username, User.is_verified).where(User.id.in_(missing)))
+            for row in result:
+                found[row.id] = self._remember(row)
+        return found
+
+    async def invalidate(self, user_id: int = None, username: str = None):
+        self._invalidate(user_id, username)
+        if self._pubsub is not None:
+            await self._pubsub.publish(
+                USERS_CHANNEL, json.dumps({"user_id": user_id, "username": username}))
+
+    def stats(self) -> dict:
+        return {"by_username": self._by_username.stats(), "by_id": self._by_id.stats()}
+
+    async def _load(self, db: AsyncSession, condition):
+        result = await db.execute(
+            select(User.id, User.username, User.is_verified).where(condition))
+        row = result.first()
+        if row is None:
+            return None
+        return self._remember(row)
+
+    def _remember(self, row) -> Principal:
+        principal = Principal(id=row.id, username=row.username,
+                              is_verified=bool(row.is_verified))
+        self._by_username.set(principal.username, principal)
+        self._by_id.set(principal.id, principal)
+        return principal
+
+    def _invalidate(self, user_id, username):
+        for principal in (self._by_id.pop(user_id), self._by_username.pop(username)):
+            if principal is not None:
+                self._by_id.pop(principal.id)
+                self._by_username.pop(principal.username)
+
+    def _on_invalidate(self, channel: str, payload: str):
+        event = json.loads(payload)
+        self._invalidate(event.get("user_id"), event.get("username"))
+
+
+user_cache = UserCache()
@@ -0,0 +1,164 @@
+"""Throughput of the outbound email queue against a local SMTP server.
+
+Starts an aiosmtpd server in-process, which can be made slow (--latency) and
+flaky (--fail-rate answers 451 to that share of messages, --bounce-rate 550),
+enqueues --emails rows into email_outbox of the configured Postgres database
+and runs an EmailDispatcher until the queue is drained. Reports throughput,
+end to end delay from enqueue to delivery, retries, dead letters and how many
+SMTP connections were opened. --inline instead sends every email the way
+registration used to: one connection per message, awaited in the request.
+
+    DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.bench_email \\
+        --emails 2000 --latency 0.05 --fail-rate 0.1
+
+Rows of the outbox are deleted before the run.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+import aiosmtplib
+from aiosmtpd.controller import Controller
+from sqlalchemy import delete, func, select
+
+from app.core.email import build_message, enqueue_email
+from app.db.models.base import Base
+from app.db.models.email import OutboundEmail
+from app.db.session import SessionLocal, engine
+from app.services.email_dispatcher import EmailDispatcher, SMTPPool
+from benchmarks.common import LoopLagMonitor, dump, percentiles
+
+
+class Handler:
+    def __init__(self, latency: float, fail_rate: float, bounce_rate: float):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.bounce_rate = bounce_rate
+        self.delivered = {}
+        self.rejected = 0
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        roll = random.random()
+        if roll < self.bounce_rate:
+            self.rejected += 1
+            return "550 mailbox unavailable"
+        if roll < self.bounce_rate + self.fail_rate:
+            self.rejected += 1
+            return "451 try again later"
+        subject = envelope.content.split(b"Subject: ", 1)[1].split(b"\r\n", 1)[0].decode()
+        self.delivered[subject] = time.perf_counter()
+        return "250 OK"
+
+
+async def run_queue(args, port, handler) -> dict:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with SessionLocal() as db:
+        await db.execute(delete(OutboundEmail))
+        await db.commit()
+
+    def factory():
+        return aiosmtplib.SMTP(hostname="127.0.0.1", port=port, timeout=args.send_timeout)
+
+    dispatcher = EmailDispatcher(pool=SMTPPool(args.pool_size, factory),
+                                 batch_size=args.batch_size, poll_interval=0.2,
+                                 send_timeout=args.send_timeout, max_attempts=args.max_attempts)
+    enqueued = {}
+    started = time.perf_counter()
+    async with LoopLagMonitor() as lag:
+        await dispatcher.start()
+        for first in range(0, args.emails, args.enqueue_batch):
+            async with SessionLocal() as db:
+                for n in range(first, min(args.emails, first + args.enqueue_batch)):
+                    enqueue_email(db, f"user{n}@example.com", f"bench {n}", "hello")
+                await db.commit()
+            now = time.perf_counter()
+            enqueued.update({f"bench {n}": now for n in range(first, first + args.enqueue_batch)})
+            dispatcher.notify()
+
+        while True:
+            async with SessionLocal() as db:
+                pending = (await db.execute(
+                    select(func.count()).where(OutboundEmail.status == "pending"))).scalar()
+            if not pending or time.perf_counter() - started > args.timeout:
+                break
+            await asyncio.sleep(0.1)
+        elapsed = time.perf_counter() - started
+        await dispatcher.stop()
+
+    async with SessionLocal() as db:
+        outbox = await dispatcher.queue_stats(db)
+    delays = [at - enqueued[subject] for subject, at in handler.delivered.items()]
+    return {
+        "mode": "queue",
+        "seconds": elapsed,
+        "emails_per_second": len(handler.delivered) / elapsed,
+        "delivery_delay": percentiles(delays),
+        "outbox": outbox,
+        "dispatcher": dispatcher.stats(),
+        "loop_lag": lag.report(),
+    }
+
+
+async def run_inline(args, port, handler) -> dict:
+    """One connection per email, awaited one after another like a request would."""
+    durations, errors = [], 0
+    started = time.perf_counter()
+    for n in range(args.emails):
+        sent_at = time.perf_counter()
+        try:
+            await aiosmtplib.send(build_message(f"user{n}@example.com", f"bench {n}", "hello"),
+                                  hostname="127.0.0.1", port=port, timeout=args.send_timeout)
+        except aiosmtplib.SMTPException:
+            errors += 1
+        durations.append(time.perf_counter() - sent_at)
+    elapsed = time.perf_counter() - started
+    return {
+        "mode": "inline",
+        "seconds": elapsed,
+        "emails_per_second": len(handler.delivered) / elapsed,
+        "send_latency": percentiles(durations),
+        "errors": errors,
+        "smtp_connects": args.emails,
+    }
+
+
+async def main(args):
+    handler = Handler(args.latency, args.fail_rate, args.bounce_rate)
+    controller = Controller(handler, hostname="127.0.0.1", port=args.smtp_port)
+    controller.start()
+    try:
+        if args.inline:
+            report = await run_inline(args, controller.port, handler)
+        else:
+            report = await run_queue(args, controller.port, handler)
+    finally:
+        controller.stop()
+        await engine.dispose()
+    report.update({"emails": args.emails, "delivered": len(handler.delivered),
+                   "rejected_by_server": handler.rejected})
+    dump(report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--emails", type=int, default=1000)
+    parser.add_argument("--enqueue-batch", type=int, default=100)
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=50)
+    parser.add_argument("--max-attempts", type=int, default=8)
+    parser.add_argument("--send-timeout", type=float, default=30)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds the SMTP server takes to accept a message")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="share of messages answered with a temporary 451")
+    parser.add_argument("--bounce-rate", type=float, default=0.0,
+                        help="share of messages answered with a permanent 550")
+    parser.add_argument("--smtp-port", type=int, default=8025)
+    parser.add_argument("--timeout", type=float, default=300,
+                        help="give up waiting for the queue to drain after this many seconds")
+    parser.add_argument("--inline", action="store_true")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,64 @@
+"""Event loop lag during a burst of concurrent logins.
+
+Compares verifying bcrypt hashes inline on the event loop, as login_user used
+to, with the bounded hashing pool in app.core.security.
+
+    python -m benchmarks.bench_password_hashing --logins 32
+"""
+import argparse
+import asyncio
+import time
+
+from app.core.security import (PasswordHasherBusy, hash_password,
+                               verify_password, verify_password_async)
+from benchmarks.common import LoopLagMonitor, dump, percentiles
+
+
+async def inline_login(hashed: str):
+    await asyncio.sleep(0)
+    return verify_password("correct horse", hashed)
+
+
+async def pooled_login(hashed: str):
+    return await verify_password_async("correct horse", hashed)
+
+
+async def run(mode: str, logins: int, hashed: str) -> dict:
+    login = inline_login if mode == "inline" else pooled_login
+    latencies = []
+    rejected = 0
+
+    async def one():
+        nonlocal rejected
+        started = time.perf_counter()
+        try:
+            await login(hashed)
+        except PasswordHasherBusy:
+            rejected += 1
+            return
+        latencies.append(time.perf_counter() - started)
+
+    async with LoopLagMonitor() as lag:
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(logins)))
+        elapsed = time.perf_counter() - started
+    return {
+        "logins": logins,
+        "rejected": rejected,
+        "seconds": elapsed,
+        "logins_per_second": len(latencies) / elapsed,
+        "latency": percentiles(latencies),
+        "event_loop_lag": lag.report(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--logins", type=int, default=32)
+    args = parser.parse_args()
+    hashed = hash_password("correct horse")
+    dump({mode: asyncio.run(run(mode, args.logins, hashed)) for mode in ("inline", "pool")})
+
+
+if __name__ == "__main__":
+    main()
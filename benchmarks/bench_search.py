@@ -0,0 +1,149 @@
+"""Full-text search latency on a large chat_messages table.
+
+Seeds a corpus of random messages server-side with generate_series into the
+configured Postgres database, then times app.services.search.search_messages
+for common, rare and multi-word queries, ranked and most-recent-first, over
+the first page and a few pages deep. Also prints the plans of a common and
+a rare query so the choice between the GIN and history indexes can be checked.
+
+    DATABASE_URL=postgresql+asyncpg://... python -m benchmarks.bench_search \\
+        --messages 10000000 --reset
+
+--reset drops and recreates every table of the target database.
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import text
+
+from app.db.models.base import Base
+from app.db.session import SessionLocal, engine
+from app.services.membership import membership
+from app.services.search import search_messages
+from benchmarks.common import dump, percentiles
+
+# a few very common words, a long tail and some rare ones
+VOCABULARY = (
+    ["hello", "thanks", "ok", "yes", "meeting", "today", "tomorrow", "lunch"]
+    + [f"word{i}" for i in range(5000)]
+    + ["kubernetes", "invoice", "birthday", "deadline"]
+)
+
+QUERIES = {
+    "common": "hello",
+    "rare": "kubernetes",
+    "two_words": "meeting tomorrow",
+    "phrase": '"lunch today"',
+    "no_match": "zzzznotaword",
+}
+
+
+async def seed(args):
+    async with engine.begin() as conn:
+        if args.reset:
+            await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        existing = (await conn.execute(text("SELECT count(*) FROM chat_messages"))).scalar()
+        if existing >= args.messages:
+            print(f"chat_messages already holds {existing} rows, skipping seeding")
+            return
+        await conn.execute(text(
+            "INSERT INTO users (username, email, hashed_password) "
+            "SELECT 'search' || g, 'search' || g || '@example.com', 'x' "
+            "FROM generate_series(1, :users) g"), {"users": args.users})
+        await conn.execute(text(
+            "INSERT INTO chat_rooms (name, is_group, created_at) "
+            "SELECT 'room' || g, true, now() FROM generate_series(1, :rooms) g"),
+            {"rooms": args.rooms})
+        # every user joins `members` rooms
+        await conn.execute(text(
+            "INSERT INTO chat_participants (chat_id, user_id) "
+            "SELECT 1 + (u * 7919 + k) % :rooms, u "
+            "FROM generate_series(1, :users) u, generate_series(1, :members) k"),
+            {"rooms": args.rooms, "users": args.users, "members": args.members})
+
+    vocabulary = "ARRAY[" + ",".join(f"'{word}'" for word in VOCABULARY) + "]"
+    # weighted toward the head of the vocabulary so common words are common
+    pick = f"({vocabulary})[1 + floor(power(random(), 3) * {len(VOCABULARY)})::int]"
+    inserted = 0
+    while inserted < args.messages:
+        batch = min(args.batch, args.messages - inserted)
+        started = time.perf_counter()
+        async with engine.begin() as conn:
+            await conn.execute(text(
+                "INSERT INTO chat_messages (chat_id, sender_id, message, created_at) "
+                f"SELECT 1 + (random() * (:rooms - 1))::int, 1 + (random() * (:users - 1))::int, "
+                f"concat_ws(' ', {pick}, {pick}, {pick}, {pick}, {pick}, {pick}, {pick}, {pick}), "
+                "now() - random() * interval '365 days' "
+                "FROM generate_series(1, :batch)"),
+                {"rooms": args.rooms, "users": args.users, "batch": batch})
+        inserted += batch
+        print(f"seeded {inserted}/{args.messages} messages "
+              f"({batch / (time.perf_counter() - started):.0f} rows/s)")
+    async with engine.begin() as conn:
+        await conn.execute(text("ANALYZE chat_messages"))
+        await conn.execute(text("ANALYZE chat_participants"))
+
+
+async def measure(args) -> dict:
+    report = {}
+    async with SessionLocal() as db:
+        for name, q in QUERIES.items():
+            for order in ("relevance", "recent"):
+                first, deep = [], []
+                for i in range(args.repeat):
+                    chat_ids = await membership.user_chats(db, 1 + (i * 104729) % args.users)
+                    started = time.perf_counter()
+                    page = await search_messages(db, chat_ids, q, order=order, limit=args.limit)
+                    first.append(time.perf_counter() - started)
+                    cursor = page["next"]
+                    for _ in range(args.pages - 1):
+                        if not cursor:
+                            break
+                        started = time.perf_counter()
+                        page = await search_messages(db, chat_ids, q, order=order,
+                                                     cursor=cursor, limit=args.limit)
+                        deep.append(time.perf_counter() - started)
+                        cursor = page["next"]
+                report[f"{name}_{order}"] = {"first_page": percentiles(first),
+                                             "later_pages": percentiles(deep)}
+
+        chat_ids = sorted(await membership.user_chats(db, 1))
+        for name in ("common", "rare"):
+            plan = await db.execute(text(
+                "EXPLAIN SELECT id FROM chat_messages "
+                "WHERE chat_id = ANY(:chat_ids) "
+                "AND search_vector @@ websearch_to_tsquery('simple', :q) "
+                "ORDER BY created_at DESC, id DESC LIMIT 21"),
+                {"chat_ids": chat_ids, "q": QUERIES[name]})
+            report[f"plan_{name}"] = [row[0] for row in plan]
+    return report
+
+
+async def run(args) -> dict:
+    await seed(args)
+    try:
+        return await measure(args)
+    finally:
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--rooms", type=int, default=2_000)
+    parser.add_argument("--members", type=int, default=10, help="rooms per user")
+    parser.add_argument("--batch", type=int, default=500_000, help="rows per seeding statement")
+    parser.add_argument("--reset", action="store_true",
+                        help="drop and recreate all tables before seeding")
+    parser.add_argument("--repeat", type=int, default=20, help="searches per query and order")
+    parser.add_argument("--pages", type=int, default=3, help="pages followed per search")
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+    dump(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
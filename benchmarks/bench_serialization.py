@@ -0,0 +1,90 @@
+"""Serialization cost of websocket fan-out and list responses.
+
+Compares the path websocket_endpoint and the list endpoints used to take,
+a MessageResponse per message, model_dump plus isoformat and json.dumps per
+recipient, and list responses validated through response_model, with
+app.core.serialization: one orjson Frame per message shared by every
+recipient, and FastJSONResponse rendering dicts built from rows.
+
+    python -m benchmarks.bench_serialization --recipients 200 --messages 2000
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from app.core.serialization import FastJSONResponse, Frame
+from app.schemas.chat import MessageResponse
+from benchmarks.common import dump
+
+
+def make_rows(count: int) -> list[dict]:
+    now = datetime.now(timezone.utc)
+    return [{"id": i, "chat_id": 1, "sender_id": i % 50,
+             "message": f"message number {i} " * 4, "created_at": now}
+            for i in range(count)]
+
+
+def fanout_before(rows: list[dict], recipients: int):
+    for row in rows:
+        response = MessageResponse(**row).model_dump()
+        response["created_at"] = response["created_at"].isoformat()
+        for _ in range(recipients):
+            json.dumps(response)
+
+
+def fanout_after(rows: list[dict], recipients: int):
+    for row in rows:
+        frame = Frame(row)
+        for _ in range(recipients):
+            frame.text
+
+
+def list_before(rows: list[dict]):
+    # what FastAPI does for response_model=list[MessageResponse]
+    adapter = TypeAdapter(list[MessageResponse])
+    models = [MessageResponse(**row) for row in rows]
+    json.dumps(jsonable_encoder(adapter.validate_python(models)),
+               ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def list_after(rows: list[dict]):
+    FastJSONResponse(rows).body
+
+
+def timed(func, *args, repeat: int) -> dict:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - started)
+    return {"best_ms": best * 1000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--recipients", type=int, default=100)
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.messages)
+    page = rows[:args.page_size]
+    report = {
+        "fanout_before": timed(fanout_before, rows, args.recipients, repeat=args.repeat),
+        "fanout_after": timed(fanout_after, rows, args.recipients, repeat=args.repeat),
+        "list_before": timed(list_before, page, repeat=args.repeat),
+        "list_after": timed(list_after, page, repeat=args.repeat),
+    }
+    for name in ("fanout", "list"):
+        after = report[f"{name}_after"]["best_ms"]
+        report[f"{name}_speedup"] = report[f"{name}_before"]["best_ms"] / after if after else None
+    dump(report)
+
+
+if __name__ == "__main__":
+    main()
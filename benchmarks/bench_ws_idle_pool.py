@@ -0,0 +1,73 @@
+"""Pool usage while idle websocket connections pile up.
+
+Opens idle /chat/ws/chat sockets in steps against the configured database and
+records the pool's checked out connections after each step. With per-unit-of-
+work sessions the count stays flat no matter how many sockets are open.
+
+    python -m benchmarks.bench_ws_idle_pool --sockets 200 --step 50
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from contextlib import ExitStack
+
+# every socket comes from the test client, read before the app is imported
+os.environ.setdefault("RATE_LIMITING", "false")
+
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+
+from app.core.jwt import create_access_token
+from app.core.security import hash_password
+from app.db.models.base import Base
+from app.db.models.user import User
+from app.db.session import SessionLocal, engine, pool_stats
+from app.main import app
+from benchmarks.common import dump
+
+
+async def seed_user(username: str):
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with SessionLocal() as db:
+        # a rerun reuses the user of the previous one
+        existing = (await db.execute(
+            select(User.id).filter(func.lower(User.username) == username.lower()))).first()
+        if existing is None:
+            db.add(User(username=username, hashed_password=hash_password("idle")))
+            await db.commit()
+    # the app runs on the test client's own event loop
+    await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sockets", type=int, default=200)
+    parser.add_argument("--step", type=int, default=50)
+    parser.add_argument("--username", default="bench-idle")
+    args = parser.parse_args()
+
+    asyncio.run(seed_user(args.username))
+    token = create_access_token({"sub": args.username})
+    samples = []
+    with TestClient(app) as client, ExitStack() as sockets:
+        # startup jobs check connections out briefly, wait for them to return
+        deadline = time.monotonic() + 5
+        while pool_stats().get("checked_out") and time.monotonic() < deadline:
+            time.sleep(0.05)
+        samples.append({"sockets": 0, **pool_stats()})
+        for opened in range(1, args.sockets + 1):
+            sockets.enter_context(client.websocket_connect(f"/chat/ws/chat?token={token}"))
+            if opened % args.step == 0:
+                samples.append({"sockets": opened, **pool_stats()})
+
+    checked_out = [sample.get("checked_out", 0) for sample in samples]
+    flat = max(checked_out) - min(checked_out) <= 1
+    dump({"flat": flat, "samples": samples})
+    sys.exit(0 if flat else 1)
+
+
+if __name__ == "__main__":
+    main()
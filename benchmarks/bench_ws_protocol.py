@@ -0,0 +1,149 @@
+"""Bytes on the wire and CPU per event of each websocket wire protocol.
+
+Encodes a stream of chat events (messages, acks and presence updates) the
+way the hub fans them out: each event once, then handed to every recipient's
+socket. For each protocol of app.core.wire, alone and batched, reports the
+bytes per event and the encode CPU per event on the server, plus the decode
+CPU per event a client pays. permessage_deflate is the plain JSON protocol
+behind the server's permessage-deflate extension, which compresses every
+frame again for each recipient with its own compressor (context takeover).
+
+    python -m benchmarks.bench_ws_protocol --events 5000 --recipients 100 --batch 16
+"""
+import argparse
+import random
+import time
+import zlib
+from datetime import datetime
+
+import msgpack
+import orjson
+
+from app.core.serialization import Frame
+from app.core.wire import WireProtocol
+from benchmarks.common import dump
+
+WORDS = ("hello", "meeting", "tomorrow", "deploy", "review", "lunch", "thanks", "ok",
+         "the", "build", "is", "green", "again", "can", "you", "check", "this")
+
+
+def make_events(count: int, seed: int = 1) -> list[dict]:
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    events = []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.8:
+            events.append({"id": 100000 + i, "chat_id": rng.randint(1, 500),
+                           "sender_id": rng.randint(1, 10000),
+                           "message": " ".join(rng.choices(WORDS, k=rng.randint(2, 30))),
+                           "created_at": now, "seq": 1000 + i})
+        elif kind < 0.9:
+            events.append({"type": "ack", "id": 100000 + i, "seq": 1000 + i, "created_at": now,
+                           "client_msg_id": f"{rng.getrandbits(64):016x}"})
+        else:
+            events.append({"type": "presence", "chat_id": rng.randint(1, 500),
+                           "presence": [{"user_id": rng.randint(1, 10000), "status": "online"}],
+                           "typing": [{"user_id": rng.randint(1, 10000), "typing": True}]})
+    return events
+
+
+def wire_size(data) -> int:
+    """Bytes of a server to client frame, header included."""
+    length = len(data.encode()) if isinstance(data, str) else len(data)
+    return length + (2 if length < 126 else 4 if length < 65536 else 10)
+
+
+def client_decoder(protocol: WireProtocol):
+    """What a client runs per received frame, the inverse of the protocol."""
+    def decode(data):
+        if isinstance(data, str):
+            return orjson.loads(data)
+        if protocol.compress:
+            data = data[1:] if data[:1] == b"\x00" else zlib.decompress(data[1:], -15)
+        if protocol.encoding == "json":
+            return orjson.loads(data)
+        return msgpack.unpackb(data, timestamp=3)
+    return decode
+
+
+def run_protocol(protocol: WireProtocol, events: list[dict], recipients: int, batch: int) -> dict:
+    frames = [Frame(event) for event in events]
+    started = time.process_time()
+    # the first recipient encodes each event, the others reuse it, batches
+    # are spliced per socket
+    for _ in range(recipients):
+        if protocol.batch:
+            wire = [protocol.encode_batch(frames[i:i + batch])
+                    for i in range(0, len(frames), batch)]
+        else:
+            wire = [protocol.encode(frame) for frame in frames]
+    encode_seconds = time.process_time() - started
+
+    decode = client_decoder(protocol)
+    started = time.process_time()
+    for data in wire:
+        decode(data)
+    decode_seconds = time.process_time() - started
+
+    total_bytes = sum(wire_size(data) for data in wire)
+    return {
+        "frames": len(wire),
+        "bytes_per_event": total_bytes / len(events),
+        "server_us_per_event": encode_seconds / len(events) * 1e6,
+        "server_us_per_delivery": encode_seconds / (len(events) * recipients) * 1e6,
+        "client_us_per_event": decode_seconds / len(events) * 1e6,
+    }
+
+
+def run_permessage_deflate(events: list[dict], recipients: int) -> dict:
+    frames = [Frame(event) for event in events]
+    # every socket keeps its own compressor, as the websockets library does
+    compressors = [zlib.compressobj(6, zlib.DEFLATED, -15) for _ in range(recipients)]
+    decompressor = zlib.decompressobj(-15)
+    total_bytes = 0
+    decode_seconds = 0.0
+    started = time.process_time()
+    for frame in frames:
+        data = frame.text.encode()
+        for i, compressor in enumerate(compressors):
+            compressed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if i == 0:
+                # the trailing 00 00 ff ff of the flush is not sent
+                total_bytes += wire_size(compressed[:-4])
+                decoded_at = time.process_time()
+                orjson.loads(decompressor.decompress(compressed))
+                decode_seconds += time.process_time() - decoded_at
+    encode_seconds = time.process_time() - started - decode_seconds
+    return {
+        "frames": len(frames),
+        "bytes_per_event": total_bytes / len(events),
+        "server_us_per_event": encode_seconds / len(events) * 1e6,
+        "server_us_per_delivery": encode_seconds / (len(events) * recipients) * 1e6,
+        "client_us_per_event": decode_seconds / len(events) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--recipients", type=int, default=100, help="sockets per event")
+    parser.add_argument("--batch", type=int, default=16, help="events per batch frame")
+    args = parser.parse_args()
+
+    events = make_events(args.events)
+    report = {}
+    for encoding in ("json", "msgpack"):
+        for compress in (False, True):
+            for batch in (False, True):
+                protocol = WireProtocol(encoding, compress, batch)
+                report[protocol.name] = run_protocol(protocol, events, args.recipients, args.batch)
+    report["permessage_deflate"] = run_permessage_deflate(events, args.recipients)
+    baseline = report["chat.json"]["bytes_per_event"]
+    for result in report.values():
+        result["bytes_vs_json"] = result["bytes_per_event"] / baseline
+    dump(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import asyncio
+import json
+import statistics
+import time
+
+
+def percentiles(samples: list[float]) -> dict:
+    """p50/p95/p99/max of a list of durations in seconds, reported in ms."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": pick(0.50),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+class LoopLagMonitor:
+    """Measures how late a periodic timer fires, i.e. event loop blocking."""
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - started - self.interval))
+
+    def report(self) -> dict:
+        return percentiles(self.samples)
+
+
+def dump(report: dict):
+    print(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,59 @@
+"""Compare two benchmark reports written by benchmarks.suite --output.
+
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import json
+
+FIELDS = ("p50_ms", "p95_ms", "p99_ms")
+
+
+def flatten(node, prefix=""):
+    """Yield (path, latency dict) for every percentile block in a report."""
+    if isinstance(node, dict):
+        if "p50_ms" in node:
+            yield prefix, node
+            return
+        for key, value in node.items():
+            yield from flatten(value, f"{prefix}.{key}" if prefix else key)
+
+
+def throughput(report: dict) -> dict:
+    rates = {}
+    for name, result in report["results"].items():
+        for key in ("throughput_per_second", "delivered_per_second"):
+            if key in result:
+                rates[f"{name}.{key}"] = result[key]
+    return rates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"{before['meta']['revision']} -> {after['meta']['revision']}")
+    old = dict(flatten(before))
+    for path, new in flatten(after):
+        if path not in old:
+            continue
+        cells = []
+        for field in FIELDS:
+            a, b = old[path].get(field), new.get(field)
+            if a and b is not None:
+                cells.append(f"{field} {a:9.2f} -> {b:9.2f} ({(b - a) / a:+.0%})")
+        print(f"{path:40} " + "  ".join(cells))
+    old_rates = throughput(before)
+    for key, b in throughput(after).items():
+        a = old_rates.get(key)
+        if a:
+            print(f"{key:40} {a:9.1f} -> {b:9.1f} ({(b - a) / a:+.0%})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""Load and latency benchmark for the auth, REST chat and websocket paths.
+
+Runs the FastAPI app under uvicorn on a background thread, seeds users, rooms
+and messages, then drives concurrent logins, chat listings, history reads and
+simulated websocket clients. Prints one JSON report, or writes it to --output,
+so runs on different commits can be compared with benchmarks.compare.
+
+    python -m benchmarks.suite --quick                       # sqlite, small
+    python -m benchmarks.suite --database-url postgresql+asyncpg://... --reset
+
+--reset drops and recreates every table of the target database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true",
+                        help="sqlite via aiosqlite and a small data set")
+    parser.add_argument("--database-url")
+    parser.add_argument("--reset", action="store_true",
+                        help="drop and recreate all tables before seeding")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=200)
+    parser.add_argument("--members", type=int, default=20, help="members per room")
+    parser.add_argument("--messages", type=int, default=200, help="messages per room")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per REST scenario")
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--ws-clients", type=int, default=200)
+    parser.add_argument("--ws-messages", type=int, default=20, help="messages sent per client")
+    parser.add_argument("--ws-interval", type=float, default=0.05, help="seconds between sends")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+    if args.quick:
+        args.database_url = args.database_url or "sqlite+aiosqlite:///./bench.sqlite"
+        args.reset = True
+        args.users, args.rooms, args.members, args.messages = 100, 20, 10, 50
+        args.requests, args.logins, args.ws_clients, args.ws_messages = 300, 30, 30, 10
+    return args
+
+
+def configure_environment(args):
+    # settings are read when app modules are imported, so this runs first
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    os.environ.setdefault("DB_ECHO", "false")
+    os.environ.setdefault("DB_POOL_SIZE", str(max(10, args.concurrency)))
+    # every client of the load comes from the same IP
+    os.environ.setdefault("RATE_LIMITING", "false")
+
+
+async def seed(args):
+    from sqlalchemy import func, insert, select
+
+    from app.core.security import hash_password
+    from app.db.models.base import Base
+    from app.db.models.chat import ChatMessage, ChatParticipant, ChatRoom
+    from app.db.models.user import User
+    from app.db.session import SessionLocal, engine
+
+    async with engine.begin() as conn:
+        if args.reset:
+            await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    rng = random.Random(42)
+    async with SessionLocal() as db:
+        existing = (await db.execute(select(func.count()).select_from(User))).scalar()
+        if existing:
+            print(f"database already holds {existing} users, skipping seeding")
+        else:
+            # one bcrypt hash shared by every user keeps seeding fast
+            hashed = hash_password("bench")
+            await db.execute(insert(User), [
+                {"username": f"bench{i}", "email": f"bench{i}@example.com",
+                 "hashed_password": hashed} for i in range(args.users)])
+            await db.execute(insert(ChatRoom), [
+                {"name": f"room{i}", "is_group": True} for i in range(args.rooms)])
+            user_ids = (await db.execute(select(User.id).order_by(User.id))).scalars().all()
+            room_ids = (await db.execute(select(ChatRoom.id).order_by(ChatRoom.id))).scalars().all()
+            participants = []
+            for room_id in room_ids:
+                for user_id in rng.sample(user_ids, min(args.members, len(user_ids))):
+                    participants.append({"chat_id": room_id, "user_id": user_id})
+            await db.execute(insert(ChatParticipant), participants)
+            members = {}
+            for row in participants:
+                members.setdefault(row["chat_id"], []).append(row["user_id"])
+            batch = []
+            for room_id in room_ids:
+                for n in range(args.messages):
+                    batch.append({"chat_id": room_id, "sender_id": rng.choice(members[room_id]),
+                                  "message": f"seed message {n}"})
+                    if len(batch) >= 5000:
+                        await db.execute(insert(ChatMessage), batch)
+                        batch = []
+            if batch:
+                await db.execute(insert(ChatMessage), batch)
+            await db.commit()
+
+        rows = (await db.execute(
+            select(User.username, ChatParticipant.chat_id).join(ChatParticipant))).all()
+    await engine.dispose()
+
+    rooms_by_user = {}
+    for username, chat_id in rows:
+        rooms_by_user.setdefault(username, []).append(chat_id)
+    return rooms_by_user
+
+
+class ServerThread(threading.Thread):
+    """uvicorn on its own thread and event loop, with a loop lag monitor."""
+
+    def __init__(self, port: int):
+        super().__init__(daemon=True)
+        import uvicorn
+
+        from app.main import app
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=port, log_level="warning", ws="websockets"))
+        self.loop = None
+        self.lag = None
+
+    def run(self):
+        from benchmarks.common import LoopLagMonitor
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.lag = LoopLagMonitor(interval=0.01)
+
+        async def serve():
+            async with self.lag:
+                await self.server.serve()
+
+        self.loop.run_until_complete(serve())
+
+    def wait_started(self, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.is_alive():
+                raise RuntimeError("server did not start")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.join(timeout=30)
+
+
+async def run_load(total: int, concurrency: int, request):
+    """Call `request` total times with at most `concurrency` in flight."""
+    from benchmarks.common import percentiles
+
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                ok = await request(i)
+            except Exception:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total)))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": total,
+        "errors": errors,
+        "seconds": elapsed,
+        "throughput_per_second": len(latencies) / elapsed if elapsed else 0,
+        "latency": percentiles(latencies),
+    }
+
+
+async def run_websockets(args, base_ws: str, tokens: dict, rooms_by_user: dict):
+    import websockets
+
+    from benchmarks.common import percentiles
+
+    usernames = [u for u in rooms_by_user if u in tokens][:args.ws_clients]
+    delivery, acks = [], []
+    received = 0
+    sent = 0
+    connected = asyncio.Event()
+    ready = 0
+
+    async def client(username: str):
+        nonlocal sent, ready
+        async with websockets.connect(f"{base_ws}/chat/ws/chat?token={tokens[username]}",
+                                      max_queue=None) as ws:
+            ready += 1
+            if ready == len(usernames):
+                connected.set()
+            await connected.wait()
+            pending_acks = []
+
+            async def reader():
+                nonlocal received
+                async for frame in ws:
+                    now = time.perf_counter()
+                    try:
+                        event = json.loads(frame)
+                    except ValueError:
+                        continue
+                    if event.get("type") == "ack":
+                        if pending_acks:
+                            acks.append(now - pending_acks.pop(0))
+                    elif "message" in event and event["message"].startswith("bench@"):
+                        delivery.append(now - float(event["message"][6:]))
+                        received += 1
+
+            reading = asyncio.create_task(reader())
+            rooms = rooms_by_user[username]
+            for _ in range(args.ws_messages):
+                stamp = time.perf_counter()
+                pending_acks.append(stamp)
+                await ws.send(json.dumps({"chat_id": random.choice(rooms),
+                                          "message": f"bench@{stamp}"}))
+                sent += 1
+                await asyncio.sleep(args.ws_interval)
+            # let in-flight deliveries land before closing
+            await asyncio.sleep(1)
+            reading.cancel()
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(client(u) for u in usernames), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    return {
+        "clients": len(usernames),
+        "client_errors": sum(isinstance(r, Exception) for r in results),
+        "messages_sent": sent,
+        "messages_delivered": received,
+        "seconds": elapsed,
+        "sent_per_second": sent / elapsed if elapsed else 0,
+        "delivered_per_second": received / elapsed if elapsed else 0,
+        "delivery_latency": percentiles(delivery),
+        "ack_latency": percentiles(acks),
+    }
+
+
+async def run_scenarios(args, rooms_by_user: dict):
+    import httpx
+
+    from app.core.jwt import create_access_token
+
+    base = f"http://127.0.0.1:{args.port}"
+    base_ws = f"ws://127.0.0.1:{args.port}"
+    usernames = list(rooms_by_user)
+    tokens = {u: create_access_token({"sub": u}) for u in usernames}
+    limits = httpx.Limits(max_connections=args.concurrency,
+                          max_keepalive_connections=args.concurrency)
+    report = {}
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=60) as http:
+        async def login(i):
+            response = await http.post("/auth/login", data={
+                "username": usernames[i % len(usernames)], "password": "bench"})
+            return response.status_code == 200
+
+        async def list_chats(i):
+            username = usernames[i % len(usernames)]
+            response = await http.get(
+                "/chat/", headers={"Authorization": f"Bearer {tokens[username]}"})
+            return response.status_code == 200
+
+        async def read_messages(i):
+            username = usernames[i % len(usernames)]
+            chat_id = rooms_by_user[username][i % len(rooms_by_user[username])]
+            response = await http.get(
+                f"/chat/{chat_id}/messages", params={"limit": 50},
+                headers={"Authorization": f"Bearer {tokens[username]}"})
+            return response.status_code == 200
+
+        report["login"] = await run_load(args.logins, args.concurrency, login)
+        report["list_chats"] = await run_load(args.requests, args.concurrency, list_chats)
+        report["read_messages"] = await run_load(args.requests, args.concurrency, read_messages)
+    report["websocket"] = await run_websockets(args, base_ws, tokens, rooms_by_user)
+    return report
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+
+    from benchmarks.common import dump
+
+    rooms_by_user = asyncio.run(seed(args))
+    server = ServerThread(args.port)
+    server.start()
+    server.wait_started()
+    try:
+        results = asyncio.run(run_scenarios(args, rooms_by_user))
+    finally:
+        server.stop()
+
+    report = {
+        "meta": {
+            "revision": git_revision(),
+            "database": os.environ.get("DATABASE_URL", "").split("://")[0],
+            "scale": {k: getattr(args, k) for k in (
+                "users", "rooms", "members", "messages", "concurrency", "requests",
+                "logins", "ws_clients", "ws_messages")},
+        },
+        "results": results,
+        "server_event_loop_lag": server.lag.report(),
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    dump(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ import asyncio
 from app.db.models.base import Base
 from app.db.models.user import *
 from app.db.models.chat import *
+from app.db.models.email import *
+from app.db.models.rate_limit import *
 
 # Load the Alembic config
 config = context.config
@@ -19,11 +21,25 @@ if config.config_file_name is not None:
 target_metadata = Base.metadata
 
 
+def include_object(object, name, type_, reflected, compare_to):
+    # created by migrations and an after_create hook, not mapped on the model
+    if type_ == "column" and name == "search_vector":
+        return False
+    if type_ == "index" and name in ("ix_chat_messages_search_vector", "ix_users_username_lower_trgm"):
+        return False
+    # chat_messages partitions are managed by app.db.partitions
+    table = object if type_ == "table" else getattr(object, "table", None)
+    if reflected and table is not None and table.name.startswith("chat_messages_"):
+        return False
+    return True
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode."""
     url = config.get_main_option("sqlalchemy.url")
     context.configure(
-        url=url, target_metadata=target_metadata, literal_binds=True)
+        url=url, target_metadata=target_metadata, literal_binds=True,
+        include_object=include_object)
     with context.begin_transaction():
         context.run_migrations()
 
@@ -46,7 +62,8 @@ async def run_migrations_online():
 
 
 def do_run_migrations(connection):
-    context.configure(connection=connection, target_metadata=target_metadata)
+    context.configure(connection=connection, target_metadata=target_metadata,
+                      include_object=include_object)
     with context.begin_transaction():
         context.run_migrations()
 
@@ -0,0 +1,58 @@
+"""add inbox room summaries
+
+Revision ID: 5b1c0e7a9f32
+Revises: d7fda154e444
+Create Date: 2026-10-18 11:03:27.118524
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b1c0e7a9f32'
+down_revision: Union[str, None] = 'd7fda154e444'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chat_rooms', sa.Column('last_message_id', sa.Integer(), nullable=True))
+    op.add_column('chat_rooms', sa.Column('last_message_at', sa.DateTime(), nullable=True))
+    op.add_column('chat_rooms', sa.Column('member_count', sa.Integer(),
+                                          server_default='0', nullable=False))
+    op.add_column('chat_participants', sa.Column('last_read_message_id', sa.Integer(), nullable=True))
+    op.add_column('chat_participants', sa.Column('unread_count', sa.Integer(),
+                                                 server_default='0', nullable=False))
+    op.create_index('ix_chat_participants_user_id_chat_id', 'chat_participants',
+                    ['user_id', 'chat_id'], unique=False)
+
+    # backfill the summaries, existing history counts as read
+    op.execute("""
+        UPDATE chat_rooms r SET member_count = p.members
+        FROM (SELECT chat_id, count(*) AS members
+              FROM chat_participants GROUP BY chat_id) p
+        WHERE p.chat_id = r.id
+    """)
+    op.execute("""
+        UPDATE chat_rooms r SET last_message_id = m.id, last_message_at = m.created_at
+        FROM (SELECT DISTINCT ON (chat_id) chat_id, id, created_at
+              FROM chat_messages ORDER BY chat_id, id DESC) m
+        WHERE m.chat_id = r.id
+    """)
+    op.execute("""
+        UPDATE chat_participants p SET last_read_message_id = r.last_message_id
+        FROM chat_rooms r
+        WHERE r.id = p.chat_id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chat_participants_user_id_chat_id', table_name='chat_participants')
+    op.drop_column('chat_participants', 'unread_count')
+    op.drop_column('chat_participants', 'last_read_message_id')
+    op.drop_column('chat_rooms', 'member_count')
+    op.drop_column('chat_rooms', 'last_message_at')
+    op.drop_column('chat_rooms', 'last_message_id')
@@ -0,0 +1,37 @@
+"""add chat_messages search vector
+
+Revision ID: 9c2f4a71d8e6
+Revises: 5b1c0e7a9f32
+Create Date: 2026-10-18 13:52:08.640317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c2f4a71d8e6'
+down_revision: Union[str, None] = '5b1c0e7a9f32'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # stored generated column, ADD COLUMN rewrites the table once
+    op.execute("""
+        ALTER TABLE chat_messages ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('simple', message)) STORED
+    """)
+    # build the GIN index without blocking writes on a large table
+    with op.get_context().autocommit_block():
+        op.create_index('ix_chat_messages_search_vector', 'chat_messages',
+                        ['search_vector'], unique=False, postgresql_using='gin',
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_chat_messages_search_vector', table_name='chat_messages',
+                      postgresql_concurrently=True)
+    op.drop_column('chat_messages', 'search_vector')
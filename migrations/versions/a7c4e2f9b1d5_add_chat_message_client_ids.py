@@ -0,0 +1,40 @@
+"""add chat message client ids
+
+Revision ID: a7c4e2f9b1d5
+Revises: f2a9c6d41e83
+Create Date: 2026-10-18 19:02:11.408316
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7c4e2f9b1d5'
+down_revision: Union[str, None] = 'f2a9c6d41e83'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'chat_message_client_ids',
+        sa.Column('sender_id', sa.Integer(), nullable=False),
+        sa.Column('client_msg_id', sa.String(length=64), nullable=False),
+        sa.Column('chat_id', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=True),
+        sa.Column('message_created_at', sa.DateTime(), nullable=True),
+        sa.Column('seq', sa.Integer(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.text('now()'), nullable=False),
+        sa.PrimaryKeyConstraint('sender_id', 'client_msg_id'),
+    )
+    # the pruning scans by age
+    op.create_index(op.f('ix_chat_message_client_ids_created_at'), 'chat_message_client_ids',
+                    ['created_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_chat_message_client_ids_created_at'), table_name='chat_message_client_ids')
+    op.drop_table('chat_message_client_ids')
@@ -0,0 +1,32 @@
+"""add rate limit buckets
+
+Revision ID: b6e3f1a2c9d4
+Revises: 3a8d5c2e6b17
+Create Date: 2026-10-18 16:20:44.508113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6e3f1a2c9d4'
+down_revision: Union[str, None] = '3a8d5c2e6b17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'rate_limit_buckets',
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('tat', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('key'),
+        prefixes=['UNLOGGED'],
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('rate_limit_buckets')
@@ -0,0 +1,56 @@
+"""unique chat participants
+
+Revision ID: c5d8a3e1f7b2
+Revises: b6e3f1a2c9d4
+Create Date: 2026-10-18 17:05:12.774301
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5d8a3e1f7b2'
+down_revision: Union[str, None] = 'b6e3f1a2c9d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # keep the oldest row of each duplicated membership, with the most
+    # advanced read receipt of its copies
+    op.execute("""
+        UPDATE chat_participants p
+        SET last_read_message_id = d.last_read_message_id, unread_count = d.unread_count
+        FROM (SELECT min(id) AS id, max(last_read_message_id) AS last_read_message_id,
+                     min(unread_count) AS unread_count
+              FROM chat_participants GROUP BY chat_id, user_id HAVING count(*) > 1) d
+        WHERE p.id = d.id
+    """)
+    op.execute("""
+        DELETE FROM chat_participants p
+        USING chat_participants k
+        WHERE k.chat_id = p.chat_id AND k.user_id = p.user_id AND k.id < p.id
+    """)
+    # duplicates were counted as members
+    op.execute("""
+        UPDATE chat_rooms r SET member_count = c.members
+        FROM (SELECT chat_id, count(*) AS members
+              FROM chat_participants GROUP BY chat_id) c
+        WHERE c.chat_id = r.id AND r.member_count <> c.members
+    """)
+    # built without blocking writes, if a duplicate slipped in meanwhile
+    # the build fails and leaves an invalid index, dropped here so the
+    # migration can simply be run again
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS uq_chat_participants_chat_id_user_id")
+        op.create_index('uq_chat_participants_chat_id_user_id', 'chat_participants',
+                        ['chat_id', 'user_id'], unique=True,
+                        postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('uq_chat_participants_chat_id_user_id', table_name='chat_participants',
+                      postgresql_concurrently=True)
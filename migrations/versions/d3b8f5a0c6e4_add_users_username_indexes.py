@@ -0,0 +1,58 @@
+"""add users username indexes
+
+Revision ID: d3b8f5a0c6e4
+Revises: a7c4e2f9b1d5
+Create Date: 2026-10-18 19:41:53.127604
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd3b8f5a0c6e4'
+down_revision: Union[str, None] = 'a7c4e2f9b1d5'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    duplicates = op.get_bind().execute(sa.text(
+        "SELECT count(*) FROM (SELECT 1 FROM users GROUP BY lower(username) "
+        "HAVING count(*) > 1) d")).scalar()
+    if duplicates:
+        raise RuntimeError(
+            f"{duplicates} usernames differ only in case, rename those users before upgrading")
+    # build without blocking sign ups and logins on a large table, a build
+    # that failed leaves an invalid index, dropped first so a rerun works
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS uq_users_username_lower")
+        op.create_index('uq_users_username_lower', 'users', [sa.text('lower(username)')],
+                        unique=True, postgresql_concurrently=True)
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_lower_pattern")
+        op.execute("CREATE INDEX CONCURRENTLY ix_users_username_lower_pattern "
+                   "ON users (lower(username) text_pattern_ops)")
+        # substring search works without it, scanning the table
+        op.execute("""
+            DO $$ BEGIN
+                IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+                    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                END IF;
+            END $$
+        """)
+        installed = op.get_bind().execute(sa.text(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first()
+        if installed:
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_lower_trgm")
+            op.execute("CREATE INDEX CONCURRENTLY ix_users_username_lower_trgm "
+                       "ON users USING gin (lower(username) gin_trgm_ops)")
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_lower_trgm")
+        op.drop_index('ix_users_username_lower_pattern', table_name='users',
+                      postgresql_concurrently=True)
+        op.drop_index('uq_users_username_lower', table_name='users',
+                      postgresql_concurrently=True)
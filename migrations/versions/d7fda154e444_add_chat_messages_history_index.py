@@ -0,0 +1,28 @@
+"""add chat_messages history index
+
+Revision ID: d7fda154e444
+Revises: 
+Create Date: 2026-10-18 09:12:41.402113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd7fda154e444'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # keyset pagination of a chat's history walks (created_at, id) in order
+    op.create_index('ix_chat_messages_chat_id_created_at_id', 'chat_messages',
+                    ['chat_id', 'created_at', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_chat_messages_chat_id_created_at_id',
+                  table_name='chat_messages')
@@ -0,0 +1,136 @@
+"""partition chat_messages by month
+
+Revision ID: e41b7d09a3c5
+Revises: 9c2f4a71d8e6
+Create Date: 2026-10-18 14:21:47.903215
+
+The old table is renamed to chat_messages_legacy and a range partitioned
+chat_messages takes its place, keeping the id sequence. Rows are copied in
+this migration unless it runs with `alembic -x defer_copy=true upgrade`, in
+which case `python -m app.services.partition_maintenance migrate-legacy`
+moves them afterwards in small batches.
+"""
+from datetime import date
+from typing import Sequence, Union
+
+from alembic import context, op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e41b7d09a3c5'
+down_revision: Union[str, None] = '9c2f4a71d8e6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+MONTHS_AHEAD = 3
+
+
+def _add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _create_partition(month: date) -> None:
+    op.execute(f"CREATE TABLE IF NOT EXISTS chat_messages_p{month:%Y%m} PARTITION OF chat_messages "
+               f"FOR VALUES FROM ('{month}') TO ('{_add_months(month, 1)}')")
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+    # move the old table and its index names out of the way
+    op.rename_table('chat_messages', 'chat_messages_legacy')
+    for index in ('chat_messages_pkey', 'ix_chat_messages_id',
+                  'ix_chat_messages_chat_id_created_at_id', 'ix_chat_messages_search_vector'):
+        op.execute(f"ALTER INDEX IF EXISTS {index} RENAME TO {index}_legacy")
+    op.execute("ALTER TABLE chat_messages_legacy ALTER COLUMN id DROP DEFAULT")
+    op.execute("ALTER SEQUENCE chat_messages_id_seq OWNED BY NONE")
+
+    # the primary key of a partitioned table has to include created_at
+    op.execute("""
+        CREATE TABLE chat_messages (
+            id integer NOT NULL DEFAULT nextval('chat_messages_id_seq'),
+            chat_id integer REFERENCES chat_rooms (id),
+            sender_id integer REFERENCES users (id),
+            message varchar NOT NULL,
+            created_at timestamp without time zone NOT NULL DEFAULT now(),
+            search_vector tsvector
+                GENERATED ALWAYS AS (to_tsvector('simple', message)) STORED,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute("ALTER SEQUENCE chat_messages_id_seq OWNED BY chat_messages.id")
+    op.create_index('ix_chat_messages_chat_id_created_at_id', 'chat_messages',
+                    ['chat_id', 'created_at', 'id'], unique=False)
+    op.create_index('ix_chat_messages_search_vector', 'chat_messages',
+                    ['search_vector'], unique=False, postgresql_using='gin')
+    op.create_table(
+        'chat_message_archives',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('month', sa.Date(), nullable=False),
+        sa.Column('path', sa.String(), nullable=False),
+        sa.Column('message_count', sa.Integer(), nullable=False),
+        sa.Column('archived_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('month'),
+    )
+
+    # one partition per month of existing history, plus the coming months
+    today = conn.execute(sa.text("SELECT localtimestamp")).scalar()
+    first = date(today.year, today.month, 1)
+    months = set(conn.execute(sa.text(
+        "SELECT DISTINCT date_trunc('month', created_at)::date FROM chat_messages_legacy "
+        "WHERE created_at IS NOT NULL")).scalars())
+    months.update(_add_months(first, n) for n in range(MONTHS_AHEAD + 1))
+    for month in sorted(months):
+        _create_partition(month)
+    op.execute("CREATE TABLE chat_messages_default PARTITION OF chat_messages DEFAULT")
+
+    if context.get_x_argument(as_dictionary=True).get('defer_copy', '').lower() in ('1', 'true', 'yes'):
+        return
+    op.execute("""
+        INSERT INTO chat_messages (id, chat_id, sender_id, message, created_at)
+        SELECT id, chat_id, sender_id, message, coalesce(created_at, now())
+        FROM chat_messages_legacy
+    """)
+    op.drop_table('chat_messages_legacy')
+
+
+def downgrade() -> None:
+    # archived months are not restored, their files stay on disk
+    op.drop_table('chat_message_archives')
+    op.execute("ALTER SEQUENCE chat_messages_id_seq OWNED BY NONE")
+    op.rename_table('chat_messages', 'chat_messages_partitioned')
+    for index in ('chat_messages_pkey', 'ix_chat_messages_chat_id_created_at_id',
+                  'ix_chat_messages_search_vector'):
+        op.execute(f"ALTER INDEX {index} RENAME TO {index}_partitioned")
+    op.execute("""
+        CREATE TABLE chat_messages (
+            id integer NOT NULL DEFAULT nextval('chat_messages_id_seq'),
+            chat_id integer REFERENCES chat_rooms (id),
+            sender_id integer REFERENCES users (id),
+            message varchar NOT NULL,
+            created_at timestamp without time zone,
+            search_vector tsvector
+                GENERATED ALWAYS AS (to_tsvector('simple', message)) STORED,
+            CONSTRAINT chat_messages_pkey PRIMARY KEY (id)
+        )
+    """)
+    op.execute("ALTER SEQUENCE chat_messages_id_seq OWNED BY chat_messages.id")
+    op.execute("""
+        INSERT INTO chat_messages (id, chat_id, sender_id, message, created_at)
+        SELECT id, chat_id, sender_id, message, created_at FROM chat_messages_partitioned
+    """)
+    # rows not moved yet after a deferred copy
+    if op.get_bind().execute(sa.text("SELECT to_regclass('chat_messages_legacy')")).scalar():
+        op.execute("""
+            INSERT INTO chat_messages (id, chat_id, sender_id, message, created_at)
+            SELECT id, chat_id, sender_id, message, created_at FROM chat_messages_legacy
+        """)
+        op.drop_table('chat_messages_legacy')
+    op.execute("DROP TABLE chat_messages_partitioned")
+    op.create_index('ix_chat_messages_id', 'chat_messages', ['id'], unique=True)
+    op.create_index('ix_chat_messages_chat_id_created_at_id', 'chat_messages',
+                    ['chat_id', 'created_at', 'id'], unique=False)
+    op.create_index('ix_chat_messages_search_vector', 'chat_messages',
+                    ['search_vector'], unique=False, postgresql_using='gin')
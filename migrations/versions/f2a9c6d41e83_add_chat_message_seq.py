@@ -0,0 +1,47 @@
+"""add chat message seq
+
+Revision ID: f2a9c6d41e83
+Revises: c5d8a3e1f7b2
+Create Date: 2026-10-18 18:10:37.219544
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f2a9c6d41e83'
+down_revision: Union[str, None] = 'c5d8a3e1f7b2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('chat_rooms', sa.Column('last_seq', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('chat_messages', sa.Column('seq', sa.Integer(), nullable=True))
+    # number the live rows of each room in history order, months archived
+    # before this migration keep no seq, later archives carry it
+    op.execute("""
+        UPDATE chat_messages m SET seq = n.seq
+        FROM (SELECT id, created_at,
+                     row_number() OVER (PARTITION BY chat_id ORDER BY created_at, id) AS seq
+              FROM chat_messages) n
+        WHERE m.id = n.id AND m.created_at = n.created_at
+    """)
+    op.execute("""
+        UPDATE chat_rooms r SET last_seq = s.last_seq
+        FROM (SELECT chat_id, max(seq) AS last_seq FROM chat_messages GROUP BY chat_id) s
+        WHERE s.chat_id = r.id
+    """)
+    # a partitioned table cannot build an index concurrently, this one
+    # blocks writes while it builds, like the backfill above
+    op.create_index('uq_chat_messages_chat_id_seq', 'chat_messages',
+                    ['chat_id', 'seq', 'created_at'], unique=True)
+
+
+def downgrade() -> None:
+    op.drop_index('uq_chat_messages_chat_id_seq', table_name='chat_messages')
+    op.drop_column('chat_messages', 'seq')
+    op.drop_column('chat_rooms', 'last_seq')